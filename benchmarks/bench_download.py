@@ -0,0 +1,189 @@
+"""Download throughput benchmark for /download
+
+Starts file.py in a subprocess, downloads a generated file repeatedly and
+reports client-side MB/s and server CPU seconds per GB sent. Pass --ref to
+run the same benchmark against file.py from another git revision, e.g.
+
+    python benchmarks/bench_download.py --size-mb 512 --ref HEAD~1
+
+Use --server gunicorn (if installed) to measure the sendfile(2) path; the
+Werkzeug development server always copies through Python.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def process_cpu_seconds(pid):
+    """User + system CPU time of a process and its children, from /proc (Linux only)
+
+    Children matter for gunicorn, where the requests are served by a worker
+    process forked from the one we started.
+    """
+    stats = {}
+    try:
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as f:
+                        fields = f.read().rsplit(')', 1)[1].split()
+                except OSError:
+                    continue
+                stats[int(entry)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+    except OSError:
+        return None
+    if pid not in stats:
+        return None
+    tree = {pid}
+    changed = True
+    while changed:
+        changed = False
+        for child, (parent, _) in stats.items():
+            if parent in tree and child not in tree:
+                tree.add(child)
+                changed = True
+    return sum(stats[p][1] for p in tree) / os.sysconf('SC_CLK_TCK')
+
+def start_server(source, workdir, server, port, threads):
+    """Copy file.py into workdir and serve it from there"""
+    shutil.copy(source, os.path.join(workdir, 'file.py'))
+    if server == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', '-w', '1', '--threads', str(threads),
+               '-b', f'127.0.0.1:{port}', 'file:app']
+    else:
+        cmd = [sys.executable, '-c',
+               f"import file; file.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    proc = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/files', timeout=1).read()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f'server did not start: {" ".join(cmd)}')
+
+def fetch(url, range_header=None):
+    """Download url, discarding the body; returns bytes received"""
+    headers = {'Range': range_header} if range_header else {}
+    buf = bytearray(1024 * 1024)
+    received = 0
+    with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as resp:
+        while True:
+            n = resp.readinto(buf)
+            if not n:
+                return received
+            received += n
+
+def run(source, args):
+    workdir = tempfile.mkdtemp(prefix='bench_download_')
+    try:
+        shared = os.path.join(workdir, 'shared_files')
+        os.makedirs(shared)
+        size = args.size_mb * 1024 * 1024
+        with open(os.path.join(shared, 'bench.bin'), 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        port = free_port()
+        proc = start_server(source, workdir, args.server, port, args.concurrency)
+        try:
+            url = f'http://127.0.0.1:{port}/download/bench.bin'
+            fetch(url)  # warm the page cache
+            jobs = list(range(args.requests))
+            lock = threading.Lock()
+            total = [0]
+
+            def worker():
+                while True:
+                    with lock:
+                        if not jobs:
+                            return
+                        jobs.pop()
+                    range_header = None
+                    if args.range_mb:
+                        length = args.range_mb * 1024 * 1024
+                        start = random.randrange(0, max(size - length, 1))
+                        range_header = f'bytes={start}-{start + length - 1}'
+                    n = fetch(url, range_header)
+                    with lock:
+                        total[0] += n
+
+            cpu_before = process_cpu_seconds(proc.pid)
+            started = time.perf_counter()
+            threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - started
+            cpu_after = process_cpu_seconds(proc.pid)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+        gigabytes = total[0] / 1024 ** 3
+        cpu = None if cpu_before is None or cpu_after is None else cpu_after - cpu_before
+        return {
+            'bytes': total[0],
+            'seconds': round(elapsed, 3),
+            'mb_per_s': round(total[0] / 1024 ** 2 / elapsed, 1),
+            'server_cpu_s': None if cpu is None else round(cpu, 3),
+            'server_cpu_s_per_gb': None if cpu is None or not gigabytes else round(cpu / gigabytes, 3),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256, help='size of the test file')
+    parser.add_argument('--requests', type=int, default=8, help='number of downloads')
+    parser.add_argument('--concurrency', type=int, default=4, help='parallel downloads')
+    parser.add_argument('--range-mb', type=int, default=0,
+                        help='fetch random ranges of this size instead of whole files')
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn'), default='werkzeug')
+    parser.add_argument('--ref', help='also benchmark file.py from this git revision')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    sources = {'working tree': os.path.join(REPO, 'file.py')}
+    tmp = None
+    if args.ref:
+        tmp = tempfile.mkdtemp(prefix='bench_ref_')
+        ref_source = os.path.join(tmp, 'file.py')
+        with open(ref_source, 'wb') as f:
+            f.write(subprocess.check_output(['git', 'show', f'{args.ref}:file.py'], cwd=REPO))
+        sources = {args.ref: ref_source, **sources}
+
+    try:
+        results = {label: run(source, args) for label, source in sources.items()}
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{"version":<16}{"MB/s":>10}{"CPU s":>10}{"CPU s/GB":>12}')
+    for label, r in results.items():
+        print(f'{label:<16}{r["mb_per_s"]:>10}{str(r["server_cpu_s"]):>10}{str(r["server_cpu_s_per_gb"]):>12}')
+
+if __name__ == '__main__':
+    main()
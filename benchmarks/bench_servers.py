@@ -0,0 +1,152 @@
+"""Load test comparing the dev (threaded Werkzeug) and asgi servers
+
+Opens many slow concurrent downloads, the kind a phone on weak Wi-Fi makes,
+and while they run measures /files latency from a separate client. Reports
+latency percentiles, failed requests and the server's thread count and
+resident memory, e.g.
+
+    python benchmarks/bench_servers.py --slow-clients 500 --json
+
+The asgi server needs uvicorn installed; it is skipped otherwise.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def process_status(pid):
+    """Thread count and resident memory (MB) of a process, from /proc (Linux only)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None, None
+    return int(fields['Threads']), round(int(fields['VmRSS'].split()[0]) / 1024, 1)
+
+def start_server(workdir, server, port, max_connections):
+    shutil.copy(os.path.join(REPO, 'file.py'), os.path.join(workdir, 'file.py'))
+    cmd = [sys.executable, 'file.py', '--server', server, '--host', '127.0.0.1',
+           '--port', str(port), '--max-connections', str(max_connections)]
+    proc = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/files', timeout=1).read()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f'server did not start: {" ".join(cmd)}')
+
+def slow_download(port, path, read_size, delay, stop, errors):
+    """Read a download a little at a time until told to stop"""
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=30) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024)
+            s.sendall(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+            if not s.recv(read_size).startswith(b'HTTP/1.1 200'):
+                errors.append('status')
+                return
+            while not stop.is_set():
+                if not s.recv(read_size):
+                    return
+                time.sleep(delay)
+    except OSError as e:
+        errors.append(type(e).__name__)
+
+def percentile(values, p):
+    values = sorted(values)
+    return round(values[min(int(len(values) * p / 100), len(values) - 1)] * 1000, 2) if values else None
+
+def run(server, args):
+    workdir = tempfile.mkdtemp(prefix='bench_servers_')
+    try:
+        shared = os.path.join(workdir, 'shared_files')
+        os.makedirs(shared)
+        with open(os.path.join(shared, 'bench.bin'), 'wb') as f:
+            f.write(os.urandom(args.size_mb * 1024 * 1024))
+        for i in range(args.files):
+            with open(os.path.join(shared, f'file_{i:05d}.txt'), 'w') as f:
+                f.write('x')
+
+        port = free_port()
+        proc = start_server(workdir, server, port, args.slow_clients + 100)
+        stop = threading.Event()
+        errors = []
+        try:
+            clients = [threading.Thread(target=slow_download, daemon=True,
+                                        args=(port, '/download/bench.bin', 4096, 0.05, stop, errors))
+                       for _ in range(args.slow_clients)]
+            for t in clients:
+                t.start()
+                time.sleep(0.002)
+            time.sleep(1)
+
+            latencies = []
+            failed = 0
+            url = f'http://127.0.0.1:{port}/files?limit=100'
+            for _ in range(args.requests):
+                started = time.perf_counter()
+                try:
+                    urllib.request.urlopen(url, timeout=10).read()
+                    latencies.append(time.perf_counter() - started)
+                except OSError:
+                    failed += 1
+            threads, rss_mb = process_status(proc.pid)
+        finally:
+            stop.set()
+            proc.terminate()
+            proc.wait()
+        return {
+            'slow_clients': args.slow_clients,
+            'slow_client_errors': len(errors),
+            'files_p50_ms': percentile(latencies, 50),
+            'files_p99_ms': percentile(latencies, 99),
+            'files_failed': failed,
+            'server_threads': threads,
+            'server_rss_mb': rss_mb,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--slow-clients', type=int, default=200, help='concurrent slow downloads')
+    parser.add_argument('--requests', type=int, default=200, help='/files requests to time')
+    parser.add_argument('--files', type=int, default=1000, help='small files in the share')
+    parser.add_argument('--size-mb', type=int, default=64, help='size of the downloaded file')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    servers = ['dev']
+    if importlib.util.find_spec('uvicorn'):
+        servers.append('asgi')
+    else:
+        print('uvicorn not installed, skipping the asgi server', file=sys.stderr)
+
+    results = {server: run(server, args) for server in servers}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{"server":<8}{"p50 ms":>10}{"p99 ms":>10}{"failed":>8}{"errors":>8}{"threads":>9}{"RSS MB":>9}')
+    for server, r in results.items():
+        print(f'{server:<8}{str(r["files_p50_ms"]):>10}{str(r["files_p99_ms"]):>10}{r["files_failed"]:>8}'
+              f'{r["slow_client_errors"]:>8}{str(r["server_threads"]):>9}{str(r["server_rss_mb"]):>9}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Startup benchmark: import time and time to first byte of the page
+
+Runs file.py in fresh processes and reports, as the median over --runs:
+
+- import_ms: time to import the module, measured inside the process
+- ttfb_ms: from starting the server process to the first byte of GET /
+- first_page_ms / second_page_ms: the whole first and second GET /
+
+It also lists which of the optional heavy modules were loaded by the import.
+Pass --ref to compare with file.py from another git revision, e.g.
+
+    python benchmarks/bench_startup.py --ref HEAD~1 --files 10000
+
+file.py is byte-compiled up front, as it would be after a first run. Python
+never uses cached bytecode for a script run as `python file.py`, so that
+start recompiles the whole file; --launch module starts it as
+`python -m file` instead, which loads the cached bytecode.
+"""
+import argparse
+import json
+import os
+import py_compile
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_download import free_port
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('qrcode', 'PIL.Image', 'asyncio', 'sqlite3', 'tarfile', 'zstandard', 'brotli', 'ctypes')
+
+IMPORT_PROBE = f'''
+import json, sys, time
+started = time.perf_counter()
+import file
+elapsed = time.perf_counter() - started
+# Lazily imported modules sit in sys.modules as placeholders until first use
+loaded = [m for m in {HEAVY_MODULES!r}
+          if m in sys.modules and type(sys.modules[m]).__name__ != '_LazyModule']
+print(json.dumps({{'import_ms': elapsed * 1000, 'loaded': loaded}}))
+'''
+
+def get_page(port, timeout=30):
+    """GET / once the server accepts connections; returns (first byte, done) times"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+            break
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise RuntimeError('server did not start')
+            time.sleep(0.005)
+    with sock:
+        sock.sendall(b'GET / HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n')
+        data = sock.recv(65536)
+        first_byte = time.perf_counter()
+        while data:
+            data = sock.recv(65536)
+        return first_byte, time.perf_counter()
+
+def populate(shared, count):
+    os.makedirs(shared)
+    for i in range(count):
+        folder = os.path.join(shared, f'folder{i // 1000:03}')
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f'file{i}.txt'), 'w') as f:
+            f.write(f'file {i}\n')
+
+def run(source, args):
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        shutil.copy(source, os.path.join(workdir, 'file.py'))
+        py_compile.compile(os.path.join(workdir, 'file.py'), doraise=True)
+        populate(os.path.join(workdir, 'shared_files'), args.files)
+        results = []
+        for _ in range(args.runs):
+            probe = json.loads(subprocess.check_output([sys.executable, '-c', IMPORT_PROBE], cwd=workdir))
+
+            port = free_port()
+            started = time.perf_counter()
+            launch = ['file.py'] if args.launch == 'script' else ['-m', 'file']
+            proc = subprocess.Popen([sys.executable, *launch, '--server', args.server, '--host', '127.0.0.1',
+                                     '--port', str(port)], cwd=workdir,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                first_byte, first_done = get_page(port)
+                second_started = time.perf_counter()
+                _, second_done = get_page(port)
+            finally:
+                proc.terminate()
+                proc.wait()
+            results.append({
+                'import_ms': probe['import_ms'],
+                'ttfb_ms': (first_byte - started) * 1000,
+                'first_page_ms': (first_done - started) * 1000,
+                'second_page_ms': (second_done - second_started) * 1000,
+                'loaded': probe['loaded'],
+            })
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = {key: round(statistics.median(r[key] for r in results), 1)
+               for key in ('import_ms', 'ttfb_ms', 'first_page_ms', 'second_page_ms')}
+    summary['loaded'] = results[-1]['loaded']
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='server starts to take the median of')
+    parser.add_argument('--files', type=int, default=0, help='files to put in the share')
+    parser.add_argument('--server', choices=('dev', 'asgi'), default='dev')
+    parser.add_argument('--launch', choices=('script', 'module'), default='script',
+                        help='start the server as python file.py or python -m file')
+    parser.add_argument('--ref', help='also benchmark file.py from this git revision')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    sources = {'working tree': os.path.join(REPO, 'file.py')}
+    tmp = None
+    if args.ref:
+        tmp = tempfile.mkdtemp(prefix='bench_ref_')
+        ref_source = os.path.join(tmp, 'file.py')
+        with open(ref_source, 'wb') as f:
+            f.write(subprocess.check_output(['git', 'show', f'{args.ref}:file.py'], cwd=REPO))
+        sources = {args.ref: ref_source, **sources}
+
+    try:
+        results = {label: run(source, args) for label, source in sources.items()}
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{"version":<16}{"import ms":>11}{"TTFB ms":>10}{"1st page":>10}{"2nd page":>10}  heavy modules loaded')
+    for label, r in results.items():
+        print(f'{label:<16}{r["import_ms"]:>11}{r["ttfb_ms"]:>10}{r["first_page_ms"]:>10}'
+              f'{r["second_page_ms"]:>10}  {", ".join(r["loaded"]) or "-"}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""Benchmark suite for the upload, download, list and preview routes
+
+Generates a synthetic share (many small files, a few huge ones and a set of
+photos), starts file.py on it and drives each route at a fixed concurrency.
+For every route it reports p50/p90/p99 latency, requests/s, MB/s, server
+CPU seconds and resident memory. Results are written as JSON so runs can be
+compared over time, e.g.
+
+    python benchmarks/bench_suite.py --output before.json
+    pip install -U flask werkzeug
+    python benchmarks/bench_suite.py --output after.json --compare before.json
+
+Use --server asgi or --server gunicorn (if installed) to benchmark the other
+servers, and --routes to run a subset.
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from importlib import metadata
+
+from bench_download import free_port, process_cpu_seconds
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUTES = ('files', 'download_small', 'download_huge', 'preview_cold', 'preview',
+          'upload', 'upload_batch')
+
+def process_rss_mb(pid):
+    """Resident memory of a process and its children in MB, from /proc (Linux only)"""
+    parents = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/status') as f:
+                fields = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            continue
+        parents[int(entry)] = int(fields['PPid'])
+        rss[int(entry)] = int(fields.get('VmRSS', '0 kB').split()[0])
+    if pid not in rss:
+        return None
+    tree = {pid}
+    changed = True
+    while changed:
+        changed = False
+        for child, parent in parents.items():
+            if parent in tree and child not in tree:
+                tree.add(child)
+                changed = True
+    return round(sum(rss[p] for p in tree) / 1024, 1)
+
+def generate_tree(shared, args):
+    """Write the synthetic share; returns the names of each kind of file"""
+    from PIL import Image
+    tree = {'small': [], 'huge': [], 'images': []}
+    for i in range(args.small_files):
+        name = f'small_{i:05d}.txt'
+        with open(os.path.join(shared, name), 'wb') as f:
+            f.write(os.urandom(args.small_kb * 512).hex().encode())
+        tree['small'].append(name)
+    block = os.urandom(1024 * 1024)
+    for i in range(args.huge_files):
+        name = f'huge_{i}.bin'
+        with open(os.path.join(shared, name), 'wb') as f:
+            for _ in range(args.huge_mb):
+                f.write(block)
+        tree['huge'].append(name)
+    for i in range(args.images):
+        name = f'photo_{i:03d}.jpg'
+        img = Image.radial_gradient('L').resize((2000, 1500)).convert('RGB')
+        img = Image.blend(img, Image.effect_noise((2000, 1500), 40).convert('RGB'), 0.3)
+        img.save(os.path.join(shared, name), quality=90)
+        tree['images'].append(name)
+    return tree
+
+def start_server(workdir, server, port, threads):
+    shutil.copy(os.path.join(REPO, 'file.py'), os.path.join(workdir, 'file.py'))
+    if server == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', '-w', '1', '--threads', str(threads),
+               '-b', f'127.0.0.1:{port}', 'file:app']
+    else:
+        cmd = [sys.executable, 'file.py', '--server', server, '--host', '127.0.0.1',
+               '--port', str(port)]
+    proc = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/files?limit=1')
+            conn.getresponse().read()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f'server did not start: {" ".join(cmd)}')
+
+def multipart(field, files):
+    """Encode (filename, bytes) pairs as a multipart/form-data body"""
+    boundary = f'bench{random.getrandbits(64):x}'
+    body = io.BytesIO()
+    for filename, data in files:
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+                   f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+        body.write(data)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+def make_requests(route, tree, args):
+    """List of (method, path, body, headers) for one route"""
+    rng = random.Random(route)
+    small_body = lambda: os.urandom(args.small_kb * 512).hex().encode()
+    if route == 'files':
+        return [('GET', f'/files?limit=100&sort={rng.choice(["name", "size", "mtime"])}'
+                        f'&order={rng.choice(["asc", "desc"])}', None, {})
+                for _ in range(args.requests)]
+    if route == 'download_small':
+        return [('GET', f'/download/{rng.choice(tree["small"])}', None, {})
+                for _ in range(args.requests)]
+    if route == 'download_huge':
+        return [('GET', f'/download/{name}', None, {})
+                for name in (tree['huge'] * args.huge_requests)[:max(args.huge_requests, 1)]]
+    if route == 'preview_cold':
+        return [('GET', f'/preview/{name}?size=160', None, {}) for name in tree['images']]
+    if route == 'preview':
+        return [('GET', f'/preview/{rng.choice(tree["images"])}?size=160', None, {})
+                for _ in range(args.requests)]
+    if route == 'upload':
+        requests = []
+        for i in range(args.requests):
+            body, content_type = multipart('file', [(f'upload_{i}.txt', small_body())])
+            requests.append(('POST', '/upload', body, {'Content-Type': content_type}))
+        return requests
+    if route == 'upload_batch':
+        requests = []
+        for i in range(max(args.requests // 10, 1)):
+            body, content_type = multipart('files', [(f'batch_{i}_{j}.txt', small_body())
+                                                     for j in range(10)])
+            requests.append(('POST', '/upload/batch', body, {'Content-Type': content_type}))
+        return requests
+    raise ValueError(route)
+
+def run_route(port, pid, requests, concurrency):
+    lock = threading.Lock()
+    pending = list(reversed(requests))
+    latencies = []
+    errors = {}
+    received = [0]
+    sent = [0]
+    buf = bytearray(1024 * 1024)
+
+    def worker():
+        view = memoryview(bytearray(len(buf)))
+        while True:
+            with lock:
+                if not pending:
+                    return
+                method, path, body, headers = pending.pop()
+            started = time.perf_counter()
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                n = 0
+                while True:
+                    chunk = resp.readinto(view)
+                    if not chunk:
+                        break
+                    n += chunk
+                conn.close()
+                status = resp.status
+            except OSError as e:
+                status, n = type(e).__name__, 0
+            elapsed = time.perf_counter() - started
+            with lock:
+                if status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+                received[0] += n
+                sent[0] += len(body or b'')
+
+    cpu_before = process_cpu_seconds(pid)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    cpu_after = process_cpu_seconds(pid)
+
+    latencies.sort()
+    pct = lambda p: round(latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] * 1000, 2) \
+        if latencies else None
+    return {
+        'requests': len(requests),
+        'errors': errors,
+        'p50_ms': pct(50),
+        'p90_ms': pct(90),
+        'p99_ms': pct(99),
+        'req_per_s': round(len(latencies) / elapsed, 1),
+        'mb_per_s': round((received[0] + sent[0]) / 1024 ** 2 / elapsed, 2),
+        'server_cpu_s': None if cpu_before is None or cpu_after is None else round(cpu_after - cpu_before, 3),
+        'server_rss_mb': process_rss_mb(pid),
+    }
+
+def git_revision():
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, text=True).strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', 'file.py'], cwd=REPO).returncode
+        return rev + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def version(package):
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+def print_table(results, baseline=None):
+    print(f'{"route":<16}{"p50 ms":>9}{"p99 ms":>9}{"req/s":>9}{"MB/s":>9}{"CPU s":>8}{"RSS MB":>8}  errors')
+    for route, r in results['routes'].items():
+        print(f'{route:<16}{str(r["p50_ms"]):>9}{str(r["p99_ms"]):>9}{r["req_per_s"]:>9}'
+              f'{r["mb_per_s"]:>9}{str(r["server_cpu_s"]):>8}{str(r["server_rss_mb"]):>8}  '
+              f'{r["errors"] or ""}')
+        old = (baseline or {}).get('routes', {}).get(route)
+        if old:
+            deltas = []
+            for key in ('p50_ms', 'p99_ms', 'req_per_s', 'mb_per_s'):
+                if old.get(key) and r.get(key) is not None:
+                    deltas.append(f'{key} {(r[key] - old[key]) / old[key] * 100:+.1f}%')
+            print(f'{"":<16}vs baseline: {", ".join(deltas)}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=('dev', 'asgi', 'gunicorn'), default='dev')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='comma-separated subset of: '
+                        + ', '.join(ROUTES))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--small-files', type=int, default=2000)
+    parser.add_argument('--small-kb', type=int, default=8, help='size of each small file')
+    parser.add_argument('--huge-files', type=int, default=2)
+    parser.add_argument('--huge-mb', type=int, default=256)
+    parser.add_argument('--huge-requests', type=int, default=8, help='downloads of the huge files')
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    routes = [r.strip() for r in args.routes.split(',') if r.strip()]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error(f'unknown routes: {", ".join(sorted(unknown))}')
+
+    workdir = tempfile.mkdtemp(prefix='bench_suite_')
+    try:
+        shared = os.path.join(workdir, 'shared_files')
+        os.makedirs(shared)
+        tree = generate_tree(shared, args)
+        port = free_port()
+        proc = start_server(workdir, args.server, port, args.concurrency)
+        try:
+            results = {
+                'meta': {
+                    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                    'git_revision': git_revision(),
+                    'server': args.server,
+                    'python': platform.python_version(),
+                    'flask': version('flask'),
+                    'werkzeug': version('werkzeug'),
+                    'platform': platform.platform(),
+                    'cpus': os.cpu_count(),
+                    'args': vars(args),
+                },
+                'routes': {},
+            }
+            for route in routes:
+                results['routes'][route] = run_route(port, proc.pid, make_requests(route, tree, args),
+                                                     args.concurrency)
+        finally:
+            proc.terminate()
+            proc.wait()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Delta sync benchmark for /sync
+
+Shares a generated file, edits a local copy in a few typical ways
+(overwriting bytes in place, inserting, deleting, appending) and pushes each
+edit with file.py --sync. Reports the bytes sent against the file size and
+the time taken, e.g.
+
+    python benchmarks/bench_sync.py --size-mb 1024
+
+Each edit should cost roughly its own size plus a few KB of op headers,
+not the whole file.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from bench_download import free_port
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def write_random(path, size_mb):
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        for i in range(size_mb):
+            # Vary each megabyte so blocks don't all look alike
+            f.write(i.to_bytes(8, 'big') + block[8:])
+
+def splice(path, offset, remove, insert):
+    """Replace `remove` bytes at offset with `insert`, streaming through a temp file"""
+    temp = path + '.edit'
+    with open(path, 'rb') as src, open(temp, 'wb') as dst:
+        remaining = offset
+        while remaining:
+            data = src.read(min(remaining, 1024 * 1024))
+            dst.write(data)
+            remaining -= len(data)
+        src.seek(remove, os.SEEK_CUR)
+        dst.write(insert)
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(temp, path)
+
+EDITS = {
+    'unchanged': lambda path, size: None,
+    'overwrite_4k': lambda path, size: splice(path, size // 3, 4096, os.urandom(4096)),
+    'insert_10k': lambda path, size: splice(path, size // 2, 0, os.urandom(10 * 1024)),
+    'delete_1m': lambda path, size: splice(path, size // 4, 1024 * 1024, b''),
+    'append_1m': lambda path, size: splice(path, os.path.getsize(path), 0, os.urandom(1024 * 1024)),
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256, help='size of the synced file')
+    parser.add_argument('--server', choices=('dev', 'asgi'), default='dev')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_sync_')
+    try:
+        shared = os.path.join(workdir, 'shared_files')
+        os.makedirs(shared)
+        local = os.path.join(workdir, 'image.bin')
+        write_random(local, args.size_mb)
+        shutil.copy(local, os.path.join(shared, 'image.bin'))
+        shutil.copy(os.path.join(REPO, 'file.py'), os.path.join(workdir, 'file.py'))
+
+        port = free_port()
+        proc = subprocess.Popen([sys.executable, 'file.py', '--server', args.server, '--host', '127.0.0.1',
+                                 '--port', str(port)], cwd=workdir,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            deadline = time.time() + 30
+            while True:
+                try:
+                    urllib.request.urlopen(f'http://127.0.0.1:{port}/files', timeout=1).read()
+                    break
+                except OSError:
+                    if time.time() > deadline:
+                        raise RuntimeError('server did not start')
+                    time.sleep(0.2)
+
+            results = {}
+            for edit, apply in EDITS.items():
+                apply(local, os.path.getsize(local))
+                started = time.perf_counter()
+                output = subprocess.check_output(
+                    [sys.executable, os.path.join(REPO, 'file.py'), '--sync', local,
+                     f'http://127.0.0.1:{port}'], text=True)
+                elapsed = time.perf_counter() - started
+                sent = int(output.split(' sent ')[1].split()[0])
+                size = os.path.getsize(local)
+                results[edit] = {
+                    'size': size,
+                    'sent_bytes': sent,
+                    'sent_pct': round(sent / size * 100, 4),
+                    'seconds': round(elapsed, 2),
+                }
+        finally:
+            proc.terminate()
+            proc.wait()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{"edit":<14}{"sent bytes":>14}{"% of file":>12}{"seconds":>10}')
+    for edit, r in results.items():
+        print(f'{edit:<14}{r["sent_bytes"]:>14}{r["sent_pct"]:>12}{r["seconds"]:>10}')
+
+if __name__ == '__main__':
+    main()
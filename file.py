@@ -1,17 +1,152 @@
 import os
+import re
+import io
+import sys
+import json
+import base64
+import hashlib
+import bisect
+import math
+import time
 import socket
-import qrcode
-from flask import Flask, render_template_string, request, send_file, jsonify
+import stat
+import errno
+import struct
+import queue
+import zlib
+import sqlite3
+import collections
+import http.client
+import urllib.parse
+import shutil
+import zipfile
+import secrets
+import threading
+import random
+import argparse
+import ctypes
+import ctypes.util
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, render_template_string, request, jsonify, redirect
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file, FileWrapper
+from werkzeug.http import is_resource_modified
+from werkzeug.exceptions import HTTPException
 import mimetypes
 
-app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max file size
-app.config['UPLOAD_FOLDER'] = 'shared_files'
+class LazyModule:
+    """Stand-in for a module that is imported on first attribute access
+
+    importlib's LazyLoader isn't thread-safe before Python 3.12: threads
+    touching a module at the same time can find it half-loaded. The import
+    here is a plain one, done once under a lock.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+                module = self._module
+        return getattr(module, attr)
+
+def lazy_import(name):
+    """Import a module on first attribute access, or return None if it isn't installed
+
+    Keeps Pillow, asyncio and the optional compressors out of startup; a
+    server started on demand often never needs them.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except ImportError:
+        spec = None
+    if spec is None:
+        return None
+    return LazyModule(name)
+
+asyncio = lazy_import('asyncio')
+tarfile = lazy_import('tarfile')
+cProfile = lazy_import('cProfile')
+zstandard = lazy_import('zstandard')
+brotli = lazy_import('brotli')
+Image = lazy_import('PIL.Image')
+ImageOps = lazy_import('PIL.ImageOps')
+ExifTags = lazy_import('PIL.ExifTags')
+features = lazy_import('PIL.features')
 
-# Create upload folder if it doesn't exist
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
+app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max size per request
+app.config['UPLOAD_FOLDER'] = os.path.abspath('shared_files')
+# Chunked upload sessions live in a hidden folder inside UPLOAD_FOLDER so the
+# finished file can be renamed into place without copying it
+app.config['UPLOAD_SESSION_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.uploads')
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024  # 8MB default chunk size
+app.config['UPLOAD_MAX_CHUNK_SIZE'] = 64 * 1024 * 1024
+app.config['UPLOAD_PARALLEL_STREAMS'] = 4  # concurrent chunk PUTs per browser
+# Deduplicated file contents, one blob per content hash; shared files are hard
+# links to these
+app.config['BLOB_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.blobs')
+app.config['HASH_BLOCK_SIZE'] = 4 * 1024 * 1024  # chunk sizes must be a multiple of this
+app.config['BLOB_GC_INTERVAL'] = 600  # seconds between sweeps for unreferenced blobs
+app.config['CATALOG_POLL_INTERVAL'] = 2  # seconds, used when inotify is unavailable
+app.config['CATALOG_RESCAN_INTERVAL'] = 300  # seconds between full consistency rescans
+app.config['EVENTS_HISTORY'] = 1000  # deltas kept for clients reconnecting with Last-Event-ID
+app.config['EVENTS_KEEPALIVE'] = 15  # seconds between SSE keep-alive comments
+app.config['THUMBNAIL_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.thumbs')
+app.config['THUMBNAIL_SIZES'] = (80, 160, 320)  # longest edge in pixels
+app.config['THUMBNAIL_CACHE_BYTES'] = 256 * 1024 * 1024
+app.config['THUMBNAIL_WORKERS'] = 2
+app.config['THUMBNAIL_WAIT'] = 10  # seconds /preview waits for a missing thumbnail
+app.config['SEND_BLOCK_SIZE'] = 256 * 1024  # read size when a file can't be sent zero-copy
+app.config['MAX_RANGES'] = 32  # more ranges than this in one request get the whole file
+app.config['SYNC_MIN_BLOCK'] = 2 * 1024  # bounds for the /sync block size, which follows sqrt(size)
+app.config['SYNC_MAX_BLOCK'] = 128 * 1024
+app.config['SYNC_MAX_SCAN'] = 8 * 1024 * 1024  # bytes of rolling search after a miss before probing sparsely
+app.config['SYNC_SIGNATURE_CACHE'] = 8  # block signatures kept in memory
+app.config['COMPRESSED_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.compressed')
+app.config['COMPRESS_MIN_SIZE'] = 1024  # smaller text files are always sent as-is
+app.config['COMPRESS_WORKERS'] = 1  # threads building precompressed variants after upload
+app.config['POSTPROCESS_WORKERS'] = 2  # threads running post-upload work (catalog, thumbnails, ...)
+app.config['POSTPROCESS_QUEUE'] = 64  # queued uploads before new ones are refused with 503
+app.config['STATE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], '.state')
+app.config['STORAGE_QUOTA_BYTES'] = None  # total size of shared files; None for no limit
+app.config['CLIENT_QUOTA_BYTES'] = None  # size of the files each device has uploaded; None for no limit
+app.config['STORAGE_MIN_FREE_BYTES'] = 256 * 1024 * 1024  # uploads are refused rather than fill the disk
+app.config['RETENTION_MAX_AGE'] = None  # seconds after upload before a file is deleted; None keeps it
+app.config['RETENTION_MAX_IDLE'] = None  # seconds without a download before a file is deleted
+app.config['RETENTION_EVICT_LRU'] = False  # over quota, delete the least recently downloaded files
+app.config['RETENTION_SWEEP_INTERVAL'] = 300  # seconds between retention sweeps
+app.config['UPLOAD_SESSION_MAX_IDLE'] = 7 * 24 * 3600  # unfinished uploads untouched this long are dropped
+app.config['SCRUB_RATE'] = 8 * 1024 * 1024  # bytes/s the integrity scrubber reads at; 0 disables it
+app.config['SCRUB_INTERVAL'] = 7 * 24 * 3600  # seconds between passes re-verifying every file
+app.config['SEARCH_TEXT_BYTES'] = 1024 * 1024  # leading bytes of each text file indexed for /search
+app.config['RATE_LIMIT'] = None  # bytes/s for all transfers in each direction; None for no limit
+app.config['CLIENT_RATE_LIMIT'] = None  # bytes/s for each device in each direction; None for no limit
+app.config['SHAPER_PRIORITY_BYTES'] = 1024 * 1024  # smaller bodies, and previews, are never held back
+app.config['SHAPER_BLOCK_SIZE'] = 64 * 1024  # pacing granularity of rate-limited transfers
+app.config['SHAPER_INTERVAL'] = 1.0  # seconds between fair share recalculations
+app.config['PROFILE_SAMPLE_RATE'] = 0  # fraction of requests run under cProfile; 0 disables
+app.config['PROFILE_SLOW_SECONDS'] = 1.0  # profiled requests slower than this are dumped
+app.config['PROFILE_FOLDER'] = os.path.abspath('profiles')
+app.config['PORT'] = 5000  # advertised in the page and QR code; set from --port
+app.config['NETWORK_POLL_INTERVAL'] = 30  # seconds between address checks without netlink
+app.config['ASGI_MAX_CONNECTIONS'] = 1000  # open HTTP requests before the ASGI server answers 503
+app.config['ASGI_IO_THREADS'] = 32  # threads for blocking file I/O in the ASGI server
+app.config['ASGI_WSGI_THREADS'] = 16  # threads running Flask routes the ASGI server doesn't handle itself
+app.config['NODE_NAME'] = socket.gethostname()  # shown next to this node's files on its peers
+app.config['PEER_REFRESH_INTERVAL'] = 10  # seconds between polls of each peer's file list
+app.config['PEER_STALE_AFTER'] = 60  # seconds without a successful poll before a peer's files are hidden
+app.config['PEER_TIMEOUT'] = 3  # seconds to wait for a peer before giving up on a request
+app.config['PEER_REDIRECT'] = False  # send clients to the peer for remote files instead of proxying
 
 # HTML template for the web interface
 HTML_TEMPLATE = '''
@@ -67,6 +202,55 @@ HTML_TEMPLATE = '''
         .file-list {
             margin-top: 30px;
         }
+        .file-controls {
+            display: flex;
+            flex-wrap: wrap;
+            gap: 10px;
+            margin-bottom: 10px;
+        }
+        .file-controls input, .file-controls select {
+            padding: 8px;
+            border: 1px solid #ddd;
+            border-radius: 5px;
+            font-size: 14px;
+        }
+        .file-controls input {
+            flex: 1;
+        }
+        .file-count {
+            color: #666;
+            font-size: 14px;
+        }
+        .breadcrumb {
+            margin-bottom: 10px;
+            font-size: 14px;
+        }
+        .breadcrumb a {
+            color: #4CAF50;
+            cursor: pointer;
+        }
+        .archive-actions {
+            display: flex;
+            gap: 10px;
+            margin-bottom: 10px;
+        }
+        .btn:disabled {
+            background: #aaa;
+            cursor: default;
+        }
+        .virtual-list {
+            position: relative;
+            height: 60vh;
+            overflow-y: auto;
+        }
+        .virtual-list .file-item {
+            position: absolute;
+            left: 0;
+            right: 0;
+            height: 80px;
+            min-height: 0;
+            margin: 0;
+        }
         .file-item {
             display: flex;
             justify-content: space-between;
@@ -108,6 +292,11 @@ HTML_TEMPLATE = '''
             word-break: break-word;
             font-size: 14px;
         }
+        .file-node {
+            display: block;
+            color: #888;
+            font-size: 12px;
+        }
         .qr-code {
             text-align: center;
             margin: 20px 0;
@@ -151,7 +340,7 @@ HTML_TEMPLATE = '''
         
         <div class="qr-code">
             <h3>Scan QR Code to Connect</h3>
-            <img src="/qrcode" alt="QR Code">
+            <img src="/qrcode?v={{ qr_version }}" alt="QR Code">
         </div>
         
         <div class="upload-area" id="uploadArea">
@@ -161,9 +350,13 @@ HTML_TEMPLATE = '''
                 🖼️ Images and documents supported
             </p>
             <input type="file" id="fileInput" multiple>
+            <input type="file" id="folderInput" webkitdirectory multiple>
             <button class="btn" onclick="document.getElementById('fileInput').click()">
                 Choose Files
             </button>
+            <button class="btn" onclick="document.getElementById('folderInput').click()">
+                Choose Folder
+            </button>
         </div>
         
         <div id="progress">
@@ -175,7 +368,41 @@ HTML_TEMPLATE = '''
         
         <div class="file-list">
             <h2>Shared Files</h2>
-            <div id="fileList"></div>
+            <div class="file-controls">
+                <input type="search" id="searchQuery" placeholder="Search names, text, camera...">
+                <input type="search" id="filterPrefix" placeholder="Filter by name...">
+                <select id="filterType">
+                    <option value="">All types</option>
+                    <option value="image">Images</option>
+                    <option value="video">Videos</option>
+                    <option value="audio">Audio</option>
+                    <option value="document">Documents</option>
+                    <option value="archive">Archives</option>
+                    <option value="other">Other</option>
+                </select>
+                <select id="sortBy">
+                    <option value="name">Name</option>
+                    <option value="size">Size</option>
+                    <option value="mtime">Date</option>
+                </select>
+                <select id="sortOrder">
+                    <option value="asc">Ascending</option>
+                    <option value="desc">Descending</option>
+                </select>
+            </div>
+            <div class="breadcrumb" id="breadcrumb"></div>
+            <p class="file-count" id="fileCount"></p>
+            <div class="archive-actions">
+                <button class="btn" id="downloadSelected" onclick="downloadArchive(Array.from(selectedFiles))" disabled>
+                    Download selected (ZIP)
+                </button>
+                <button class="btn" onclick="downloadArchive([])">
+                    Download all (ZIP)
+                </button>
+            </div>
+            <div id="fileList" class="virtual-list">
+                <div id="fileListSpacer"></div>
+            </div>
         </div>
     </div>
 
@@ -206,6 +433,11 @@ HTML_TEMPLATE = '''
             handleFiles(e.target.files);
         });
         
+        document.getElementById('folderInput').addEventListener('change', (e) => {
+            handleFiles(e.target.files);
+            e.target.value = '';
+        });
+        
         function handleFiles(files) {
             console.log(`handleFiles called with ${files.length} files:`);
             for (let i = 0; i < files.length; i++) {
@@ -219,108 +451,290 @@ HTML_TEMPLATE = '''
             
             // Show user which files were selected
             let fileNames = Array.from(files).map(f => f.name).join(', ');
-            if (files.length > 1) {
-                alert(`Selected ${files.length} files: ${fileNames}\nUploading in batch mode...`);
-                uploadFilesBatch(files);
-            } else {
-                alert(`Selected 1 file: ${fileNames}\nUploading in single mode...`);
-                uploadFile(files[0]);
-            }
+            alert(`Selected ${files.length} file(s): ${fileNames}\nUploading in resumable chunks...`);
+            uploadFiles(Array.from(files));
         }
         
-        function uploadFilesBatch(files) {
-            const formData = new FormData();
-            
-            // Append all files to the form data
-            for (let file of files) {
-                formData.append('files', file);
-            }
-            
+        const CHUNK_SIZE = {{ chunk_size }};
+        const PARALLEL_STREAMS = {{ parallel_streams }};
+        const HASH_BLOCK_SIZE = {{ hash_block_size }};
+        const MAX_RETRIES = 5;
+        
+        // The folder being shown; uploads go into it, keeping the relative
+        // paths of a chosen folder
+        let currentFolder = decodeURIComponent(location.hash.slice(1));
+        
+        function uploadName(file) {
+            const name = file.webkitRelativePath || file.name;
+            return currentFolder ? `${currentFolder}/${name}` : name;
+        }
+        
+        async function uploadFiles(files) {
             const progress = document.getElementById('progress');
             const progressFill = document.getElementById('progressFill');
             const progressText = document.getElementById('progressText');
             
             progress.style.display = 'block';
-            progressText.textContent = `Uploading ${files.length} files...`;
             
-            const xhr = new XMLHttpRequest();
+            const stats = {
+                total: files.reduce((n, f) => n + f.size, 0) || 1,
+                done: 0,
+                resumed: 0,
+                inflight: new Map(),
+                started: performance.now()
+            };
+            const response = {uploaded_files: [], errors: []};
             
-            xhr.upload.addEventListener('progress', (e) => {
-                if (e.lengthComputable) {
-                    const percentComplete = (e.loaded / e.total) * 100;
-                    progressFill.style.width = percentComplete + '%';
-                    progressText.textContent = `Uploading ${files.length} files: ${Math.round(percentComplete)}%`;
+            const updateProgress = () => {
+                let sent = stats.done;
+                stats.inflight.forEach(loaded => sent += loaded);
+                const seconds = (performance.now() - stats.started) / 1000;
+                const rate = seconds > 0 ? (sent - stats.resumed) / seconds : 0;
+                const percentComplete = (sent / stats.total) * 100;
+                progressFill.style.width = percentComplete + '%';
+                progressText.textContent = `Uploading ${files.length} file(s): ${Math.round(percentComplete)}% ` +
+                    `(${formatRate(rate)}, ${stats.inflight.size} streams)`;
+            };
+            
+            // All workers pull from one shared queue of chunks, so small files
+            // and the chunks of large files are spread over the same streams
+            const tasks = chunkTasks(files, stats, response);
+            const worker = async () => {
+                for await (const task of tasks) {
+                    await uploadTask(task, stats, response, updateProgress);
                 }
-            });
+            };
+            const workers = [];
+            for (let i = 0; i < PARALLEL_STREAMS; i++) {
+                workers.push(worker());
+            }
+            await Promise.all(workers);
+            
+            progress.style.display = 'none';
+            progressFill.style.width = '0%';
             
-            xhr.addEventListener('load', () => {
-                progress.style.display = 'none';
-                progressFill.style.width = '0%';
+            response.total_uploaded = response.uploaded_files.length;
+            response.total_errors = response.errors.length;
+            showUploadResults(response);
+            loadFiles();
+        }
+        
+        function formatRate(bytesPerSecond) {
+            if (bytesPerSecond >= 1024 * 1024) {
+                return (bytesPerSecond / (1024 * 1024)).toFixed(1) + ' MB/s';
+            }
+            return (bytesPerSecond / 1024).toFixed(0) + ' KB/s';
+        }
+        
+        async function* chunkTasks(files, stats, response) {
+            for (const file of files) {
+                try {
+                    const known = await uploadIfKnown(file);
+                    if (known) {
+                        response.uploaded_files.push(...known.uploaded_files);
+                        stats.done += file.size;
+                        stats.resumed += file.size;
+                        continue;
+                    }
+                } catch (err) {
+                    // Fall back to sending the bytes
+                }
                 
-                if (xhr.status === 200) {
-                    const response = JSON.parse(xhr.responseText);
-                    showUploadResults(response);
-                } else {
-                    alert('Upload failed!');
+                let session;
+                try {
+                    session = await getUploadSession(file);
+                } catch (err) {
+                    response.errors.push({filename: file.name, error: err.message});
+                    continue;
                 }
                 
-                loadFiles();
-            });
+                const upload = {file, session, remaining: session.missing_chunks.length, failed: false};
+                const received = file.size - session.missing_chunks.reduce(
+                    (n, index) => n + chunkSize(session, index), 0);
+                stats.done += received;
+                stats.resumed += received;
+                
+                if (upload.remaining === 0) {
+                    await completeUpload(upload, response);
+                    continue;
+                }
+                for (const index of session.missing_chunks) {
+                    yield {upload, index};
+                }
+            }
+        }
+        
+        async function uploadTask(task, stats, response, updateProgress) {
+            const {upload, index} = task;
+            if (upload.failed) {
+                return;
+            }
+            const key = `${upload.session.session_id}:${index}`;
+            try {
+                await putChunkWithRetry(upload.session, upload.file, index, (loaded) => {
+                    stats.inflight.set(key, loaded);
+                    updateProgress();
+                });
+                stats.done += chunkSize(upload.session, index);
+            } catch (err) {
+                upload.failed = true;
+                response.errors.push({filename: upload.file.name, error: err.message});
+            } finally {
+                stats.inflight.delete(key);
+                updateProgress();
+            }
             
-            xhr.addEventListener('error', () => {
-                progress.style.display = 'none';
-                progressFill.style.width = '0%';
-                alert('Upload failed due to network error!');
+            upload.remaining--;
+            if (upload.remaining === 0 && !upload.failed) {
+                await completeUpload(upload, response);
+            }
+        }
+        
+        function chunkSize(session, index) {
+            const start = index * session.chunk_size;
+            return Math.max(0, Math.min(session.chunk_size, session.size - start));
+        }
+        
+        async function contentHash(file) {
+            // Same scheme as the server: SHA-256 over the SHA-256 of each block.
+            // crypto.subtle only exists in secure contexts (https or localhost).
+            if (!(window.crypto && crypto.subtle)) {
+                return null;
+            }
+            const digests = new Uint8Array(Math.ceil(file.size / HASH_BLOCK_SIZE) * 32);
+            for (let i = 0, start = 0; start < file.size; i++, start += HASH_BLOCK_SIZE) {
+                const block = await file.slice(start, start + HASH_BLOCK_SIZE).arrayBuffer();
+                digests.set(new Uint8Array(await crypto.subtle.digest('SHA-256', block)), i * 32);
+            }
+            const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', digests));
+            return Array.from(digest, b => b.toString(16).padStart(2, '0')).join('');
+        }
+        
+        // Content hashes computed for the dedup check, sent again with the
+        // upload so the server can tell if the bytes it got are the ones sent
+        const fileHashes = new WeakMap();
+        
+        async function uploadIfKnown(file) {
+            // Ask the server whether it already stores this content, in which
+            // case the upload finishes without sending the bytes
+            if (localStorage.getItem(sessionKey(file))) {
+                return null;
+            }
+            const hash = await contentHash(file);
+            if (!hash) {
+                return null;
+            }
+            fileHashes.set(file, hash);
+            const res = await fetchUnlessBusy('/upload/check', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({filename: uploadName(file), size: file.size, content_hash: hash})
             });
-            
-            xhr.open('POST', '/upload/batch');
-            xhr.send(formData);
+            return res.ok ? res.json() : null;
         }
         
-        function uploadFile(file) {
-            const formData = new FormData();
-            formData.append('file', file);
-            
-            const progress = document.getElementById('progress');
-            const progressFill = document.getElementById('progressFill');
-            const progressText = document.getElementById('progressText');
-            
-            progress.style.display = 'block';
-            
-            const xhr = new XMLHttpRequest();
-            
-            xhr.upload.addEventListener('progress', (e) => {
-                if (e.lengthComputable) {
-                    const percentComplete = (e.loaded / e.total) * 100;
-                    progressFill.style.width = percentComplete + '%';
-                    progressText.textContent = `Uploading ${file.name}: ${Math.round(percentComplete)}%`;
+        function sessionKey(file) {
+            return `upload:${uploadName(file)}:${file.size}:${file.lastModified}`;
+        }
+        
+        async function fetchUnlessBusy(url, options) {
+            // The server answers 503 with Retry-After while it is still
+            // processing earlier uploads; wait as told and try again
+            for (let attempt = 1; ; attempt++) {
+                const res = await fetch(url, options);
+                if (res.status !== 503 || attempt >= MAX_RETRIES) {
+                    return res;
+                }
+                const wait = parseInt(res.headers.get('Retry-After'), 10) || attempt;
+                await new Promise(r => setTimeout(r, wait * 1000));
+            }
+        }
+        
+        async function getUploadSession(file) {
+            // Resume an interrupted upload of the same file if the server still has it
+            const savedId = localStorage.getItem(sessionKey(file));
+            if (savedId) {
+                const res = await fetch(`/upload/sessions/${savedId}`);
+                if (res.ok) {
+                    return res.json();
                 }
+                localStorage.removeItem(sessionKey(file));
+            }
+            
+            const res = await fetchUnlessBusy('/upload/sessions', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({filename: uploadName(file), size: file.size, chunk_size: CHUNK_SIZE,
+                                      content_hash: fileHashes.get(file) || null})
             });
+            const session = await res.json();
+            if (!res.ok) {
+                throw new Error(session.error || 'Could not start upload');
+            }
+            localStorage.setItem(sessionKey(file), session.session_id);
+            return session;
+        }
+        
+        async function chunkDigest(blob) {
+            // Content-Digest of a chunk, so one damaged in transit is refused and sent again
+            if (!(window.crypto && crypto.subtle)) {
+                return null;
+            }
+            const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', await blob.arrayBuffer()));
+            return `sha-256=:${btoa(String.fromCharCode(...digest))}:`;
+        }
+        
+        async function putChunk(session, file, index, onProgress) {
+            const start = index * session.chunk_size;
+            const blob = file.slice(start, Math.min(start + session.chunk_size, file.size));
+            const digest = await chunkDigest(blob);
             
-            xhr.addEventListener('load', () => {
-                progress.style.display = 'none';
-                progressFill.style.width = '0%';
-                
-                if (xhr.status === 200) {
-                    const response = JSON.parse(xhr.responseText);
-                    if (response.uploaded_files && response.uploaded_files.length > 0) {
-                        showUploadResults(response);
+            return new Promise((resolve, reject) => {
+                const xhr = new XMLHttpRequest();
+                xhr.upload.addEventListener('progress', (e) => onProgress(e.loaded));
+                xhr.addEventListener('load', () => {
+                    if (xhr.status === 200) {
+                        resolve(blob.size);
+                    } else {
+                        reject(new Error(`Chunk ${index} failed with status ${xhr.status}`));
                     }
-                } else {
-                    alert('Upload failed!');
+                });
+                xhr.addEventListener('error', () => reject(new Error(`Network error on chunk ${index}`)));
+                xhr.open('PUT', `/upload/sessions/${session.session_id}/chunks/${index}`);
+                xhr.setRequestHeader('Content-Type', 'application/octet-stream');
+                if (digest) {
+                    xhr.setRequestHeader('Content-Digest', digest);
                 }
-                
-                loadFiles();
-            });
-            
-            xhr.addEventListener('error', () => {
-                progress.style.display = 'none';
-                progressFill.style.width = '0%';
-                alert('Upload failed due to network error!');
+                xhr.send(blob);
             });
-            
-            xhr.open('POST', '/upload');
-            xhr.send(formData);
+        }
+        
+        async function putChunkWithRetry(session, file, index, onProgress) {
+            for (let attempt = 1; ; attempt++) {
+                try {
+                    return await putChunk(session, file, index, onProgress);
+                } catch (err) {
+                    if (attempt >= MAX_RETRIES) {
+                        throw err;
+                    }
+                    onProgress(0);
+                    await new Promise(r => setTimeout(r, 1000 * attempt));
+                }
+            }
+        }
+        
+        async function completeUpload(upload, response) {
+            try {
+                const res = await fetch(`/upload/sessions/${upload.session.session_id}/complete`, {method: 'POST'});
+                const result = await res.json();
+                if (!res.ok) {
+                    throw new Error(result.error || 'Upload could not be completed');
+                }
+                localStorage.removeItem(sessionKey(upload.file));
+                response.uploaded_files.push(...result.uploaded_files);
+            } catch (err) {
+                response.errors.push({filename: upload.file.name, error: err.message});
+            }
         }
         
         function showUploadResults(response) {
@@ -343,82 +757,605 @@ HTML_TEMPLATE = '''
             alert(message);
         }
         
+        // The file list is virtualized: only the rows in view are in the DOM,
+        // and pages are fetched from /files with a cursor as the user scrolls
+        const PAGE_SIZE = 200;
+        const ROW_HEIGHT = 110;
+        const fileList = document.getElementById('fileList');
+        const fileListSpacer = document.getElementById('fileListSpacer');
+        let listState = null;
+        let renderPending = false;
+        
+        function listQuery() {
+            const params = new URLSearchParams({
+                limit: PAGE_SIZE,
+                sort: document.getElementById('sortBy').value,
+                order: document.getElementById('sortOrder').value
+            });
+            const prefix = document.getElementById('filterPrefix').value.trim();
+            const type = document.getElementById('filterType').value;
+            const search = document.getElementById('searchQuery').value.trim();
+            if (search) {
+                // Search results come from /search, ranked by relevance, across all folders
+                params.set('q', search);
+                params.delete('sort');
+                params.delete('order');
+            } else if (currentFolder) {
+                params.set('dir', currentFolder);
+            }
+            if (prefix) {
+                params.set('prefix', prefix);
+            }
+            if (type) {
+                params.set('type', type);
+            }
+            return params;
+        }
+        
         function loadFiles() {
-            fetch('/files')
+            // Start again from the first page; the rows on screen stay until it arrives
+            const state = {query: listQuery(), files: [], total: 0, cursor: null, done: false, loading: null};
+            fetchPage(state).then(() => {
+                if (listState && listState.query.toString() !== state.query.toString()) {
+                    fileList.scrollTop = 0;
+                }
+                listState = state;
+                renderFiles();
+            });
+        }
+        
+        function fetchPage(state) {
+            if (state.loading) {
+                return state.loading;
+            }
+            const params = new URLSearchParams(state.query);
+            if (params.has('q')) {
+                params.set('offset', state.files.length);
+                state.loading = fetch(`/search?${params}`)
+                    .then(response => response.json())
+                    .then(page => {
+                        state.files.push(...page.results);
+                        state.total = page.total;
+                        state.done = !page.results.length || state.files.length >= page.total;
+                    })
+                    .finally(() => {
+                        state.loading = null;
+                    });
+                return state.loading;
+            }
+            if (state.cursor) {
+                params.set('cursor', state.cursor);
+            }
+            state.loading = fetch(`/files?${params}`)
                 .then(response => response.json())
-                .then(files => {
-                    const fileList = document.getElementById('fileList');
-                    fileList.innerHTML = '';
-                    
-                    if (files.length === 0) {
-                        fileList.innerHTML = '<p>No files shared yet</p>';
-                        return;
+                .then(page => {
+                    state.files.push(...page.files);
+                    state.total = page.total;
+                    state.cursor = page.next_cursor;
+                    state.done = !page.next_cursor;
+                })
+                .finally(() => {
+                    state.loading = null;
+                });
+            return state.loading;
+        }
+        
+        function renderFileItem(file, index) {
+            const fileItem = document.createElement('div');
+            fileItem.className = 'file-item';
+            fileItem.style.top = (index * ROW_HEIGHT) + 'px';
+            
+            if (file.type === 'folder') {
+                return renderFolderItem(file, fileItem);
+            }
+            // Files on other nodes are fetched through this one. Everything
+            // a peer sends is escaped: any device on the LAN can be a peer
+            const base = file.peer ? `/peers/${encodeURIComponent(file.peer)}` : '';
+            let preview = '';
+            if (file.is_image) {
+                const src = escapeHtml(`${base}/preview/${encodePath(file.name)}?v=${encodeURIComponent(file.mtime)}`);
+                preview = `<img src="${src}&amp;size=80" srcset="${src}&amp;size=160 2x" alt="${escapeHtml(file.name)}" class="file-preview" loading="lazy" onerror="this.style.display='none'; this.nextElementSibling.style.display='flex';">`;
+                preview += `<div class="file-icon-large" style="display:none;">${escapeHtml(file.icon)}</div>`;
+            } else {
+                preview = `<div class="file-icon-large">${escapeHtml(file.icon)}</div>`;
+            }
+            
+            fileItem.innerHTML = `
+                <div class="file-info">
+                    <input type="checkbox" class="file-select" ${file.peer ? 'disabled' : (selectedFiles.has(file.name) ? 'checked' : '')}>
+                    ${preview}
+                    <span class="file-name">${escapeHtml(displayName(file))}${file.peer ? `<span class="file-node">on ${escapeHtml(file.node)}</span>` : ''}${file.snippet ? `<span class="file-node">${escapeHtml(file.snippet)}</span>` : ''}</span>
+                </div>
+                <a href="${escapeHtml(`${base}/download/${encodePath(file.name)}`)}" class="btn" download>
+                    Download
+                </a>
+            `;
+            fileItem.querySelector('.file-select').addEventListener('change', (e) => {
+                if (e.target.checked) {
+                    selectedFiles.add(file.name);
+                } else {
+                    selectedFiles.delete(file.name);
+                }
+                updateSelection();
+            });
+            return fileItem;
+        }
+        
+        function renderFolderItem(folder, fileItem) {
+            // Local folders can be selected or downloaded as an archive of
+            // everything below them
+            fileItem.innerHTML = `
+                <div class="file-info">
+                    <input type="checkbox" class="file-select" ${folder.peer ? 'disabled' : (selectedFiles.has(folder.name) ? 'checked' : '')}>
+                    <div class="file-icon-large">${escapeHtml(folder.icon)}</div>
+                    <span class="file-name"><a class="folder-link">${escapeHtml(displayName(folder))}/</a><span class="file-node">${escapeHtml(folder.files)} file(s)${folder.peer ? ` on ${escapeHtml(folder.node)}` : ''}</span></span>
+                </div>
+                <button class="btn" ${folder.peer ? 'disabled' : ''}>Download (ZIP)</button>
+            `;
+            fileItem.querySelector('.folder-link').addEventListener('click', () => openFolder(folder.name));
+            fileItem.querySelector('button').addEventListener('click', () => downloadArchive([folder.name]));
+            fileItem.querySelector('.file-select').addEventListener('change', (e) => {
+                if (e.target.checked) {
+                    selectedFiles.add(folder.name);
+                } else {
+                    selectedFiles.delete(folder.name);
+                }
+                updateSelection();
+            });
+            return fileItem;
+        }
+        
+        function displayName(file) {
+            // Names are shown relative to the folder; search results keep their full path
+            const prefix = currentFolder ? currentFolder + '/' : '';
+            return listState && listState.query.has('q') || !file.name.startsWith(prefix) ?
+                file.name : file.name.slice(prefix.length);
+        }
+        
+        function renderBreadcrumb() {
+            const crumbs = document.getElementById('breadcrumb');
+            crumbs.innerHTML = '';
+            const parts = currentFolder ? currentFolder.split('/') : [];
+            [''].concat(parts).forEach((part, i) => {
+                const link = document.createElement('a');
+                link.textContent = part || 'All files';
+                const path = parts.slice(0, i).join('/');
+                link.addEventListener('click', () => openFolder(path));
+                if (i > 0) {
+                    crumbs.appendChild(document.createTextNode(' / '));
+                }
+                crumbs.appendChild(link);
+            });
+        }
+        
+        function openFolder(path) {
+            // The folder lives in the URL hash so back and reload keep it
+            location.hash = path ? encodeURIComponent(path) : '';
+            if (!path) {
+                showFolder();
+            }
+        }
+        
+        function showFolder() {
+            currentFolder = decodeURIComponent(location.hash.slice(1));
+            renderBreadcrumb();
+            loadFiles();
+        }
+        
+        window.addEventListener('hashchange', showFolder);
+        
+        const selectedFiles = new Set();
+        
+        function updateSelection() {
+            const button = document.getElementById('downloadSelected');
+            button.disabled = selectedFiles.size === 0;
+            button.textContent = selectedFiles.size ?
+                `Download ${selectedFiles.size} selected (ZIP)` : 'Download selected (ZIP)';
+        }
+        
+        function downloadArchive(names) {
+            // A form POST lets the browser stream the archive straight to disk
+            // and keeps long selections out of the URL
+            const form = document.createElement('form');
+            form.method = 'POST';
+            form.action = '/download/archive';
+            names.forEach(name => {
+                const input = document.createElement('input');
+                input.type = 'hidden';
+                input.name = 'files';
+                input.value = name;
+                form.appendChild(input);
+            });
+            document.body.appendChild(form);
+            form.submit();
+            form.remove();
+        }
+        
+        function renderFiles() {
+            const state = listState;
+            if (!state) {
+                return;
+            }
+            fileListSpacer.style.height = (state.total * ROW_HEIGHT) + 'px';
+            document.getElementById('fileCount').textContent =
+                state.total === 0 ? 'No files shared yet' : `${state.total} file(s)`;
+            
+            const first = Math.max(0, Math.floor(fileList.scrollTop / ROW_HEIGHT) - 5);
+            const last = Math.min(state.total,
+                Math.ceil((fileList.scrollTop + fileList.clientHeight) / ROW_HEIGHT) + 5);
+            
+            // Fetch the next page once the visible window runs past what is loaded
+            if (last > state.files.length && !state.done) {
+                fetchPage(state).then(() => {
+                    if (state === listState) {
+                        renderFiles();
                     }
-                    
-                    files.forEach(file => {
-                        const fileItem = document.createElement('div');
-                        fileItem.className = 'file-item';
-                        
-                        let preview = '';
-                        if (file.is_image) {
-                            preview = `<img src="/preview/${file.name}" alt="${file.name}" class="file-preview" onerror="this.style.display='none'; this.nextElementSibling.style.display='flex';">`;
-                            preview += `<div class="file-icon-large" style="display:none;">${file.icon}</div>`;
-                        } else {
-                            preview = `<div class="file-icon-large">${file.icon}</div>`;
-                        }
-                        
-                        fileItem.innerHTML = `
-                            <div class="file-info">
-                                ${preview}
-                                <span class="file-name">${file.name}</span>
-                            </div>
-                            <a href="/download/${file.name}" class="btn" download>
-                                Download
-                            </a>
-                        `;
-                        fileList.appendChild(fileItem);
-                    });
                 });
+            }
+            
+            const rows = document.createDocumentFragment();
+            for (let i = first; i < Math.min(last, state.files.length); i++) {
+                rows.appendChild(renderFileItem(state.files[i], i));
+            }
+            fileList.querySelectorAll('.file-item').forEach(el => el.remove());
+            fileList.appendChild(rows);
+        }
+        
+        function scheduleRender() {
+            if (!renderPending) {
+                renderPending = true;
+                requestAnimationFrame(() => {
+                    renderPending = false;
+                    renderFiles();
+                });
+            }
         }
         
+        fileList.addEventListener('scroll', scheduleRender);
+        
+        let filterTimer = null;
+        document.getElementById('searchQuery').addEventListener('input', () => {
+            clearTimeout(filterTimer);
+            filterTimer = setTimeout(loadFiles, 250);
+        });
+        document.getElementById('filterPrefix').addEventListener('input', () => {
+            clearTimeout(filterTimer);
+            filterTimer = setTimeout(loadFiles, 250);
+        });
+        ['filterType', 'sortBy', 'sortOrder'].forEach(id => {
+            document.getElementById(id).addEventListener('change', loadFiles);
+        });
+        
         // Load files on page load
+        renderBreadcrumb();
         loadFiles();
         
-        // Refresh file list every 5 seconds
-        setInterval(loadFiles, 5000);
+        // Live updates: changes pushed over /events are applied to the loaded
+        // rows in place. Without EventSource, poll /files with If-None-Match.
+        // Same as the server: a peer's file sorts right after a local one of the same name
+        const tieBreak = f => f.peer ? `${f.name}\0${f.peer}` : f.name;
+        const SORT_KEYS = {
+            name: f => [f.name.toLowerCase(), tieBreak(f)],
+            size: f => [f.size, tieBreak(f)],
+            mtime: f => [f.mtime, tieBreak(f)]
+        };
+        
+        function compareFiles(a, b, query) {
+            const key = SORT_KEYS[query.get('sort')];
+            const ka = key(a), kb = key(b);
+            let result = 0;
+            for (let i = 0; i < ka.length && result === 0; i++) {
+                result = ka[i] < kb[i] ? -1 : (ka[i] > kb[i] ? 1 : 0);
+            }
+            return query.get('order') === 'desc' ? -result : result;
+        }
+        
+        function matchesQuery(file, query) {
+            const prefix = (query.get('prefix') || '').toLowerCase();
+            const type = query.get('type');
+            const name = file.name.slice(file.name.lastIndexOf('/') + 1);
+            return name.toLowerCase().startsWith(prefix) && (!type || file.type === type);
+        }
+        
+        function folderOf(name) {
+            return name.slice(0, Math.max(name.lastIndexOf('/'), 0));
+        }
+        
+        function dropFile(state, file) {
+            const index = state.files.findIndex(f => f.name === file.name && !f.peer);
+            if (index >= 0) {
+                state.files.splice(index, 1);
+                state.total--;
+            } else if (!state.done && matchesQuery(file, state.query)) {
+                // It was in a page we haven't fetched yet
+                state.total--;
+            }
+        }
+        
+        function addFile(state, file) {
+            if (!matchesQuery(file, state.query)) {
+                return;
+            }
+            let index = state.files.findIndex(f => compareFiles(file, f, state.query) < 0);
+            if (index < 0) {
+                index = state.files.length;
+            }
+            // Past the loaded pages, the cursor will pick it up when we get there
+            if (index < state.files.length || state.done) {
+                state.files.splice(index, 0, file);
+            }
+            state.total++;
+        }
+        
+        function escapeHtml(text) {
+            // Quotes too, as some values go into attributes
+            const entities = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'};
+            return String(text).replace(/[&<>"']/g, c => entities[c]);
+        }
+        
+        function encodePath(name) {
+            // A shared name in a URL path: each segment encoded, the slashes kept
+            return name.split('/').map(encodeURIComponent).join('/');
+        }
+        
+        let searchTimer = null;
+        
+        function applyEvent(event) {
+            const state = listState;
+            if (event.type === 'resync' || !state) {
+                loadFiles();
+                return;
+            }
+            if (state.query.has('q')) {
+                // The search index catches up in the background; ask again shortly
+                clearTimeout(searchTimer);
+                searchTimer = setTimeout(loadFiles, 1000);
+                return;
+            }
+            // Only changes in the open folder are applied in place. Deeper
+            // down they change a subfolder's totals, so reload shortly instead.
+            const names = [event.file, event.old_file, event.replaced_file]
+                .filter(f => f).map(f => f.name);
+            const prefix = currentFolder ? currentFolder + '/' : '';
+            if (names.some(name => name.startsWith(prefix) && folderOf(name) !== currentFolder)) {
+                clearTimeout(searchTimer);
+                searchTimer = setTimeout(loadFiles, 1000);
+                return;
+            }
+            if (!names.some(name => folderOf(name) === currentFolder)) {
+                return;
+            }
+            if (event.type === 'add') {
+                addFile(state, event.file);
+            } else if (event.type === 'remove') {
+                selectedFiles.delete(event.file.name);
+                updateSelection();
+                dropFile(state, event.file);
+            } else if (event.type === 'update') {
+                dropFile(state, event.old_file);
+                addFile(state, event.file);
+            } else if (event.type === 'rename') {
+                selectedFiles.delete(event.old_file.name);
+                updateSelection();
+                dropFile(state, event.old_file);
+                if (event.replaced_file) {
+                    dropFile(state, event.replaced_file);
+                }
+                addFile(state, event.file);
+            }
+            scheduleRender();
+        }
+        
+        let filesEtag = null;
+        
+        function pollFiles() {
+            // A one-entry probe: its ETag changes whenever the catalog does
+            const headers = filesEtag ? {'If-None-Match': filesEtag} : {};
+            fetch('/files?limit=1', {headers, cache: 'no-store'})
+                .then(response => {
+                    if (response.status === 304) {
+                        return;
+                    }
+                    const changed = filesEtag !== null;
+                    filesEtag = response.headers.get('ETag');
+                    if (changed) {
+                        loadFiles();
+                    }
+                })
+                .catch(() => {});
+        }
+        
+        function startPolling() {
+            pollFiles();
+            setInterval(pollFiles, 5000);
+        }
+        
+        if (window.EventSource) {
+            const events = new EventSource('/events');
+            events.addEventListener('message', (e) => applyEvent(JSON.parse(e.data)));
+            events.addEventListener('error', () => {
+                // EventSource retries on its own; give up only once it has closed
+                if (events.readyState === EventSource.CLOSED) {
+                    startPolling();
+                }
+            });
+        } else {
+            startPolling();
+        }
     </script>
 </body>
 </html>
 '''
 
-def get_local_ip():
-    """Get the local IP address of the machine"""
+def default_route_interface():
+    """Name of the interface carrying the IPv4 default route, from /proc (Linux only)"""
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-    except:
-        return "localhost"
+        with open('/proc/net/route') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 3 and fields[1] == '00000000' and int(fields[3], 16) & 1:
+                    return fields[0]
+    except (OSError, ValueError):
+        pass
+    return None
 
-def is_image_file(filename):
-    """Check if file is an image based on extension"""
-    ext = filename.lower().split('.')[-1] if '.' in filename else ''
-    image_extensions = {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'svg', 'ico'}
-    return ext in image_extensions
+def interface_addresses():
+    """IPv4 address of each network interface, as {name: ip}, without network traffic"""
+    addresses = {}
+    try:
+        import fcntl
+        names = socket.if_nameindex()
+    except (ImportError, AttributeError, OSError):
+        return addresses
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, name in names:
+            try:
+                # SIOCGIFADDR
+                ifreq = fcntl.ioctl(s.fileno(), 0x8915, struct.pack('256s', name.encode()[:15]))
+            except OSError:
+                continue
+            addresses[name] = socket.inet_ntoa(ifreq[20:24])
+    return addresses
 
-def get_file_icon(filename):
-    """Get emoji icon based on file type"""
-    ext = filename.lower().split('.')[-1] if '.' in filename else ''
-    
-    icon_map = {
-        # Images
-        'jpg': '🖼️', 'jpeg': '🖼️', 'png': '🖼️', 'gif': '🖼️', 'bmp': '🖼️', 'webp': '🖼️',
-        # Videos
-        'mp4': '🎥', 'avi': '🎥', 'mov': '🎥', 'wmv': '🎥', 'flv': '🎥',
-        # Audio
-        'mp3': '🎵', 'wav': '🎵', 'flac': '🎵', 'aac': '🎵',
+def resolve_local_ips():
+    """LAN addresses of this machine, the preferred one first
+
+    Uses the interface list and routing table where available, so an
+    offline network can't stall the lookup; otherwise falls back to the
+    hostname and finally to the old UDP-connect trick.
+    """
+    addresses = interface_addresses()
+    preferred = addresses.get(default_route_interface())
+    ips = [ip for ip in addresses.values() if not ip.startswith('127.')]
+    if not ips:
+        try:
+            ips = [ip for ip in socket.gethostbyname_ex(socket.gethostname())[2]
+                   if not ip.startswith('127.')]
+        except OSError:
+            pass
+    if not ips:
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                s.settimeout(0.5)
+                s.connect(("8.8.8.8", 80))
+                ips = [s.getsockname()[0]]
+        except OSError:
+            pass
+    if preferred in ips:
+        ips.remove(preferred)
+        ips.insert(0, preferred)
+    return ips or ['localhost']
+
+class NetworkInfo:
+    """Cached LAN addresses and QR codes for the connection URLs
+
+    Addresses are resolved once and refreshed when the kernel reports an
+    address, link or route change over netlink, or every
+    NETWORK_POLL_INTERVAL seconds where netlink isn't available. Rendered
+    QR codes are kept per URL and format until the addresses change.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._ips = None
+        self.qr_codes = {}
+
+    @property
+    def ips(self):
+        """Resolved on first use, as it can wait on a UDP socket"""
+        if self._ips is None:
+            ips = resolve_local_ips()
+            with self.lock:
+                if self._ips is None:
+                    self._ips = ips
+        return self._ips
+
+    def urls(self):
+        return [f"http://{ip}:{app.config['PORT']}" for ip in self.ips]
+
+    def refresh(self):
+        ips = resolve_local_ips()
+        with self.lock:
+            if ips != self._ips:
+                self._ips = ips
+                self.qr_codes.clear()
+
+    def qr_etag(self, url, fmt):
+        """ETag of a QR code, known without drawing it so the page needn't wait for one"""
+        return hashlib.sha1(f'{fmt} {url}'.encode()).hexdigest()[:16]
+
+    def qr_code(self, url, fmt):
+        """Return (body, etag) for the QR code of url as png or svg"""
+        with self.lock:
+            cached = self.qr_codes.get((url, fmt))
+        if cached:
+            return cached
+        # qrcode pulls in Pillow, so it is imported by the first request for a code
+        import qrcode
+        import qrcode.image.svg
+        qr = qrcode.QRCode(version=1, box_size=10, border=5)
+        qr.add_data(url)
+        qr.make(fit=True)
+        buffer = io.BytesIO()
+        if fmt == 'svg':
+            qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+        else:
+            qr.make_image(fill_color="black", back_color="white").save(buffer, format='PNG')
+        body = buffer.getvalue()
+        cached = body, self.qr_etag(url, fmt)
+        with self.lock:
+            self.qr_codes[(url, fmt)] = cached
+        return cached
+
+    def watch(self):
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self):
+        try:
+            # RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE
+            s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0)
+            s.bind((0, 0x1 | 0x10 | 0x40))
+        except (AttributeError, OSError):
+            while True:
+                time.sleep(app.config['NETWORK_POLL_INTERVAL'])
+                self.refresh()
+        with s:
+            while True:
+                s.recv(65536)
+                # A change usually comes as a burst of messages; let it settle
+                time.sleep(1)
+                s.setblocking(False)
+                try:
+                    while s.recv(65536):
+                        pass
+                except BlockingIOError:
+                    pass
+                s.setblocking(True)
+                self.refresh()
+
+network = NetworkInfo()
+
+def get_local_ip():
+    """Get the local IP address of the machine"""
+    return network.ips[0]
+
+def is_image_file(filename):
+    """Check if file is an image based on extension"""
+    ext = filename.lower().split('.')[-1] if '.' in filename else ''
+    image_extensions = {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'svg', 'ico'}
+    return ext in image_extensions
+
+def get_file_icon(filename):
+    """Get emoji icon based on file type"""
+    ext = filename.lower().split('.')[-1] if '.' in filename else ''
+    
+    icon_map = {
+        # Images
+        'jpg': '🖼️', 'jpeg': '🖼️', 'png': '🖼️', 'gif': '🖼️', 'bmp': '🖼️', 'webp': '🖼️',
+        # Videos
+        'mp4': '🎥', 'avi': '🎥', 'mov': '🎥', 'wmv': '🎥', 'flv': '🎥',
+        # Audio
+        'mp3': '🎵', 'wav': '🎵', 'flac': '🎵', 'aac': '🎵',
         # Documents
         'pdf': '📄', 'doc': '📝', 'docx': '📝', 'txt': '📝', 'xls': '📊', 
         'xlsx': '📊', 'ppt': '📊', 'pptx': '📊',
@@ -428,47 +1365,3509 @@ def get_file_icon(filename):
     
     return icon_map.get(ext, '📎')
 
+def get_file_type(filename):
+    """Get the broad category of a file, used for filtering"""
+    ext = filename.lower().split('.')[-1] if '.' in filename else ''
+    
+    type_map = {
+        'image': {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp', 'svg', 'ico'},
+        'video': {'mp4', 'avi', 'mov', 'wmv', 'flv', 'mkv', 'webm'},
+        'audio': {'mp3', 'wav', 'flac', 'aac', 'ogg', 'm4a'},
+        'document': {'pdf', 'doc', 'docx', 'txt', 'xls', 'xlsx', 'ppt', 'pptx', 'csv', 'json', 'md'},
+        'archive': {'zip', 'rar', '7z', 'tar', 'gz'},
+    }
+    
+    for file_type, extensions in type_map.items():
+        if ext in extensions:
+            return file_type
+    return 'other'
+
+def secure_path(path):
+    """secure_filename for each part of a relative path, keeping the folders"""
+    parts = (secure_filename(part) for part in path.replace('\\', '/').split('/'))
+    return '/'.join(part for part in parts if part)
+
+def shared_path(name):
+    """Absolute path of a shared file or folder, or None for names outside the share
+
+    Names are relative paths with / separators. Empty parts, . and .., and
+    hidden parts (our .blobs, .state, ... folders) are refused.
+    """
+    parts = name.split('/')
+    if any(not part or part.startswith('.') for part in parts):
+        return None
+    return os.path.join(app.config['UPLOAD_FOLDER'], *parts)
+
+def parent_folder(name):
+    """Folder of a shared name, '' for the top level"""
+    return name.rpartition('/')[0]
+
+def create_exclusive(path):
+    """Create an empty file, failing with FileExistsError if path is taken"""
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+
+class NameConflict(ValueError):
+    """A shared name that can't be used because a file is where its folder should be"""
+
+class NameAllocator:
+    """Hands out free shared-file names, e.g. photo.jpg, photo_1.jpg, ...
+
+    A name is claimed by an exclusive create (O_EXCL or link(2)), so two
+    concurrent uploads can never end up with the same one. After the first
+    clash for a name, the next suffix to try is kept in memory, seeded once
+    from the catalog, so the 500th upload of IMG_0001.jpg costs one or two
+    syscalls rather than 500 stats.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.next_suffix = {}
+
+    def _seed(self, base, ext):
+        pattern = re.compile(re.escape(base) + r'_(\d+)' + re.escape(ext) + '$')
+        taken = [int(m.group(1)) for m in map(pattern.match, catalog.names()) if m]
+        return max(taken, default=0) + 1
+
+    def claim(self, filename, create=create_exclusive):
+        """Claim a free variant of filename by calling create(path) on it
+
+        create must fail with FileExistsError when the path exists. Returns
+        the claimed name.
+        """
+        base, ext = os.path.splitext(filename)
+        name = filename
+        self.prepare(filename)
+        while True:
+            try:
+                create(os.path.join(self.folder, name))
+                return name
+            except FileExistsError:
+                pass
+            with self.lock:
+                suffix = self.next_suffix.get(filename)
+                if suffix is None:
+                    suffix = self._seed(base, ext)
+                self.next_suffix[filename] = suffix + 1
+            name = f"{base}_{suffix}{ext}"
+
+    def prepare(self, filename):
+        """Create the folders filename goes in; raises NameConflict if a file is in the way"""
+        try:
+            os.makedirs(os.path.dirname(os.path.join(self.folder, filename)), exist_ok=True)
+        except (FileExistsError, NotADirectoryError):
+            raise NameConflict(f'Cannot save {filename}: a file is in the way of its folder') from None
+
+name_allocator = NameAllocator(app.config['UPLOAD_FOLDER'])
+
+# Chunked upload sessions, keyed by session id. Each session is also persisted
+# as JSON next to its .part file so an upload can resume after a restart.
+upload_sessions = {}
+upload_sessions_lock = threading.Lock()
+SESSION_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+def session_paths(session_id):
+    """Get the metadata and data file paths for an upload session"""
+    folder = app.config['UPLOAD_SESSION_FOLDER']
+    return (os.path.join(folder, session_id + '.json'),
+            os.path.join(folder, session_id + '.part'))
+
+def save_session(session):
+    """Persist session metadata atomically"""
+    meta_path, _ = session_paths(session['id'])
+    state = dict(session, received=sorted(session['received']))
+    state.pop('lock', None)
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, meta_path)
+
+def get_session(session_id):
+    """Look up an upload session, loading it from disk if needed"""
+    if not SESSION_ID_RE.match(session_id):
+        return None
+    with upload_sessions_lock:
+        session = upload_sessions.get(session_id)
+        if session is not None:
+            return session
+        meta_path, part_path = session_paths(session_id)
+        if not (os.path.exists(meta_path) and os.path.exists(part_path)):
+            return None
+        with open(meta_path) as f:
+            session = json.load(f)
+        session['received'] = set(session['received'])
+        session['lock'] = threading.Lock()
+        upload_sessions[session_id] = session
+        return session
+
+def chunk_length(session, index):
+    """Expected byte length of chunk `index` in a session"""
+    start = index * session['chunk_size']
+    return max(0, min(session['chunk_size'], session['size'] - start))
+
+def session_status(session):
+    """Public view of an upload session"""
+    missing = [i for i in range(session['total_chunks']) if i not in session['received']]
+    return {
+        'session_id': session['id'],
+        'filename': session['filename'],
+        'size': session['size'],
+        'chunk_size': session['chunk_size'],
+        'total_chunks': session['total_chunks'],
+        'received_chunks': sorted(session['received']),
+        'missing_chunks': missing,
+        'complete': not missing,
+        'parallel_streams': app.config['UPLOAD_PARALLEL_STREAMS']
+    }
+
+def preallocate(fd, size):
+    """Reserve disk space for a file so chunks can be written in place"""
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+class FileCatalog:
+    """In-memory index of the files in UPLOAD_FOLDER and its subfolders
+
+    Entries are computed once when a file appears and kept up to date by the
+    upload handlers and a directory watcher, so listing the share never has
+    to touch the disk. Every change bumps `version` and is published as a
+    delta (add, update, remove or rename) to subscribers of /events.
+
+    Files are keyed by their path relative to UPLOAD_FOLDER, e.g.
+    photos/2024/IMG_0001.jpg. `folders` holds each folder's direct children
+    and the file count, total size and latest mtime of everything below it.
+    These are updated along the file's ancestors as entries come and go, so
+    listing a folder costs its own children, never a walk of the tree.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.folders = {'': self._new_folder()}
+        self.dirs = set()  # every folder seen by the last scan, empty ones included
+        self.version = 0
+        self._listing = None
+        self._listing_version = -1
+        self._sorted = {}
+        self._counts = {}
+        self._history = collections.deque(maxlen=app.config['EVENTS_HISTORY'])
+        self._subscribers = set()
+        # Versions restart from zero with the process, so ETags and event ids
+        # carry an instance id to keep them from matching across restarts
+        self.instance = secrets.token_hex(4)
+
+    @staticmethod
+    def _new_folder():
+        return {'files': set(), 'folders': set(), 'count': 0, 'size': 0, 'mtime': 0}
+
+    def _folder(self, path):
+        """The folder record for path, created along with its parents if needed"""
+        node = self.folders.get(path)
+        if node is None:
+            node = self.folders[path] = self._new_folder()
+            self._folder(parent_folder(path))['folders'].add(path)
+        return node
+
+    def _put(self, name, entry):
+        """Add or replace an entry and update its folders; must be called with the lock held"""
+        self._drop(name)
+        self.entries[name] = entry
+        path = parent_folder(name)
+        self._folder(path)['files'].add(name)
+        while True:
+            node = self.folders[path]
+            node['count'] += 1
+            node['size'] += entry['size']
+            node['mtime'] = max(node['mtime'], entry['mtime'])
+            if not path:
+                break
+            path = parent_folder(path)
+
+    def _drop(self, name):
+        """Remove an entry and update its folders; must be called with the lock held"""
+        entry = self.entries.pop(name, None)
+        if entry is None:
+            return None
+        path = parent_folder(name)
+        self.folders[path]['files'].discard(name)
+        while True:
+            node = self.folders[path]
+            node['count'] -= 1
+            node['size'] -= entry['size']
+            if not path:
+                break
+            if not node['count']:
+                # Folders are listed while they hold files
+                del self.folders[path]
+                self.folders[parent_folder(path)]['folders'].discard(path)
+            path = parent_folder(path)
+        return entry
+
+    def folder_entry(self, path):
+        """Listing entry for a folder, with the totals of everything below it"""
+        with self.lock:
+            node = self.folders.get(path)
+            if node is None:
+                return None
+            return {
+                'name': path,
+                'size': node['size'],
+                'mtime': node['mtime'],
+                'icon': '📁',
+                'is_image': False,
+                'type': 'folder',
+                'files': node['count'],
+            }
+
+    def _make_entry(self, name, st):
+        basename = name.rpartition('/')[2]
+        return {
+            'name': name,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'icon': get_file_icon(basename),
+            'is_image': is_image_file(basename),
+            'type': get_file_type(basename)
+        }
+
+    def _stat_entry(self, name):
+        try:
+            st = os.stat(os.path.join(self.folder, name))
+        except OSError:
+            return None
+        return self._make_entry(name, st) if stat.S_ISREG(st.st_mode) else None
+
+    def _publish(self, event):
+        """Record a change; must be called with the lock held"""
+        self.version += 1
+        event['version'] = self.version
+        self._history.append(event)
+        for q in list(self._subscribers):
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # A client that falls this far behind reloads the list instead
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait({'type': 'resync', 'version': self.version})
+
+    def _publish_change(self, old, entry):
+        if old is None:
+            self._publish({'type': 'add', 'file': entry})
+        else:
+            self._publish({'type': 'update', 'old_file': old, 'file': entry})
+
+    def scan(self, folder=''):
+        """Rebuild the catalog, or the part below folder, from a directory walk
+
+        Hidden files and folders (ours are .blobs, .state, ...) are skipped.
+        """
+        entries = {}
+        dirs = set()
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.folder, folder)):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            path = os.path.relpath(dirpath, self.folder).replace(os.sep, '/')
+            prefix = '' if path == '.' else path + '/'
+            dirs.add(prefix[:-1])
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    entries[prefix + filename] = self._make_entry(prefix + filename, st)
+        with self.lock:
+            prefix = folder + '/' if folder else ''
+            self.dirs = {d for d in self.dirs if d != folder and not d.startswith(prefix)} | dirs
+            for name in [name for name in self.entries if name.startswith(prefix) and name not in entries]:
+                self._publish({'type': 'remove', 'name': name, 'file': self._drop(name)})
+            for name, entry in entries.items():
+                old = self.entries.get(name)
+                if old != entry:
+                    self._put(name, entry)
+                    self._publish_change(old, entry)
+
+    def refresh(self, name):
+        """Re-stat a single file and add, update or drop its entry"""
+        entry = self._stat_entry(name)
+        with self.lock:
+            old = self.entries.get(name)
+            if entry is None:
+                if old is not None:
+                    self._drop(name)
+                    self._publish({'type': 'remove', 'name': name, 'file': old})
+            elif old != entry:
+                self._put(name, entry)
+                self._publish_change(old, entry)
+        return entry
+
+    def rename(self, old_name, new_name):
+        """Move an entry to a new name after a rename on disk"""
+        entry = self._stat_entry(new_name)
+        with self.lock:
+            old = self._drop(old_name)
+            if old is None or entry is None:
+                if old is not None:
+                    self._publish({'type': 'remove', 'name': old_name, 'file': old})
+                self.refresh(new_name)
+                return
+            replaced = self.entries.get(new_name)
+            self._put(new_name, entry)
+            self._publish({'type': 'rename', 'old_name': old_name, 'old_file': old,
+                           'file': entry, 'replaced_file': replaced})
+
+    def subscribe(self, last_version=None):
+        """Register for change events, replaying any missed since last_version"""
+        q = queue.Queue(maxsize=app.config['EVENTS_HISTORY'])
+        with self.lock:
+            if last_version is not None and last_version < self.version:
+                if last_version >= 0 and self._history and self._history[0]['version'] <= last_version + 1:
+                    for event in self._history:
+                        if event['version'] > last_version:
+                            q.put_nowait(event)
+                else:
+                    q.put_nowait({'type': 'resync', 'version': self.version})
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self._subscribers.discard(q)
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def names(self):
+        with self.lock:
+            return sorted(self.entries)
+
+    def snapshot(self):
+        """All entries as a list; entries are replaced, never mutated, so this is safe to read"""
+        with self.lock:
+            return list(self.entries.values())
+
+    def listing_json(self):
+        """Serialized file list, rebuilt only when the catalog has changed"""
+        with self.lock:
+            if self._listing_version != self.version:
+                files = [self.entries[name] for name in sorted(self.entries)]
+                self._listing = json.dumps(files)
+                self._listing_version = self.version
+            return self._listing
+
+    def files_under(self, folder):
+        """Names of all files below a folder, '' for the whole share"""
+        with self.lock:
+            if folder not in self.folders:
+                return []
+            prefix = folder + '/' if folder else ''
+            return sorted(name for name in self.entries if name.startswith(prefix))
+
+    def children(self, folder):
+        """Entries of a folder's files and subfolders, or None if there is no such folder"""
+        with self.lock:
+            node = self.folders.get(folder)
+            if node is None:
+                return None
+            return ([self.entries[name] for name in node['files']] +
+                    [self.folder_entry(path) for path in node['folders']])
+
+    def sorted_entries(self, sort, folder=''):
+        """A folder's entries and their sort keys in ascending order, cached per version"""
+        with self.lock:
+            if self._sorted.get('version') != self.version:
+                self._sorted = {'version': self.version}
+            cached = self._sorted.get((sort, folder))
+            if cached is None:
+                keyfunc = SORT_KEYS[sort]
+                entries = sorted(self.children(folder) or [], key=keyfunc)
+                cached = (entries, [keyfunc(e) for e in entries])
+                self._sorted[(sort, folder)] = cached
+            return cached
+
+    def totals(self):
+        """Number of shared files and their total size in bytes"""
+        with self.lock:
+            return len(self.entries), sum(e['size'] for e in self.entries.values())
+
+    def count(self, filters, match, folder=''):
+        """Number of a folder's entries matching a filter, cached per version"""
+        with self.lock:
+            if self._counts.get('version') != self.version:
+                self._counts = {'version': self.version}
+            if (folder, filters) not in self._counts:
+                self._counts[(folder, filters)] = sum(1 for e in self.children(folder) or [] if match(e))
+            return self._counts[(folder, filters)]
+
+    def page(self, sort, descending, after, limit, match, folder=''):
+        """Return up to `limit` matching entries of a folder that sort after the key `after`
+
+        Returns the page and the key to continue from, or None at the end.
+        """
+        entries, keys = self.sorted_entries(sort, folder)
+        return page_entries(entries, keys, descending, after, limit, match)
+
+    def resync(self):
+        """Tell subscribers to reload the whole list, e.g. when a peer's files change"""
+        with self.lock:
+            self._publish({'type': 'resync'})
+
+    def watch(self):
+        """Keep the catalog in sync with changes made outside the app"""
+        target = self._watch_inotify if inotify_available() else self._watch_polling
+        threading.Thread(target=target, name='catalog-watcher', daemon=True).start()
+
+    def _watch_polling(self):
+        last_mtimes = None
+        last_scan = time.monotonic()
+        while True:
+            time.sleep(app.config['CATALOG_POLL_INTERVAL'])
+            # Adding, removing or renaming a file bumps its folder's mtime,
+            # so a full scan is only needed when one of them moves
+            with self.lock:
+                paths = list(self.dirs | set(self.folders))
+            mtimes = {}
+            for path in paths:
+                try:
+                    mtimes[path] = os.stat(os.path.join(self.folder, path)).st_mtime_ns
+                except OSError:
+                    mtimes[path] = None
+            due = time.monotonic() - last_scan > app.config['CATALOG_RESCAN_INTERVAL']
+            if mtimes != last_mtimes or due:
+                last_mtimes = mtimes
+                last_scan = time.monotonic()
+                try:
+                    self.scan()
+                except OSError:
+                    continue
+
+    def _watch_inotify(self):
+        try:
+            watcher = Inotify()
+        except OSError:
+            self._watch_polling()
+            return
+        folders = {}  # watch descriptor -> folder relative to the share
+
+        def watch_tree(path):
+            for dirpath, dirnames, _ in os.walk(os.path.join(self.folder, path)):
+                dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+                rel = os.path.relpath(dirpath, self.folder).replace(os.sep, '/')
+                try:
+                    folders[watcher.add(dirpath)] = '' if rel == '.' else rel
+                except OSError:
+                    continue
+
+        def unwatch_tree(path):
+            for wd, rel in list(folders.items()):
+                if rel == path or rel.startswith(path + '/'):
+                    watcher.remove(wd)
+                    del folders[wd]
+
+        try:
+            watch_tree('')
+        except OSError:
+            self._watch_polling()
+            return
+        while True:
+            moved_from = {}
+            for wd, mask, cookie, name in watcher.read_events():
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    watch_tree('')
+                    self.scan()
+                    continue
+                if mask & Inotify.IN_IGNORED:
+                    folders.pop(wd, None)
+                    continue
+                if not name or name.startswith('.') or wd not in folders:
+                    continue
+                path = f'{folders[wd]}/{name}' if folders[wd] else name
+                if mask & Inotify.IN_ISDIR:
+                    # Folders are rescanned as a whole when they come or go
+                    if mask & (Inotify.IN_MOVED_FROM | Inotify.IN_DELETE):
+                        unwatch_tree(path)
+                        self.scan(path)
+                    elif mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                        watch_tree(path)
+                        self.scan(path)
+                elif mask & Inotify.IN_MOVED_FROM:
+                    moved_from[cookie] = path
+                elif mask & Inotify.IN_MOVED_TO and cookie in moved_from:
+                    self.rename(moved_from.pop(cookie), path)
+                else:
+                    self.refresh(path)
+            # Files moved out of the share have no matching IN_MOVED_TO
+            for path in moved_from.values():
+                self.refresh(path)
+
+def page_entries(entries, keys, descending, after, limit, match):
+    """Keyset pagination over entries sorted by `keys`; see FileCatalog.page"""
+    if descending:
+        end = bisect.bisect_left(keys, after) if after is not None else len(keys)
+        indices = range(end - 1, -1, -1)
+    else:
+        start = bisect.bisect_right(keys, after) if after is not None else 0
+        indices = range(start, len(keys))
+
+    page = []
+    page_last = None
+    for i in indices:
+        if match(entries[i]):
+            if len(page) == limit:
+                return page, keys[page_last]
+            page.append(entries[i])
+            page_last = i
+    return page, None
+
+def inotify_available():
+    """Check whether the C library exposes inotify"""
+    libc = ctypes.util.find_library('c')
+    return libc is not None and hasattr(ctypes.CDLL(libc), 'inotify_init1')
+
+class Inotify:
+    """Minimal ctypes wrapper around Linux inotify"""
+
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add(self, folder):
+        """Watch a directory; returns its watch descriptor"""
+        mask = (self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM |
+                self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        return wd
+
+    def remove(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Block until events arrive; yields (wd, mask, cookie, name) tuples"""
+        buf = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(buf, pos)
+            pos += self.EVENT_HEADER.size
+            name = buf[pos:pos + length].rstrip(b'\0')
+            pos += length
+            yield wd, mask, cookie, os.fsdecode(name)
+
+SORT_KEYS = {
+    'name': lambda e: (e['name'].lower(), e['name']),
+    'size': lambda e: (e['size'], e['name']),
+    'mtime': lambda e: (e['mtime'], e['name']),
+}
+
+def encode_cursor(sort, key):
+    """Opaque pagination cursor for the position after `key`"""
+    raw = json.dumps([sort, list(key)]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor, sort):
+    """Decode a cursor; raises ValueError if it is malformed or for another sort"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, key = json.loads(raw)
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if cursor_sort != sort or not isinstance(key, list) or len(key) != 2:
+        raise ValueError('Cursor does not match the requested sort')
+    value_type = str if sort == 'name' else (int, float)
+    if not isinstance(key[0], value_type) or not isinstance(key[1], str):
+        raise ValueError('Invalid cursor')
+    return tuple(key)
+
+catalog = FileCatalog(app.config['UPLOAD_FOLDER'])
+
+PEER_SERVICE_TYPE = '_fileshare._tcp.local.'
+# Headers passed between clients and peers when a remote file is proxied
+PROXY_REQUEST_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since', 'Accept-Encoding')
+PROXY_RESPONSE_HEADERS = ('content-type', 'content-length', 'content-range', 'content-disposition',
+                          'content-encoding', 'accept-ranges', 'etag', 'last-modified',
+                          'cache-control', 'vary')
+
+class PeerDirectory:
+    """File lists of other file_share nodes, merged into /files
+
+    Each peer's local list is polled every PEER_REFRESH_INTERVAL seconds with
+    If-None-Match, so an unchanged peer costs a 304. A peer that hasn't
+    answered for PEER_STALE_AFTER seconds drops out of the listing until it
+    comes back. Remote entries carry `peer` (the id used in
+    /peers/<peer>/download/<filename>) and `node` (the peer's name). Their
+    tie-break key has the peer id appended, so a file with the same name on
+    several nodes still has a unique position for cursors.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.peers = {}
+        self.version = 0
+        self._live = frozenset()
+        self._sorted = {}
+        self._children = {}
+        self._counts = {}
+        self._listing = None
+        self._listing_version = -1
+        self.pool = ThreadPoolExecutor(8, 'peer-refresh')
+        self.watching = False
+
+    @staticmethod
+    def peer_id(url):
+        return urllib.parse.urlsplit(url).netloc
+
+    def add(self, url, service=None):
+        """Add a peer by base URL, e.g. http://192.168.1.20:5000; returns its id"""
+        if '://' not in url:
+            url = 'http://' + url
+        url = url.rstrip('/')
+        peer_id = self.peer_id(url)
+        with self.lock:
+            if peer_id not in self.peers:
+                self.peers[peer_id] = {
+                    'id': peer_id, 'url': url, 'name': peer_id, 'service': service,
+                    'files': [], 'etag': None, 'fetched': None, 'error': None, 'self': False,
+                }
+        return peer_id
+
+    def forget(self, service):
+        """Drop peers that were discovered as an mDNS service that has gone away"""
+        with self.lock:
+            for peer_id, peer in list(self.peers.items()):
+                if peer['service'] == service:
+                    del self.peers[peer_id]
+
+    def get(self, peer_id):
+        with self.lock:
+            peer = self.peers.get(peer_id)
+            return peer if peer is not None and not peer['self'] else None
+
+    def _is_live(self, peer):
+        return (not peer['self'] and peer['fetched'] is not None and
+                time.monotonic() - peer['fetched'] < app.config['PEER_STALE_AFTER'])
+
+    def active(self):
+        """Whether any peer currently contributes files"""
+        return bool(self._live)
+
+    def open(self, peer, method, path, headers=None):
+        """Send a request to a peer; returns the http.client response, unread"""
+        parts = urllib.parse.urlsplit(peer['url'])
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        conn = connection_class(parts.netloc, timeout=app.config['PEER_TIMEOUT'])
+        try:
+            conn.request(method, path, headers=headers or {})
+            return conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+
+    def _fetch(self, peer):
+        """Poll one peer's local file list; returns True if its files changed"""
+        headers = {'If-None-Match': peer['etag']} if peer['etag'] else {}
+        try:
+            resp = self.open(peer, 'GET', '/files?peers=0', headers)
+            try:
+                body = resp.read()
+            finally:
+                resp.close()
+            if resp.status not in (200, 304):
+                raise ValueError(f'HTTP {resp.status}')
+            name = resp.getheader('X-File-Share-Node') or peer['id']
+            files = None
+            if resp.status == 200:
+                files = [dict(entry, peer=peer['id'], node=name) for entry in json.loads(body)]
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            with self.lock:
+                peer['error'] = str(e) or type(e).__name__
+            return False
+        with self.lock:
+            if resp.getheader('X-File-Share-Instance') == catalog.instance:
+                # Our own address, in the static list or found by discovery
+                peer['self'] = True
+                return False
+            changed = files is not None and files != peer['files']
+            if files is not None:
+                peer['files'] = files
+                peer['etag'] = resp.getheader('ETag')
+            peer['name'] = name
+            peer['fetched'] = time.monotonic()
+            peer['error'] = None
+        return changed
+
+    def refresh(self):
+        """Poll every peer once and publish a resync if the merged list changed"""
+        with self.lock:
+            peers = list(self.peers.values())
+        changed = any(list(self.pool.map(self._fetch, peers)))
+        with self.lock:
+            live = frozenset(peer['id'] for peer in self.peers.values() if self._is_live(peer))
+            if changed or live != self._live:
+                self._live = live
+                self.version += 1
+                changed = True
+        if changed:
+            catalog.resync()
+
+    def entries(self):
+        """Files of all live peers; must be called with the lock held"""
+        return [entry for peer_id in sorted(self._live) if peer_id in self.peers
+                for entry in self.peers[peer_id]['files']]
+
+    def listing_json(self):
+        """Serialized remote files, rebuilt only when a peer's list has changed"""
+        with self.lock:
+            if self._listing_version != self.version:
+                self._listing = json.dumps(sorted(self.entries(), key=lambda e: (e['name'], e['peer'])))
+                self._listing_version = self.version
+            return self._listing
+
+    def children(self, folder):
+        """Remote files in a folder and remote subfolders with their totals; lock held"""
+        if self._children.get('version') != self.version:
+            self._children = {'version': self.version}
+        if folder not in self._children:
+            prefix = folder + '/' if folder else ''
+            files = []
+            folders = {}
+            for entry in self.entries():
+                if not entry['name'].startswith(prefix):
+                    continue
+                rest = entry['name'][len(prefix):]
+                if '/' not in rest:
+                    files.append(entry)
+                    continue
+                path = prefix + rest.split('/', 1)[0]
+                node = folders.get((entry['peer'], path))
+                if node is None:
+                    node = folders[(entry['peer'], path)] = {
+                        'name': path, 'size': 0, 'mtime': 0, 'icon': '📁', 'is_image': False,
+                        'type': 'folder', 'files': 0, 'peer': entry['peer'], 'node': entry['node'],
+                    }
+                node['size'] += entry['size']
+                node['mtime'] = max(node['mtime'], entry['mtime'])
+                node['files'] += 1
+            self._children[folder] = files + list(folders.values())
+        return self._children[folder]
+
+    def sorted_entries(self, sort, folder=''):
+        """A folder's local and remote entries with their sort keys, cached per catalog and peer version"""
+        with self.lock:
+            version = (catalog.version, self.version)
+            cached = self._sorted.get((sort, folder))
+            if cached is None or cached[0] != version:
+                local, local_keys = catalog.sorted_entries(sort, folder)
+                keyfunc = SORT_KEYS[sort]
+                pairs = list(zip(local_keys, local))
+                for entry in self.children(folder):
+                    value, name = keyfunc(entry)
+                    pairs.append(((value, f"{name}\0{entry['peer']}"), entry))
+                # Two sorted runs, so this is close to a linear merge
+                pairs.sort(key=lambda pair: pair[0])
+                cached = (version, [e for _, e in pairs], [k for k, _ in pairs])
+                if self._sorted.get('version') != version:
+                    self._sorted = {'version': version}
+                self._sorted[(sort, folder)] = cached
+            return cached[1], cached[2]
+
+    def count(self, filters, match, folder=''):
+        """Number of a folder's local and remote entries matching a filter"""
+        with self.lock:
+            if self._counts.get('version') != self.version:
+                self._counts = {'version': self.version}
+            if (folder, filters) not in self._counts:
+                self._counts[(folder, filters)] = sum(1 for e in self.children(folder) if match(e))
+            remote = self._counts[(folder, filters)]
+        return catalog.count(filters, match, folder) + remote
+
+    def page(self, sort, descending, after, limit, match, folder=''):
+        """Like FileCatalog.page, over local and remote entries"""
+        entries, keys = self.sorted_entries(sort, folder)
+        return page_entries(entries, keys, descending, after, limit, match)
+
+    def status(self):
+        with self.lock:
+            now = time.monotonic()
+            return [{
+                'id': peer['id'],
+                'url': peer['url'],
+                'node': peer['name'],
+                'live': peer['id'] in self._live,
+                'files': len(peer['files']),
+                'last_seen': None if peer['fetched'] is None else round(now - peer['fetched'], 1),
+                'error': peer['error'],
+            } for peer in self.peers.values() if not peer['self']]
+
+    def watch(self):
+        """Start polling peers in the background"""
+        if self.watching:
+            return
+        self.watching = True
+
+        def run():
+            while True:
+                try:
+                    self.refresh()
+                except Exception:
+                    app.logger.exception('Peer refresh failed')
+                time.sleep(app.config['PEER_REFRESH_INTERVAL'])
+
+        threading.Thread(target=run, name='peers', daemon=True).start()
+
+    def discover(self):
+        """Advertise this node over mDNS and add the peers it finds
+
+        Needs the zeroconf package; returns False when it isn't installed.
+        """
+        try:
+            import zeroconf
+        except ImportError:
+            return False
+        directory = self
+        zc = zeroconf.Zeroconf()
+        zc.register_service(zeroconf.ServiceInfo(
+            PEER_SERVICE_TYPE,
+            f"{app.config['NODE_NAME']}-{catalog.instance}.{PEER_SERVICE_TYPE}",
+            addresses=[socket.inet_aton(ip) for ip in network.ips],
+            port=app.config['PORT'],
+            properties={'instance': catalog.instance, 'node': app.config['NODE_NAME']},
+        ))
+
+        class Listener:
+            def add_service(self, zc, service_type, name):
+                info = zc.get_service_info(service_type, name)
+                if info is None or info.properties.get(b'instance') == catalog.instance.encode():
+                    return
+                for address in info.parsed_addresses(zeroconf.IPVersion.V4Only):
+                    directory.add(f'http://{address}:{info.port}', service=name)
+                    break
+
+            def update_service(self, zc, service_type, name):
+                self.add_service(zc, service_type, name)
+
+            def remove_service(self, zc, service_type, name):
+                directory.forget(name)
+
+        self.browser = zeroconf.ServiceBrowser(zc, PEER_SERVICE_TYPE, Listener())
+        self.watch()
+        return True
+
+peers = PeerDirectory()
+
+class ContentHasher:
+    """Incremental content hash used to address blobs
+
+    The data is split into HASH_BLOCK_SIZE blocks, each block is hashed with
+    SHA-256, and the content hash is the SHA-256 of the concatenated block
+    digests. Blocks are independent, so upload chunks can be hashed as they
+    stream in, in any order, and a browser can compute the same value with
+    crypto.subtle one block at a time.
+
+    With whole=True it also keeps a plain SHA-256 of everything fed to it,
+    for callers that see the data in order, so the file's Digest header
+    comes out of the same pass.
+    """
+
+    def __init__(self, whole=False):
+        self.block_size = app.config['HASH_BLOCK_SIZE']
+        self.digests = []
+        self._block = hashlib.sha256()
+        self._filled = 0
+        self.whole = hashlib.sha256() if whole else None
+
+    def update(self, data):
+        if self.whole is not None:
+            self.whole.update(data)
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.block_size - self._filled)
+            self._block.update(view[:n])
+            self._filled += n
+            view = view[n:]
+            if self._filled == self.block_size:
+                self.digests.append(self._block.hexdigest())
+                self._block = hashlib.sha256()
+                self._filled = 0
+
+    def block_digests(self):
+        """Digests of every block so far, including a trailing partial block"""
+        if self._filled:
+            return self.digests + [self._block.hexdigest()]
+        return list(self.digests)
+
+    def hexdigest(self):
+        return combine_digests(self.block_digests())
+
+def combine_digests(block_digests):
+    """Content hash from the ordered list of block digests"""
+    return hashlib.sha256(b''.join(bytes.fromhex(d) for d in block_digests)).hexdigest()
+
+def file_digest(path):
+    """Content hash of a file on disk"""
+    hasher = ContentHasher()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+def file_sha256(path):
+    """Plain SHA-256 of a file on disk"""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            sha256.update(data)
+    return sha256.hexdigest()
+
+class ThumbnailCache:
+    """On-disk cache of downscaled image previews
+
+    Thumbnails are keyed by the source's content hash and mtime, so copies of
+    the same photo share them and edited files get new ones. The cache is
+    kept under a byte budget by evicting the least recently served files.
+    """
+
+    def __init__(self, folder, sizes, budget):
+        self.folder = folder
+        self.sizes = sorted(sizes)
+        self.budget = budget
+        self._format = None
+        self.lock = threading.Lock()
+        self.lru = collections.OrderedDict()  # thumbnail path -> bytes, oldest first
+        self.total = 0
+        self.pending = {}
+        self.pool = ThreadPoolExecutor(app.config['THUMBNAIL_WORKERS'], thread_name_prefix='thumbnail')
+        self.index_path = os.path.join(folder, 'index.json')
+        self.dirty = False
+        try:
+            with open(self.index_path) as f:
+                self.digests = json.load(f)  # name -> [size, mtime_ns, sha256]
+        except (OSError, ValueError):
+            self.digests = {}
+
+    @property
+    def format(self):
+        """WEBP where Pillow can write it, else JPEG; checked on first use as it loads Pillow"""
+        if self._format is None:
+            self._format = 'WEBP' if features.check('webp') else 'JPEG'
+        return self._format
+
+    @property
+    def extension(self):
+        return 'webp' if self.format == 'WEBP' else 'jpg'
+
+    def _digest(self, name, st):
+        known = self.digests.get(name)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        digest = file_digest(os.path.join(app.config['UPLOAD_FOLDER'], name))
+        self.remember(name, st, digest)
+        return digest
+
+    def remember(self, name, st, digest):
+        """Record a content hash computed elsewhere, so the image isn't read twice"""
+        with self.lock:
+            self.digests[name] = [st.st_size, st.st_mtime_ns, digest]
+            self.dirty = True
+
+    def save(self):
+        """Write the content hash index, without files that have left the share"""
+        names = set(catalog.names())
+        with self.lock:
+            for name in self.digests.keys() - names:
+                del self.digests[name]
+                self.dirty = True
+            if not self.dirty:
+                return
+            state = json.dumps(self.digests)
+            self.dirty = False
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(state)
+        os.replace(tmp_path, self.index_path)
+
+    def start(self):
+        """Load the thumbnails already on disk, then save the hash index every minute"""
+        existing = []
+        with os.scandir(self.folder) as it:
+            for item in it:
+                if item.name.endswith(('.webp', '.jpg')):
+                    st = item.stat()
+                    existing.append((st.st_mtime, item.path, st.st_size))
+        with self.lock:
+            for _, path, size in sorted(existing):
+                self.lru[path] = size
+                self.total += size
+
+        def run():
+            while True:
+                time.sleep(60)
+                try:
+                    self.save()
+                except OSError:
+                    pass
+        threading.Thread(target=run, name='thumbnail-index', daemon=True).start()
+
+    def _paths(self, name, st):
+        digest = self._digest(name, st)
+        return {px: os.path.join(self.folder, f'{digest}-{st.st_mtime_ns}-{px}.{self.extension}')
+                for px in self.sizes}
+
+    def _generate(self, name):
+        """Render every thumbnail size for one image; runs in the worker pool"""
+        source = os.path.join(app.config['UPLOAD_FOLDER'], name)
+        st = os.stat(source)
+        paths = self._paths(name, st)
+        if all(os.path.exists(p) for p in paths.values()):
+            return paths
+        with Image.open(source) as img:
+            # Let the JPEG decoder downscale while decoding
+            img.draft('RGB', (self.sizes[-1], self.sizes[-1]))
+            img = ImageOps.exif_transpose(img)
+            if self.format == 'JPEG' or img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if self.format == 'WEBP' and 'A' in img.getbands() else 'RGB')
+            for px in reversed(self.sizes):
+                img.thumbnail((px, px))
+                tmp_path = paths[px] + '.tmp'
+                img.save(tmp_path, self.format, quality=80)
+                os.replace(tmp_path, paths[px])
+                self._track(paths[px])
+        return paths
+
+    def _track(self, path):
+        size = os.path.getsize(path)
+        with self.lock:
+            self.total += size - self.lru.pop(path, 0)
+            self.lru[path] = size
+            while self.total > self.budget and len(self.lru) > 1:
+                old_path, old_size = self.lru.popitem(last=False)
+                self.total -= old_size
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    def submit(self, name):
+        """Queue thumbnail generation for an image, at most once at a time"""
+        with self.lock:
+            future = self.pending.get(name)
+            if future is not None:
+                return future
+            future = self.pool.submit(self._generate, name)
+            self.pending[name] = future
+        # Outside the lock: the callback runs at once if the job already finished
+        future.add_done_callback(lambda f: self._done(name, f))
+        return future
+
+    def _done(self, name, future):
+        with self.lock:
+            if self.pending.get(name) is future:
+                del self.pending[name]
+
+    def get(self, name, px):
+        """Path of the smallest thumbnail at least `px` wide, or None if unavailable"""
+        px = next((size for size in self.sizes if size >= px), self.sizes[-1])
+        try:
+            st = os.stat(os.path.join(app.config['UPLOAD_FOLDER'], name))
+            path = self._paths(name, st)[px]
+            if not os.path.exists(path):
+                path = self.submit(name).result(timeout=app.config['THUMBNAIL_WAIT'])[px]
+        except Exception:
+            return None
+        with self.lock:
+            if path in self.lru:
+                self.lru.move_to_end(path)
+        return path
+
+def can_thumbnail(filename):
+    """Raster formats Pillow can downscale; SVG and ICO are served as-is"""
+    return is_image_file(filename) and not filename.lower().endswith(('.svg', '.ico'))
+
+thumbnails = ThumbnailCache(app.config['THUMBNAIL_FOLDER'], app.config['THUMBNAIL_SIZES'],
+                            app.config['THUMBNAIL_CACHE_BYTES'])
+
+def link_unique(src, filename):
+    """Hard-link src into UPLOAD_FOLDER under a free variant of filename"""
+    return name_allocator.claim(filename, lambda path: os.link(src, path))
+
+# Errors from link(2) that mean the filesystem has no hard links, as on FAT/exFAT
+NO_HARD_LINKS = {errno.EPERM, errno.EXDEV, errno.ENOTSUP, errno.EOPNOTSUPP}
+
+class BlobStore:
+    """Content-addressed storage for uploaded files
+
+    Each distinct content is stored once under .blobs/<hash[:2]>/<hash>, and
+    every shared name is a hard link to its blob, so downloads, listings and
+    previews work on plain files. A blob whose link count drops to one is no
+    longer shared under any name and is removed by the garbage collector.
+    On filesystems without hard links (FAT/exFAT) uploads are stored as
+    ordinary files and nothing is deduplicated.
+
+    Blobs, and so the shared names, are made read-only. Someone on the host
+    can still edit a shared file in place, which changes its blob too, so a
+    blob is checked before new uploads are linked to it: one whose size and
+    mtime no longer match its checksum record is hashed again, and replaced
+    by the new copy if its content has changed.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, digest):
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def has(self, digest, size=None):
+        """Whether the blob for digest is stored, of this size, and still holds that content"""
+        path = self.path(digest)
+        try:
+            st = os.stat(path)
+            if size is not None and st.st_size != size:
+                return False
+            return integrity.unchanged(digest, st) or file_digest(path) == digest
+        except OSError:
+            return False
+
+    def discard(self, digest):
+        """Remove a blob whose content no longer matches its name; its shared names keep it"""
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+    def commit(self, temp_path, digest, filename):
+        """Store a finished upload and share it as filename
+
+        Returns the saved name and whether the content was already stored.
+        Raises NameConflict, before anything is stored, if filename can't be used.
+        """
+        blob = self.path(digest)
+        name_allocator.prepare(filename)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        for _ in range(3):
+            try:
+                os.link(temp_path, blob)
+                existed = False
+            except FileExistsError:
+                existed = True
+            except OSError as e:
+                if e.errno not in NO_HARD_LINKS:
+                    raise
+                # No hard links here: reserve a name, then move the upload over it
+                name = name_allocator.claim(filename)
+                path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+                try:
+                    os.replace(temp_path, path)
+                except OSError:
+                    os.remove(path)
+                    raise
+                return name, False
+            if existed and not self.has(digest):
+                self.discard(digest)
+                continue
+            os.chmod(blob, 0o444)
+            try:
+                name = link_unique(blob, filename)
+            except FileNotFoundError:
+                # Collected between the two links; store our copy instead
+                continue
+            os.remove(temp_path)
+            return name, existed
+        raise OSError(f'Could not store blob {digest}')
+
+    def replace(self, temp_path, digest, filename):
+        """Store a finished upload and share it as filename, replacing the file there
+
+        The new link is renamed over the old one, so readers always find
+        either the old or the new version under the name.
+        """
+        blob = self.path(digest)
+        target = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        name_allocator.prepare(filename)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        link = temp_path + '.link'
+        for _ in range(3):
+            try:
+                os.link(temp_path, blob)
+            except FileExistsError:
+                if not self.has(digest):
+                    self.discard(digest)
+                    continue
+            except OSError as e:
+                if e.errno not in NO_HARD_LINKS:
+                    raise
+                os.replace(temp_path, target)
+                return
+            os.chmod(blob, 0o444)
+            try:
+                os.link(blob, link)
+            except FileNotFoundError:
+                # Collected between the two links; store our copy instead
+                continue
+            os.replace(link, target)
+            # rename(2) leaves both names when the target already links the blob
+            if os.path.exists(link):
+                os.remove(link)
+            os.remove(temp_path)
+            return
+        raise OSError(f'Could not store blob {digest}')
+
+    def share(self, digest, filename):
+        """Share existing content under a new name, or None if it isn't stored"""
+        try:
+            return link_unique(self.path(digest), filename)
+        except FileNotFoundError:
+            return None
+
+    def collect_garbage(self):
+        """Remove blobs that no shared name links to any more"""
+        removed = 0
+        for prefix in os.listdir(self.folder):
+            prefix_dir = os.path.join(self.folder, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for digest in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, digest)
+                try:
+                    st = os.stat(path)
+                    # Skip fresh blobs that are about to be linked
+                    if st.st_nlink == 1 and time.time() - st.st_ctime > 60:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        return removed
+
+    def start_collector(self):
+        def run():
+            while True:
+                try:
+                    self.collect_garbage()
+                except OSError:
+                    pass
+                time.sleep(app.config['BLOB_GC_INTERVAL'])
+        threading.Thread(target=run, name='blob-gc', daemon=True).start()
+
+blobs = BlobStore(app.config['BLOB_FOLDER'])
+
+def store_upload(stream, filename, expected=None):
+    """Stream an upload to disk, hashing as it goes, and store it as a blob
+
+    `expected` maps 'sha256' and/or 'content_hash' to the hex digests the
+    client computed; an upload that doesn't match is discarded with a
+    ValueError. Returns (saved_name, size, digest, sha256, deduplicated).
+    """
+    temp_path = os.path.join(app.config['UPLOAD_SESSION_FOLDER'], secrets.token_hex(16) + '.tmp')
+    hasher = ContentHasher(whole=True)
+    size = 0
+    try:
+        with open(temp_path, 'wb') as f:
+            while True:
+                data = stream.read(1024 * 1024)
+                if not data:
+                    break
+                hasher.update(data)
+                f.write(data)
+                size += len(data)
+        digest = hasher.hexdigest()
+        sha256 = hasher.whole.hexdigest()
+        check_digests(expected, {'content_hash': digest, 'sha256': sha256})
+        name, deduplicated = blobs.commit(temp_path, digest, filename)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return name, size, digest, sha256, deduplicated
+
+def check_digests(expected, actual):
+    """Raise ValueError if any digest the client sent differs from the one computed"""
+    for kind, value in (expected or {}).items():
+        if value.lower() != actual[kind]:
+            raise ValueError(f'Upload is corrupt: {kind} is {actual[kind]}, the client sent {value}')
+
+def upload_digests(form, index):
+    """Digests sent for the index-th file of a multipart upload
+
+    Clients may add `sha256` and `content_hash` fields, one per file in the
+    order of the files; an empty value skips that file.
+    """
+    expected = {}
+    for kind in ('sha256', 'content_hash'):
+        values = form.getlist(kind)
+        if index < len(values) and values[index].strip():
+            expected[kind] = values[index].strip()
+    return expected
+
+def parse_digest_header(value):
+    """SHA-256 from a Content-Digest (RFC 9530) or Digest (RFC 3230) header, as hex
+
+    Returns None if the header has no usable sha-256 value.
+    """
+    for item in value.split(','):
+        algorithm, _, encoded = item.strip().partition('=')
+        if algorithm.strip().lower() != 'sha-256':
+            continue
+        try:
+            raw = base64.b64decode(encoded.strip().strip(':'), validate=True)
+        except ValueError:
+            return None
+        return raw.hex() if len(raw) == 32 else None
+    return None
+
+def digest_headers(sha256):
+    """Repr-Digest (RFC 9530) and the older Digest (RFC 3230) header for a file's SHA-256"""
+    encoded = base64.b64encode(bytes.fromhex(sha256)).decode()
+    return {'Repr-Digest': f'sha-256=:{encoded}:', 'Digest': f'sha-256={encoded}'}
+
+# Delta sync (/sync): the server publishes a weak (Adler-32) and a strong
+# (BLAKE2b) checksum per block of a shared file, and the client answers with
+# a stream of ops that either copy a run of those blocks or carry new bytes.
+# Each op is a header (b'C', first block, block count) or (b'D', 0, length)
+# followed, for b'D', by that many literal bytes.
+SYNC_OP = struct.Struct('>cQI')
+ADLER_MOD = 65521
+sync_signatures = collections.OrderedDict()
+sync_signatures_lock = threading.Lock()
+
+def sync_block_size(size):
+    """rsync-style block size, about the square root of the file size"""
+    block = 1 << max(int(size ** 0.5).bit_length() - 1, 0)
+    return min(max(block, app.config['SYNC_MIN_BLOCK']), app.config['SYNC_MAX_BLOCK'])
+
+def strong_checksum(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def block_signature(f, block_size):
+    """Serialized block checksums of an open file, cached per file version and block size
+
+    Returns (signature, etag), both taken from the same open file.
+    """
+    st = os.fstat(f.fileno())
+    etag = file_etag(st)
+    key = (etag, block_size)
+    with sync_signatures_lock:
+        if key in sync_signatures:
+            sync_signatures.move_to_end(key)
+            return sync_signatures[key], etag
+    blocks = []
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        blocks.append([zlib.adler32(data), strong_checksum(data)])
+    signature = json.dumps({'size': st.st_size, 'block_size': block_size, 'blocks': blocks})
+    with sync_signatures_lock:
+        sync_signatures[key] = signature
+        while len(sync_signatures) > app.config['SYNC_SIGNATURE_CACHE']:
+            sync_signatures.popitem(last=False)
+    return signature, etag
+
+def read_exact(stream, size):
+    """Read exactly size bytes, or b'' at a clean end of stream"""
+    data = b''
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            if data:
+                raise ValueError('Delta ended inside an op header')
+            return b''
+        data += more
+    return data
+
+def apply_delta(stream, base_fd, base_size, block_size, out, hasher, max_size):
+    """Rebuild a file from a base file and a delta stream
+
+    Writes to out and hasher; returns (copied_bytes, literal_bytes). Raises
+    ValueError on a malformed delta or one that grows past max_size.
+    """
+    copied = literal = 0
+    while True:
+        header = read_exact(stream, SYNC_OP.size)
+        if not header:
+            return copied, literal
+        op, index, length = SYNC_OP.unpack(header)
+        if op == b'C':
+            start = index * block_size
+            end = min(start + length * block_size, base_size)
+            if base_fd is None or not length or start >= base_size:
+                raise ValueError('Delta copies past the end of the base file')
+            if copied + literal + end - start > max_size:
+                raise ValueError('Delta is larger than the declared size')
+            while start < end:
+                data = os.pread(base_fd, min(1024 * 1024, end - start), start)
+                if not data:
+                    raise ValueError('Base file shrank during sync')
+                out.write(data)
+                hasher.update(data)
+                start += len(data)
+                copied += len(data)
+        elif op == b'D':
+            if copied + literal + length > max_size:
+                raise ValueError('Delta is larger than the declared size')
+            while length:
+                data = stream.read(min(1024 * 1024, length))
+                if not data:
+                    raise ValueError('Delta ended inside literal data')
+                out.write(data)
+                hasher.update(data)
+                length -= len(data)
+                literal += len(data)
+        else:
+            raise ValueError('Unknown delta op')
+
+def compute_delta(f, signature, max_scan=None):
+    """Yield the delta that turns the signed file into the contents of f
+
+    Blocks are first looked for at the current position, which finds
+    unchanged and overwritten regions at C speed. After a miss the weak
+    checksum is rolled a byte at a time, as rsync does, to find data that
+    has shifted. Rolling is pure Python, so after max_scan bytes without a
+    match the search only probes one block width in every max_scan bytes;
+    data shifted by a very large insertion is then found a little later.
+    """
+    block_size = signature['block_size']
+    max_scan = max_scan or app.config['SYNC_MAX_SCAN']
+    weak = {}
+    for i, (adler, strong) in enumerate(signature['blocks']):
+        weak.setdefault(adler, {}).setdefault(strong, i)
+    last_block = len(signature['blocks']) - 1
+    last_length = signature['size'] - last_block * block_size
+
+    def lookup(window, adler):
+        candidates = weak.get(adler)
+        if candidates is None:
+            return None
+        strong = strong_checksum(window)
+        i = candidates.get(strong)
+        # Prefer the block that continues the current run, as rsync does
+        if run and i is not None and run[0] + run[1] <= last_block and \
+                signature['blocks'][run[0] + run[1]] == [adler, strong]:
+            i = run[0] + run[1]
+        # Only the final block may be short
+        if i is not None and len(window) != block_size and not (i == last_block and len(window) == last_length):
+            return None
+        return i
+
+    buf = bytearray()
+    eof = False
+    pos = literal_start = 0
+    run = None  # [first block, count] of the pending copy
+    scanned = 0
+
+    def flush_literal(end):
+        if end > literal_start:
+            yield SYNC_OP.pack(b'D', 0, end - literal_start) + bytes(buf[literal_start:end])
+
+    while True:
+        if not eof and len(buf) - pos < 2 * block_size:
+            # Drop what has been sent, then top the buffer up
+            keep = min(pos, literal_start)
+            del buf[:keep]
+            pos -= keep
+            literal_start -= keep
+            data = f.read(max(1024 * 1024, block_size * 4))
+            eof = not data
+            buf += data
+            continue
+        if pos >= len(buf):
+            break
+        window = bytes(buf[pos:pos + block_size])
+        i = lookup(window, zlib.adler32(window))
+        rolling = scanned < max_scan or scanned % max_scan < block_size
+        if i is None and weak and len(window) == block_size and rolling:
+            # Roll the weak checksum through the next block width
+            adler = zlib.adler32(window)
+            a, b = adler & 0xffff, adler >> 16
+            for offset in range(pos, min(pos + block_size, len(buf) - block_size)):
+                out_byte, in_byte = buf[offset], buf[offset + block_size]
+                a = (a - out_byte + in_byte) % ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                candidate = (b << 16) | a
+                if candidate in weak:
+                    window = bytes(buf[offset + 1:offset + 1 + block_size])
+                    i = lookup(window, candidate)
+                    if i is not None:
+                        scanned += offset + 1 - pos
+                        pos = offset + 1
+                        break
+        if i is None:
+            step = min(block_size, len(buf) - pos)
+            pos += step
+            scanned += step
+            if pos - literal_start >= 4 * 1024 * 1024:
+                if run:
+                    yield SYNC_OP.pack(b'C', run[0], run[1])
+                    run = None
+                yield from flush_literal(pos)
+                literal_start = pos
+            continue
+        scanned = 0
+        if pos > literal_start:
+            if run:
+                yield SYNC_OP.pack(b'C', run[0], run[1])
+                run = None
+            yield from flush_literal(pos)
+        if run and run[0] + run[1] == i:
+            run[1] += 1
+        else:
+            if run:
+                yield SYNC_OP.pack(b'C', run[0], run[1])
+            run = [i, 1]
+        pos += len(window)
+        literal_start = pos
+    if run:
+        yield SYNC_OP.pack(b'C', run[0], run[1])
+    yield from flush_literal(len(buf))
+
+# Leading bytes of common formats, for files whose extension says nothing
+MAGIC_NUMBERS = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\x1f\x8b', 'application/gzip'),
+    (b'\x28\xb5\x2f\xfd', 'application/zstd'),
+    (b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (b'ID3', 'audio/mpeg'),
+    (b'OggS', 'audio/ogg'),
+    (b'fLaC', 'audio/flac'),
+    (b'\x1aE\xdf\xa3', 'video/webm'),
+    (b'\x7fELF', 'application/x-executable'),
+]
+
+def sniff_mimetype(path):
+    """Guess a file's MIME type from its first bytes, or None"""
+    with open(path, 'rb') as f:
+        head = f.read(512)
+    for magic, mimetype in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mimetype
+    if head[:4] == b'RIFF' and head[8:12] in (b'WEBP', b'WAVE', b'AVI '):
+        return {b'WEBP': 'image/webp', b'WAVE': 'audio/wav', b'AVI ': 'video/x-msvideo'}[head[8:12]]
+    if head[4:8] == b'ftyp':
+        return 'video/mp4'
+    if head and b'\0' not in head:
+        try:
+            head.decode('utf-8')
+            return 'text/plain'
+        except UnicodeDecodeError:
+            pass
+    return None
+
+class UploadPipeline:
+    """Bounded queue of post-upload work run by a small pool of threads
+
+    Upload requests only stream bytes to disk and queue a job; the workers
+    then update the catalog, record the content hash and sniff the type of
+    files without a known extension. Thumbnails and compressed variants are
+    handed to their own pools and timed as they finish, so a slow one
+    doesn't hold up the queue. When the queue is full, new uploads are
+    refused with 503 and a Retry-After estimated from recent job times.
+    """
+
+    STAGES = ('queued', 'catalog', 'checksum', 'sniff', 'thumbnail', 'compress')
+
+    def __init__(self, workers, capacity):
+        self.jobs = queue.Queue(maxsize=capacity)
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.active = 0
+        self.rejected = 0
+        self.completed = 0
+        self.job_seconds = 0.0
+        self.stats = {stage: {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+                      for stage in self.STAGES}
+        self.content_types = {}  # name -> sniffed MIME type
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f'postprocess-{i}', daemon=True).start()
+
+    def busy(self):
+        return self.jobs.full()
+
+    def retry_after(self):
+        """Seconds until the queue should have room again"""
+        with self.lock:
+            average = self.job_seconds / self.completed if self.completed else 1
+        return max(1, min(60, round(self.jobs.qsize() * average / self.workers)))
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+        return self.retry_after()
+
+    def submit(self, name, digest=None):
+        """Queue post-processing of a saved upload; blocks while the queue is full"""
+        self.jobs.put((name, digest, time.monotonic()))
+
+    def _record(self, stage, seconds, failed=False):
+        with self.lock:
+            stats = self.stats[stage]
+            stats['count'] += 1
+            stats['errors'] += failed
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def _stage(self, stage, func, *args):
+        started = time.monotonic()
+        try:
+            func(*args)
+        except Exception:
+            self._record(stage, time.monotonic() - started, True)
+        else:
+            self._record(stage, time.monotonic() - started)
+
+    def _hand_off(self, stage, submit, name):
+        """Queue work on another pool and time it from its completion, without waiting for it"""
+        started = time.monotonic()
+        try:
+            future = submit(name)
+        except Exception:
+            self._record(stage, time.monotonic() - started, True)
+            return
+        future.add_done_callback(lambda f: self._record(
+            stage, time.monotonic() - started, f.cancelled() or f.exception() is not None))
+
+    def _run(self):
+        while True:
+            name, digest, queued = self.jobs.get()
+            started = time.monotonic()
+            self._record('queued', started - queued)
+            with self.lock:
+                self.active += 1
+            try:
+                self.process(name, digest)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.completed += 1
+                    self.job_seconds += time.monotonic() - started
+
+    def process(self, name, digest):
+        path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+        self._stage('catalog', catalog.refresh, name)
+        if digest and can_thumbnail(name):
+            self._stage('checksum', lambda: thumbnails.remember(name, os.stat(path), digest))
+        if mimetypes.guess_type(name)[0] is None:
+            self._stage('sniff', self._sniff, name, path)
+        if can_thumbnail(name):
+            self._hand_off('thumbnail', thumbnails.submit, name)
+        if is_compressible(name):
+            self._hand_off('compress', variants.submit, name)
+
+    def _sniff(self, name, path):
+        mimetype = sniff_mimetype(path)
+        if mimetype:
+            with self.lock:
+                self.content_types[name] = mimetype
+
+    def content_type(self, name):
+        """MIME type of a shared file from its extension, or else from its content"""
+        return mimetypes.guess_type(name)[0] or self.content_types.get(name)
+
+    def status(self):
+        with self.lock:
+            return {
+                'queue_depth': self.jobs.qsize(),
+                'capacity': self.jobs.maxsize,
+                'workers': self.workers,
+                'active': self.active,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'stages': {
+                    stage: {
+                        'count': stats['count'],
+                        'errors': stats['errors'],
+                        'avg_ms': round(stats['seconds'] / stats['count'] * 1000, 2) if stats['count'] else None,
+                        'max_ms': round(stats['max_seconds'] * 1000, 2),
+                    } for stage, stats in self.stats.items()
+                }
+            }
+
+pipeline = UploadPipeline(app.config['POSTPROCESS_WORKERS'], app.config['POSTPROCESS_QUEUE'])
+
+def finish_upload(filename, digest=None, client=None, sha256=None):
+    """Record who uploaded a newly saved file, and its checksums, and queue its post-processing"""
+    storage.record_upload(filename, client)
+    if digest:
+        integrity.record(filename, digest, sha256)
+    pipeline.submit(filename, digest)
+
+def pipeline_busy():
+    """A 503 response telling the client when to retry, or None if uploads are accepted"""
+    if not pipeline.busy():
+        return None
+    retry_after = pipeline.reject()
+    return (jsonify({'error': 'Server is busy processing uploads, try again shortly',
+                     'retry_after': retry_after}),
+            503, {'Retry-After': str(retry_after)})
+
+class StorageManager:
+    """Quotas and retention for the shared folder
+
+    Uploads are checked against the total and per-device quotas and the
+    free disk space before their body is read, using Content-Length or the
+    size declared for a chunked session, so a full disk is reported up
+    front instead of halfway through. Open upload sessions count against
+    the quotas for their declared size.
+
+    A background sweeper deletes files past RETENTION_MAX_AGE since upload
+    or RETENTION_MAX_IDLE since their last download and, with
+    RETENTION_EVICT_LRU, the least recently downloaded files while over
+    quota. It works from the catalog and a small JSON index of upload
+    times, uploaders and last downloads, never from directory walks.
+    Deleted names free disk space once the blob collector drops content
+    no other name links to.
+    """
+
+    def __init__(self, folder, index_path):
+        self.folder = folder
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.deleted = collections.Counter()  # reason -> files deleted
+        try:
+            with open(index_path) as f:
+                self.files = json.load(f)  # name -> {uploaded, accessed, client}
+        except (OSError, ValueError):
+            self.files = {}
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            state = json.dumps(self.files)
+            self.dirty = False
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(state)
+        os.replace(tmp_path, self.index_path)
+
+    def record_upload(self, name, client):
+        with self.lock:
+            self.files[name] = {'uploaded': time.time(), 'accessed': None, 'client': client}
+            self.dirty = True
+
+    def touch(self, name):
+        """Note a download; saved with the next sweep"""
+        if catalog.get(name) is None:
+            return
+        with self.lock:
+            info = self.files.get(name)
+            if info is None:
+                info = self.files[name] = {'uploaded': None, 'accessed': None, 'client': None}
+            info['accessed'] = time.time()
+            self.dirty = True
+
+    def reserved(self, client=None):
+        """Bytes declared by unfinished chunked uploads"""
+        with upload_sessions_lock:
+            sessions = list(upload_sessions.values())
+        return sum(s['size'] for s in sessions if client is None or s.get('client') == client)
+
+    def used(self):
+        return catalog.totals()[1] + self.reserved()
+
+    def client_used(self, client):
+        with self.lock:
+            names = [name for name, info in self.files.items() if info['client'] == client]
+        entries = (catalog.get(name) for name in names)
+        return sum(e['size'] for e in entries if e) + self.reserved(client)
+
+    def check(self, incoming, client, disk=True):
+        """None if an upload of `incoming` bytes fits, else (error, status)
+
+        Pass disk=False when the upload won't write new bytes, as for
+        content that is already stored. With RETENTION_EVICT_LRU, files
+        are evicted only for an upload that passes every other check and
+        that eviction can make room for, and only as many as it needs.
+        """
+        client_quota = app.config['CLIENT_QUOTA_BYTES']
+        if client_quota is not None:
+            used = self.client_used(client)
+            if used + incoming > client_quota:
+                return {'error': 'Upload quota for this device exceeded',
+                        'quota': client_quota, 'used': used}, 507
+        quota = app.config['STORAGE_QUOTA_BYTES']
+        over = 0
+        if quota is not None:
+            used = self.used()
+            over = used + incoming - quota
+            # Only shared files can be evicted, not space held by open upload sessions
+            evictable = catalog.totals()[1] if app.config['RETENTION_EVICT_LRU'] else 0
+            if over > evictable:
+                return {'error': 'Storage quota exceeded', 'quota': quota, 'used': used}, 507
+        if disk:
+            free = shutil.disk_usage(self.folder).free
+            if free - incoming < app.config['STORAGE_MIN_FREE_BYTES']:
+                return {'error': 'Not enough free disk space for this upload', 'free': free}, 507
+        if over > 0:
+            self.evict(over)
+            over = self.used() + incoming - quota
+            if over > 0:
+                return {'error': 'Storage quota exceeded', 'quota': quota, 'used': self.used()}, 507
+        return None
+
+    def delete(self, name, reason):
+        try:
+            os.remove(os.path.join(self.folder, name))
+        except FileNotFoundError:
+            pass
+        catalog.refresh(name)
+        with self.lock:
+            self.files.pop(name, None)
+            self.dirty = True
+            self.deleted[reason] += 1
+
+    def last_used(self, entry):
+        info = self.files.get(entry['name']) or {}
+        return info.get('accessed') or info.get('uploaded') or entry['mtime']
+
+    def evict(self, needed):
+        """Delete least recently downloaded files until `needed` bytes are freed"""
+        with self.lock:
+            entries = sorted(catalog.snapshot(), key=self.last_used)
+        freed = 0
+        for entry in entries:
+            if freed >= needed:
+                break
+            self.delete(entry['name'], 'lru')
+            freed += entry['size']
+        return freed
+
+    def sweep(self):
+        """Apply the retention rules once"""
+        now = time.time()
+        max_age = app.config['RETENTION_MAX_AGE']
+        max_idle = app.config['RETENTION_MAX_IDLE']
+        entries = catalog.snapshot()
+        for entry in entries:
+            with self.lock:
+                info = self.files.get(entry['name']) or {}
+                last_used = self.last_used(entry)
+            if max_age is not None and now - (info.get('uploaded') or entry['mtime']) > max_age:
+                self.delete(entry['name'], 'age')
+            elif max_idle is not None and now - last_used > max_idle:
+                self.delete(entry['name'], 'idle')
+
+        quota = app.config['STORAGE_QUOTA_BYTES']
+        if quota is not None and app.config['RETENTION_EVICT_LRU'] and self.used() > quota:
+            self.evict(self.used() - quota)
+
+        names = {entry['name'] for entry in catalog.snapshot()}
+        with self.lock:
+            for name in self.files.keys() - names:
+                del self.files[name]
+                self.dirty = True
+        self.expire_sessions(now)
+        self.save()
+
+    def expire_sessions(self, now):
+        """Drop unfinished uploads nobody has sent a chunk to for UPLOAD_SESSION_MAX_IDLE"""
+        folder = app.config['UPLOAD_SESSION_FOLDER']
+        for item in os.listdir(folder):
+            session_id, ext = os.path.splitext(item)
+            if ext != '.json' or not SESSION_ID_RE.match(session_id):
+                continue
+            try:
+                if now - os.stat(os.path.join(folder, item)).st_mtime < app.config['UPLOAD_SESSION_MAX_IDLE']:
+                    continue
+            except OSError:
+                continue
+            with upload_sessions_lock:
+                upload_sessions.pop(session_id, None)
+            for path in session_paths(session_id):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def status(self, client):
+        return {
+            'used': self.used(),
+            'quota': app.config['STORAGE_QUOTA_BYTES'],
+            'client_used': self.client_used(client),
+            'client_quota': app.config['CLIENT_QUOTA_BYTES'],
+            'reserved': self.reserved(),
+            'disk_free': shutil.disk_usage(self.folder).free,
+            'retention': {
+                'max_age': app.config['RETENTION_MAX_AGE'],
+                'max_idle': app.config['RETENTION_MAX_IDLE'],
+                'evict_lru': app.config['RETENTION_EVICT_LRU'],
+            },
+            'deleted': dict(self.deleted),
+        }
+
+    def start_sweeper(self):
+        def run():
+            while True:
+                time.sleep(app.config['RETENTION_SWEEP_INTERVAL'])
+                try:
+                    self.sweep()
+                except OSError:
+                    pass
+        threading.Thread(target=run, name='retention', daemon=True).start()
+
+storage = StorageManager(app.config['UPLOAD_FOLDER'],
+                         os.path.join(app.config['STATE_FOLDER'], 'storage.json'))
+
+class IntegrityScrubber:
+    """Checksums of the shared files and a background scrubber that re-checks them
+
+    Every upload is stored with its content hash (see ContentHasher) and
+    its plain SHA-256, and downloads advertise the SHA-256 in Repr-Digest
+    and Digest headers. Both are computed while the upload streams to disk
+    when the bytes arrive in order. Chunked uploads arrive out of order, so
+    their SHA-256 comes from one sequential read of the finished .part file
+    at /complete, normally from the page cache as the chunks were just
+    written; a session resumed long after its chunks were sent is read
+    from disk. Files added to the folder by other means get theirs from the
+    scrubber's first read.
+
+    The scrubber re-reads the shared files at no more than SCRUB_RATE
+    bytes/s, once per SCRUB_INTERVAL, least recently verified first, and
+    reports files whose bytes no longer match their checksums. Hard links
+    to the same blob are read once. Files changed through other means
+    (their size or mtime differs from the record) are taken as they are
+    now. A damaged blob is dropped from the blob store so a new upload of
+    the same content is stored again rather than linked to the bad copy.
+    """
+
+    def __init__(self, folder, index_path):
+        self.folder = folder
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.dirty = False
+        self.corrupt = {}  # name -> {content_hash, found, detected}
+        self.current = None
+        self.bytes_read = 0
+        self.verified = 0
+        try:
+            with open(index_path) as f:
+                state = json.load(f)
+            # name -> [size, mtime_ns, content_hash, sha256, verified]
+            self.files = state['files']
+            self.last_pass = state['last_pass']
+        except (OSError, ValueError, KeyError):
+            self.files = {}
+            self.last_pass = 0
+        self.sha256 = {record[2]: record[3] for record in self.files.values() if record[3]}
+        # content hash -> [size, mtime_ns] of the stored file, to tell if a blob was edited
+        self.stats = {record[2]: record[:2] for record in self.files.values()}
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            state = json.dumps({'files': self.files, 'last_pass': self.last_pass})
+            self.dirty = False
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(state)
+        os.replace(tmp_path, self.index_path)
+
+    def record(self, name, content_hash, sha256=None):
+        """Store the checksums of a newly saved file"""
+        try:
+            st = os.stat(os.path.join(self.folder, name))
+        except OSError:
+            return
+        with self.lock:
+            # Deduplicated uploads share the SHA-256 of the stored content
+            sha256 = sha256 or self.sha256.get(content_hash)
+            self.files[name] = [st.st_size, st.st_mtime_ns, content_hash, sha256, None]
+            self.stats[content_hash] = [st.st_size, st.st_mtime_ns]
+            if sha256:
+                self.sha256[content_hash] = sha256
+            self.corrupt.pop(name, None)
+            self.dirty = True
+        if sha256 is None:
+            self.wakeup.set()
+
+    def known_sha256(self, content_hash):
+        """SHA-256 on record for content already stored, or None"""
+        with self.lock:
+            return self.sha256.get(content_hash)
+
+    def unchanged(self, content_hash, st):
+        """Whether st has the size and mtime recorded for a file holding content_hash"""
+        with self.lock:
+            return self.stats.get(content_hash) == [st.st_size, st.st_mtime_ns]
+
+    def digest(self, name, st):
+        """SHA-256 of a file if it is unchanged since it was recorded, else None"""
+        with self.lock:
+            record = self.files.get(name)
+        if record and record[0] == st.st_size and record[1] == st.st_mtime_ns:
+            return record[3]
+        return None
+
+    def read(self, path):
+        """Hash a file at SCRUB_RATE; returns (stat, content hash, sha256)
+
+        Cached pages are dropped first so the bytes come from the disk, and
+        again afterwards so a pass doesn't push hot files out of the cache.
+        """
+        rate = app.config['SCRUB_RATE']
+        hasher = ContentHasher(whole=True)
+        started = time.monotonic()
+        done = 0
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                hasher.update(data)
+                done += len(data)
+                self.bytes_read += len(data)
+                ahead = done / rate - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        return st, hasher.hexdigest(), hasher.whole.hexdigest()
+
+    def verify(self, name, seen):
+        """Re-hash one file and compare it with its record
+
+        `seen` maps (device, inode) to the checksums already read this pass.
+        """
+        path = os.path.join(self.folder, name)
+        try:
+            st = os.stat(path)
+            key = (st.st_dev, st.st_ino)
+            if key in seen:
+                content_hash, sha256 = seen[key]
+            else:
+                self.current = name
+                st, content_hash, sha256 = self.read(path)
+                after = os.stat(path)
+                if (after.st_ino, after.st_size, after.st_mtime_ns) != (st.st_ino, st.st_size, st.st_mtime_ns):
+                    return  # Changed while it was read; checked again next time
+                seen[key] = content_hash, sha256
+        except OSError:
+            return
+        finally:
+            self.current = None
+
+        with self.lock:
+            record = self.files.get(name)
+            if record and record[0] == st.st_size and record[1] == st.st_mtime_ns:
+                if record[2] != content_hash or (record[3] and record[3] != sha256):
+                    if name not in self.corrupt:
+                        app.logger.error('Integrity check failed for %s: content hash %s, expected %s',
+                                         name, content_hash, record[2])
+                    self.corrupt[name] = {'content_hash': record[2], 'found': content_hash,
+                                          'detected': time.time()}
+                    self.stats.pop(record[2], None)
+                    self.drop_blob(record[2], st)
+                    return
+                record[3] = sha256
+                record[4] = time.time()
+            else:
+                self.files[name] = [st.st_size, st.st_mtime_ns, content_hash, sha256, time.time()]
+            self.sha256[content_hash] = sha256
+            self.stats[content_hash] = [st.st_size, st.st_mtime_ns]
+            self.corrupt.pop(name, None)
+            self.verified += 1
+            self.dirty = True
+
+    def drop_blob(self, content_hash, st):
+        """Remove a damaged blob so new uploads of its content don't link to it"""
+        path = blobs.path(content_hash)
+        try:
+            if os.stat(path).st_ino == st.st_ino:
+                os.remove(path)
+        except OSError:
+            pass
+
+    def pending(self):
+        """Files whose SHA-256 is not known yet, as left by chunked uploads"""
+        with self.lock:
+            return [name for name, record in self.files.items() if record[3] is None]
+
+    def scrub(self):
+        """Hash pending files and, once per SCRUB_INTERVAL, re-verify every file"""
+        seen = {}
+        for name in self.pending():
+            self.verify(name, seen)
+        if time.time() - self.last_pass < app.config['SCRUB_INTERVAL']:
+            return
+        names = catalog.names()
+        with self.lock:
+            names.sort(key=lambda name: (self.files.get(name) or [0] * 5)[4] or 0)
+        for name in names:
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+                for pending in self.pending():
+                    self.verify(pending, seen)
+            self.verify(name, seen)
+        current = set(names)
+        with self.lock:
+            for name in [name for name in self.files if name not in current]:
+                del self.files[name]
+                self.corrupt.pop(name, None)
+            self.last_pass = time.time()
+            self.dirty = True
+
+    def status(self):
+        with self.lock:
+            files = len(self.files)
+            pending = sum(1 for record in self.files.values() if record[3] is None)
+            corrupt = [dict(info, name=name) for name, info in sorted(self.corrupt.items())]
+        return {
+            'rate': app.config['SCRUB_RATE'],
+            'interval': app.config['SCRUB_INTERVAL'],
+            'files': files,
+            'pending': pending,
+            'verified': self.verified,
+            'bytes_read': self.bytes_read,
+            'last_pass': self.last_pass or None,
+            'scanning': self.current,
+            'corrupt': corrupt,
+        }
+
+    def start_scrubber(self):
+        def run():
+            while True:
+                try:
+                    if app.config['SCRUB_RATE']:
+                        self.scrub()
+                    self.save()
+                except Exception:
+                    app.logger.exception('Integrity scrub failed')
+                self.wakeup.wait(60)
+                self.wakeup.clear()
+        threading.Thread(target=run, name='integrity-scrub', daemon=True).start()
+
+integrity = IntegrityScrubber(app.config['UPLOAD_FOLDER'],
+                              os.path.join(app.config['STATE_FOLDER'], 'integrity.json'))
+
+def storage_full(incoming, client, disk=True):
+    """A 507 response if an upload of `incoming` bytes doesn't fit, or None"""
+    error = storage.check(incoming, client, disk)
+    return (jsonify(error[0]), error[1]) if error else None
+
+SEARCH_TEXT_EXTENSIONS = {'txt', 'csv', 'tsv', 'json', 'md', 'log'}
+# EXIF tags worth searching for, from the main IFD and the Exif sub-IFD
+SEARCH_EXIF_TAGS = ('Make', 'Model', 'LensModel', 'DateTimeOriginal', 'DateTime', 'Software',
+                    'Artist', 'ImageDescription', 'Copyright')
+SEARCH_SORTS = {
+    'relevance': 'rank',
+    'name': 'f.name COLLATE NOCASE',
+    'size': 'f.size',
+    'mtime': 'f.mtime',
+}
+
+class SearchIndex:
+    """Persistent SQLite FTS5 index of names, image metadata and text content
+
+    The index lives in STATE_FOLDER/search.db and follows the catalog: a
+    background thread subscribes to catalog events and re-indexes only the
+    files that were added, changed or renamed, in batches of one
+    transaction. A resync (or a restart) reconciles the index with the
+    catalog by size and mtime, so only files that changed meanwhile are read
+    again. Queries never touch the shared folder.
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.indexed = 0
+
+    def create(self):
+        """Create the tables, dropping those left by an older schema"""
+        conn = self.connect()
+        if conn.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            conn.executescript('DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS files_fts;')
+        conn.executescript(f'''
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                name TEXT UNIQUE NOT NULL,
+                ext TEXT NOT NULL,
+                type TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                exif TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_ext ON files (ext);
+            CREATE INDEX IF NOT EXISTS files_size ON files (size);
+            CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime);
+            CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+                name, meta, body, tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            );
+            PRAGMA user_version = {self.SCHEMA_VERSION};
+        ''')
+
+    def connect(self):
+        """This thread's connection; WAL lets searches run while the indexer writes"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def _exif(self, path):
+        """Searchable EXIF fields and dimensions of an image, or {}"""
+        try:
+            with Image.open(path) as img:
+                exif = img.getexif()
+                info = {'width': img.width, 'height': img.height}
+                tags = dict(exif)
+                tags.update(exif.get_ifd(0x8769))  # Exif sub-IFD
+        except Exception:
+            return {}
+        for tag, value in tags.items():
+            name = ExifTags.TAGS.get(tag)
+            if name in SEARCH_EXIF_TAGS and isinstance(value, (str, bytes)):
+                if isinstance(value, bytes):
+                    value = value.decode('utf-8', 'replace')
+                value = value.strip('\0 ')
+                if value:
+                    info[name] = value
+        return info
+
+    def _text(self, path, ext):
+        """Leading text of a text file, up to SEARCH_TEXT_BYTES"""
+        if ext not in SEARCH_TEXT_EXTENSIONS:
+            return ''
+        try:
+            with open(path, 'rb') as f:
+                return f.read(app.config['SEARCH_TEXT_BYTES']).decode('utf-8', 'replace')
+        except OSError:
+            return ''
+
+    def _store(self, conn, entry):
+        name = entry['name']
+        path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+        ext = os.path.splitext(name)[1][1:].lower()
+        exif = self._exif(path) if entry['is_image'] else {}
+        meta = ' '.join(str(v) for k, v in exif.items() if k not in ('width', 'height'))
+        row = conn.execute('SELECT id FROM files WHERE name = ?', (name,)).fetchone()
+        values = (ext, entry['type'], entry['size'], entry['mtime'], json.dumps(exif))
+        if row:
+            conn.execute('UPDATE files SET ext = ?, type = ?, size = ?, mtime = ?, exif = ? WHERE id = ?',
+                         values + (row[0],))
+            conn.execute('DELETE FROM files_fts WHERE rowid = ?', (row[0],))
+            rowid = row[0]
+        else:
+            rowid = conn.execute('INSERT INTO files (name, ext, type, size, mtime, exif) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)', (name,) + values).lastrowid
+        conn.execute('INSERT INTO files_fts (rowid, name, meta, body) VALUES (?, ?, ?, ?)',
+                     (rowid, name, meta, self._text(path, ext)))
+        self.indexed += 1
+
+    def _remove(self, conn, name):
+        row = conn.execute('SELECT id FROM files WHERE name = ?', (name,)).fetchone()
+        if row:
+            conn.execute('DELETE FROM files_fts WHERE rowid = ?', (row[0],))
+            conn.execute('DELETE FROM files WHERE id = ?', (row[0],))
+
+    def reconcile(self):
+        """Bring the index in line with the catalog, reading only changed files"""
+        conn = self.connect()
+        indexed = {name: (size, mtime) for name, size, mtime in
+                   conn.execute('SELECT name, size, mtime FROM files')}
+        entries = {e['name']: e for e in catalog.snapshot()}
+        with conn:
+            for name in indexed.keys() - entries.keys():
+                self._remove(conn, name)
+            for name, entry in entries.items():
+                if indexed.get(name) != (entry['size'], entry['mtime']):
+                    self._store(conn, entry)
+
+    def apply(self, events):
+        """Apply a batch of catalog events in one transaction"""
+        if any(event['type'] == 'resync' for event in events):
+            self.reconcile()
+            return
+        conn = self.connect()
+        with conn:
+            for event in events:
+                if event['type'] == 'remove':
+                    self._remove(conn, event['file']['name'])
+                    continue
+                if event['type'] == 'rename':
+                    self._remove(conn, event['old_name'])
+                # The entry may be stale by now; index what the catalog has
+                entry = catalog.get(event['file']['name'])
+                if entry is None:
+                    self._remove(conn, event['file']['name'])
+                else:
+                    self._store(conn, entry)
+
+    def search(self, text='', ext=(), file_type='', min_size=None, max_size=None,
+               after=None, before=None, sort=None, descending=False, limit=50, offset=0):
+        """Return (names with snippets and EXIF, total matches)"""
+        terms = re.findall(r'\w+', text)
+        clauses = []
+        params = []
+        if terms:
+            # Every term must match, as a prefix, in any column
+            clauses.append('files_fts MATCH ?')
+            params.append(' '.join(f'"{term}"*' for term in terms))
+        if ext:
+            clauses.append(f"f.ext IN ({', '.join('?' * len(ext))})")
+            params.extend(ext)
+        for clause, value in (('f.type = ?', file_type or None), ('f.size >= ?', min_size),
+                              ('f.size <= ?', max_size), ('f.mtime >= ?', after),
+                              ('f.mtime < ?', before)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = ' AND '.join(clauses) or '1'
+        sort = sort or ('relevance' if terms else 'mtime')
+        if sort == 'relevance' and not terms:
+            sort = 'mtime'
+        order = SEARCH_SORTS[sort] + (' DESC' if descending else '')
+        snippet = "snippet(files_fts, 2, '[', ']', '…', 12)" if terms else "''"
+        # Metadata-only queries stay on the indexed files table
+        source = 'files_fts JOIN files f ON f.id = files_fts.rowid' if terms else 'files f'
+        conn = self.connect()
+        rows = conn.execute(
+            f'SELECT f.name, f.exif, {snippet} FROM {source} '
+            f'WHERE {where} ORDER BY {order}, f.name LIMIT ? OFFSET ?',
+            params + [limit, offset]).fetchall()
+        total = conn.execute(f'SELECT COUNT(*) FROM {source} WHERE {where}', params).fetchone()[0]
+        return [{'name': name, 'exif': json.loads(exif), 'snippet': snip} for name, exif, snip in rows], total
+
+    def status(self):
+        conn = self.connect()
+        return {'files': conn.execute('SELECT COUNT(*) FROM files').fetchone()[0],
+                'indexed_since_start': self.indexed}
+
+    def start(self):
+        """Index what changed while we were down, then follow the catalog"""
+        self.create()
+        events = catalog.subscribe()
+
+        def run():
+            try:
+                self.reconcile()
+            except sqlite3.Error:
+                app.logger.exception('Search index reconcile failed')
+            while True:
+                batch = [events.get()]
+                while len(batch) < 500:
+                    try:
+                        batch.append(events.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    self.apply(batch)
+                except sqlite3.Error:
+                    app.logger.exception('Search index update failed')
+
+        threading.Thread(target=run, name='search-index', daemon=True).start()
+
+search_index = SearchIndex(os.path.join(app.config['STATE_FOLDER'], 'search.db'))
+
+def file_etag(st):
+    """Strong validator that changes whenever the file is replaced or modified"""
+    return f'{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}'
+
+def resolve_ranges(range_header, size):
+    """Turn a Range header into sorted, merged (start, stop) byte spans
+
+    Returns None if the header should be ignored and [] if no range is
+    satisfiable. Unlike Werkzeug's parser this accepts overlapping and
+    out-of-order ranges, which segmented downloaders do send.
+    """
+    if not range_header or size == 0:
+        return None
+    units, _, spec = range_header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+    spans = []
+    for part in spec.split(','):
+        first, dash, last = part.strip().partition('-')
+        if not dash or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            start, stop = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            stop = size if not last else min(int(last) + 1, size)
+            if last and int(last) < start:
+                return None
+        if start < stop:
+            spans.append((start, stop))
+    spans.sort()
+    merged = []
+    for start, stop in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    if len(merged) > app.config['MAX_RANGES']:
+        return None
+    return merged
+
+def read_span(f, start, stop):
+    """Yield the bytes of f between start and stop in bounded blocks"""
+    f.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        data = f.read(min(app.config['SEND_BLOCK_SIZE'], remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+def plan_file_response(f, req, mimetype, download_name=None, max_age=0, headers=None, compress=None):
+    """Work out the status, headers and body layout for sending an open file
+
+    Handles If-None-Match, If-Modified-Since, If-Match, If-Range and single
+    or multiple byte ranges. `req` is any Werkzeug request. Returns the
+    response without a body plus a plan: a list whose items are either
+    bytes to send as-is or (start, stop) spans of the file, or None when
+    there is no body (304, 412, 416). Shared by the WSGI and ASGI servers.
+
+    With `compress`, the body will be compressed on the fly with that
+    content coding: the response gets its own ETag, no Content-Length and
+    Range is ignored.
+    """
+    st = os.fstat(f.fileno())
+    size = st.st_size
+    etag = file_etag(st)
+    if compress:
+        etag = f'{etag}-{compress}'
+
+    response = Response(mimetype=mimetype, headers=headers)
+    response.set_etag(etag)
+    response.last_modified = int(st.st_mtime)
+    if compress:
+        response.headers['Content-Encoding'] = compress
+    else:
+        response.accept_ranges = 'bytes'
+    if max_age:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    if download_name:
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+
+    if req.if_match and not req.if_match.contains(etag):
+        response.status_code = 412
+        return response, None
+    if not is_resource_modified(req.environ, etag, last_modified=response.last_modified):
+        response.status_code = 304
+        return response, None
+
+    # A Range with a stale If-Range validator gets the whole file
+    if_range = req.if_range
+    range_valid = (
+        (if_range.etag is None and if_range.date is None)
+        or if_range.etag == etag
+        or (if_range.date is not None and response.last_modified <= if_range.date)
+    )
+    spans = resolve_ranges(req.headers.get('Range'), size) if range_valid and not compress else None
+
+    if spans == []:
+        response.status_code = 416
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return response, None
+
+    if spans and len(spans) > 1:
+        boundary = secrets.token_hex(12)
+        plan = []
+        for start, stop in spans:
+            plan.append((f'--{boundary}\r\nContent-Type: {mimetype}\r\n'
+                         f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n').encode())
+            plan.append((start, stop))
+            plan.append(b'\r\n')
+        plan.append(f'--{boundary}--\r\n'.encode())
+        response.status_code = 206
+        response.mimetype = f'multipart/byteranges; boundary={boundary}'
+        response.content_length = sum(len(p) if isinstance(p, bytes) else p[1] - p[0] for p in plan)
+        return response, plan
+
+    start, stop = spans[0] if spans else (0, size)
+    if spans:
+        response.status_code = 206
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    if not compress:
+        response.content_length = stop - start
+    return response, [(start, stop)]
+
+def planned_body(f, plan):
+    """Yield a planned response body, closing the file at the end"""
+    try:
+        for part in plan:
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield from read_span(f, *part)
+    finally:
+        f.close()
+
+def send_shared_file(path, mimetype=None, download_name=None, max_age=0, headers=None, compress=None):
+    """Send a file with conditional GET and Range support
+
+    Whole files and ranges that run to the end of the file are handed to the
+    server's wsgi.file_wrapper, which servers such as gunicorn turn into
+    sendfile(2), so the bytes never pass through Python. Raises OSError if
+    the file can't be opened.
+    """
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    f = open(path, 'rb')
+    try:
+        response, plan = plan_file_response(f, request, mimetype, download_name, max_age,
+                                            headers, compress)
+        if plan is None:
+            f.close()
+            return response
+        if compress:
+            response.response = compress_stream(planned_body(f, plan), compress,
+                                                size=plan[0][1] - plan[0][0])
+            return response
+        size = os.fstat(f.fileno()).st_size
+        if plan == [(0, size)] and app.config['USE_X_SENDFILE']:
+            f.close()
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+        elif len(plan) == 1 and plan[0][1] == size:
+            f.seek(plan[0][0])
+            response.response = wrap_file(request.environ, f, app.config['SEND_BLOCK_SIZE'])
+            response.direct_passthrough = True
+        else:
+            response.response = planned_body(f, plan)
+        return response
+    except BaseException:
+        f.close()
+        raise
+
+# Text-like types that are worth compressing; everything else (media,
+# archives, office formats that are already zipped) is stored as-is
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/xml', 'application/javascript',
+    'application/x-javascript', 'application/sql', 'application/x-sh',
+    'application/x-tar', 'image/svg+xml', 'image/bmp',
+}
+
+def is_compressible(filename):
+    """Check whether a file's MIME type is text-like"""
+    mimetype = pipeline.content_type(filename) or ''
+    if mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES:
+        return True
+    return filename.lower().endswith(('.log', '.csv', '.tsv', '.md', '.yaml', '.yml', '.ini', '.conf'))
+
+# Content codings in order of preference, with the levels used on the fly
+# and for the precompressed variants built after upload
+CONTENT_CODINGS = [coding for coding, available in (
+    ('zstd', zstandard is not None),
+    ('br', brotli is not None),
+    ('gzip', True),
+) if available]
+COMPRESS_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+PRECOMPRESS_LEVELS = {'zstd': 12, 'gzip': 9}
+VARIANT_SUFFIXES = {'zstd': 'zst', 'gzip': 'gz'}
+
+def compress_stream(chunks, coding, level=None, size=-1):
+    """Compress an iterable of bytes with a content coding, yielding compressed blocks
+
+    Pass the input size when known: zstd then sizes its tables to the
+    input, which makes high levels cheap for small files.
+    """
+    level = level or COMPRESS_LEVELS[coding]
+    if coding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=level).compressobj(size=size)
+        compress, finish = compressor.compress, compressor.flush
+    elif coding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # gzip container
+        compress, finish = compressor.compress, compressor.flush
+    try:
+        for chunk in chunks:
+            data = compress(chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+class CompressedVariants:
+    """Precompressed .gz/.zst copies of text-like shared files
+
+    Variants are keyed by the source's ETag, so hard-linked duplicates share
+    them and a modified file never gets a stale one. They are built in the
+    background after upload and served with zero-copy like any other file.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.codings = [c for c in CONTENT_CODINGS if c in PRECOMPRESS_LEVELS]
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.incompressible = set()  # ETags whose variants came out no smaller
+        self.pool = ThreadPoolExecutor(app.config['COMPRESS_WORKERS'], thread_name_prefix='compress')
+
+    def path(self, st, coding):
+        return os.path.join(self.folder, f'{file_etag(st)}.{VARIANT_SUFFIXES[coding]}')
+
+    def get(self, st, coding):
+        """Path of a ready variant of the file with this stat, or None"""
+        if coding not in self.codings:
+            return None
+        path = self.path(st, coding)
+        return path if os.path.exists(path) else None
+
+    def submit(self, name):
+        """Queue building the variants of a shared file, at most once at a time"""
+        with self.lock:
+            future = self.pending.get(name)
+            if future is not None:
+                return future
+            future = self.pool.submit(self._build, name)
+            self.pending[name] = future
+        future.add_done_callback(lambda f: self._done(name, f))
+        return future
+
+    def _done(self, name, future):
+        with self.lock:
+            if self.pending.get(name) is future:
+                del self.pending[name]
+
+    def _build(self, name):
+        try:
+            source = os.path.join(app.config['UPLOAD_FOLDER'], name)
+            st = os.stat(source)
+            etag = file_etag(st)
+            if st.st_size < app.config['COMPRESS_MIN_SIZE'] or etag in self.incompressible:
+                return
+            for coding in self.codings:
+                path = self.path(st, coding)
+                if os.path.exists(path):
+                    continue
+                tmp_path = f'{path}.{secrets.token_hex(8)}.tmp'
+                with open(source, 'rb') as src, open(tmp_path, 'wb') as out:
+                    blocks = iter(lambda: src.read(1024 * 1024), b'')
+                    for data in compress_stream(blocks, coding, PRECOMPRESS_LEVELS[coding], st.st_size):
+                        out.write(data)
+                # Drop the result if the file changed meanwhile or barely shrank
+                if file_etag(os.stat(source)) != etag or os.path.getsize(tmp_path) > st.st_size * 0.9:
+                    os.remove(tmp_path)
+                    self.incompressible.add(etag)
+                    return
+                os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def prune(self):
+        """Remove variants whose source file is gone or has changed"""
+        current = set()
+        for name in catalog.names():
+            try:
+                current.add(file_etag(os.stat(os.path.join(app.config['UPLOAD_FOLDER'], name))))
+            except OSError:
+                continue
+        removed = 0
+        for item in os.listdir(self.folder):
+            etag = item.split('.', 1)[0]
+            path = os.path.join(self.folder, item)
+            if etag not in current and time.time() - os.stat(path).st_mtime > 60:
+                os.remove(path)
+                removed += 1
+        return removed
+
+    def start_collector(self):
+        def run():
+            while True:
+                time.sleep(app.config['BLOB_GC_INTERVAL'])
+                try:
+                    self.prune()
+                except OSError:
+                    pass
+        threading.Thread(target=run, name='compressed-gc', daemon=True).start()
+
+variants = CompressedVariants(app.config['COMPRESSED_FOLDER'])
+
+def negotiate_download(req, path, filename):
+    """Choose how to send a download: returns (path, coding, compress, headers)
+
+    Text-like files go out with the client's best accepted content coding,
+    from a precompressed variant when one is ready (`coding`), otherwise
+    compressed on the fly (`compress`). Range requests always get the
+    uncompressed file, so resuming and seeking keep working. Uncompressed
+    files carry their recorded SHA-256 in Repr-Digest and Digest headers.
+    Raises OSError if the file doesn't exist.
+    """
+    st = os.stat(path)
+    sha256 = integrity.digest(filename, st)
+    identity = digest_headers(sha256) if sha256 else {}
+    if not is_compressible(filename):
+        return path, None, None, identity or None
+    headers = {'Vary': 'Accept-Encoding'}
+    if st.st_size < app.config['COMPRESS_MIN_SIZE'] or req.headers.get('Range'):
+        return path, None, None, dict(headers, **identity)
+    accepted = [c for c in CONTENT_CODINGS if req.accept_encodings[c] > 0]
+    accepted.sort(key=lambda c: -req.accept_encodings[c])
+    if not accepted:
+        return path, None, None, dict(headers, **identity)
+    for coding in accepted:
+        variant = variants.get(st, coding)
+        if variant:
+            return variant, coding, None, dict(headers, **{'Content-Encoding': coding})
+    variants.submit(filename)
+    return path, None, accepted[0], headers
+
+class StreamBuffer:
+    """Write-only file object that hands written bytes to a generator
+
+    It has tell() but no seek(), which puts zipfile into its streaming mode
+    (data descriptors after each entry instead of seeking back).
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def zip_stream(names):
+    """Yield a ZIP64 archive of shared files as it is built"""
+    buf = StreamBuffer()
+    block = app.config['SEND_BLOCK_SIZE']
+    with zipfile.ZipFile(buf, 'w', allowZip64=True) as zf:
+        for name in names:
+            path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+            try:
+                src = open(path, 'rb')
+            except OSError:
+                continue
+            with src:
+                st = os.fstat(src.fileno())
+                # ZIP timestamps can't go before 1980
+                info = zipfile.ZipInfo(name, time.localtime(max(st.st_mtime, 315532800))[:6])
+                info.file_size = st.st_size
+                info.compress_type = zipfile.ZIP_DEFLATED if is_compressible(name) else zipfile.ZIP_STORED
+                with zf.open(info, 'w') as dst:
+                    while True:
+                        data = src.read(block)
+                        if not data:
+                            break
+                        dst.write(data)
+                        yield buf.drain()
+            yield buf.drain()
+    yield buf.drain()
+
+def tar_members(names):
+    """Header, path and size for each file that still exists"""
+    members = []
+    for name in names:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        info = tarfile.TarInfo(name)
+        info.size = st.st_size
+        info.mtime = st.st_mtime
+        info.mode = 0o644
+        members.append((info.tobuf(tarfile.PAX_FORMAT), path, st.st_size))
+    return members
+
+def tar_length(members):
+    """Exact size of the tar stream that tar_stream() produces"""
+    length = sum(len(header) + size + (-size % tarfile.BLOCKSIZE) for header, _, size in members)
+    length += 2 * tarfile.BLOCKSIZE
+    return length + (-length % tarfile.RECORDSIZE)
+
+def tar_stream(members):
+    """Yield a tar archive, writing headers by hand so file data is streamed"""
+    block = app.config['SEND_BLOCK_SIZE']
+    written = 0
+    for header, path, size in members:
+        yield header
+        remaining = size
+        # Pad with zeros if the file shrank, or was deleted, since we sized
+        # the archive: Content-Length has been sent already
+        try:
+            src = open(path, 'rb')
+        except OSError:
+            src = io.BytesIO()
+        with src:
+            while remaining > 0:
+                data = src.read(min(block, remaining)) or b'\0' * min(block, remaining)
+                remaining -= len(data)
+                yield data
+        yield b'\0' * (-size % tarfile.BLOCKSIZE)
+        written += len(header) + size + (-size % tarfile.BLOCKSIZE)
+    written += 2 * tarfile.BLOCKSIZE
+    yield b'\0' * (2 * tarfile.BLOCKSIZE + (-written % tarfile.RECORDSIZE))
+
+class Metrics:
+    """Request counts, latency histograms and byte totals per route
+
+    Rendered in the Prometheus text exposition format by /metrics. Routes
+    are labelled by their URL rule, e.g. /download/<path:filename>, so the
+    number of series stays bounded.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()  # (route, method, status) -> count
+        self.durations = {}  # route -> [count per bucket..., +Inf count, sum]
+        self.bytes_in = collections.Counter()
+        self.bytes_out = collections.Counter()
+        self.active = collections.Counter()
+
+    def started(self, route):
+        with self.lock:
+            self.active[route] += 1
+
+    def abandoned(self, route):
+        """A started request that is recorded elsewhere"""
+        with self.lock:
+            self.active[route] -= 1
+
+    def finished(self, route, method, status, seconds, bytes_in, bytes_out):
+        with self.lock:
+            self.active[route] -= 1
+            self.requests[(route, method, str(status))] += 1
+            histogram = self.durations.setdefault(route, [0] * (len(self.BUCKETS) + 2))
+            histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+            self.bytes_in[route] += bytes_in
+            self.bytes_out[route] += bytes_out
+
+    def render(self):
+        """All metrics in the Prometheus text format"""
+        lines = []
+
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP file_share_{name} {help_text}')
+            lines.append(f'# TYPE file_share_{name} {kind}')
+            for labels, value in samples:
+                labels = ','.join(f'{k}="{label(v)}"' for k, v in labels.items())
+                lines.append(f'file_share_{name}{{{labels}}} {value}' if labels
+                             else f'file_share_{name} {value}')
+
+        with self.lock:
+            metric('http_requests_total', 'counter', 'HTTP requests by route, method and status',
+                   [({'route': r, 'method': m, 'status': s}, n)
+                    for (r, m, s), n in sorted(self.requests.items())])
+            histogram_samples = []
+            for route, histogram in sorted(self.durations.items()):
+                cumulative = 0
+                for bound, n in zip(self.BUCKETS + ('+Inf',), histogram[:-1]):
+                    cumulative += n
+                    histogram_samples.append(({'route': route, 'le': bound}, cumulative))
+            lines.append('# HELP file_share_http_request_duration_seconds Time from request '
+                         'to the last byte of the response')
+            lines.append('# TYPE file_share_http_request_duration_seconds histogram')
+            for labels, value in histogram_samples:
+                lines.append(f'file_share_http_request_duration_seconds_bucket'
+                             f'{{route="{label(labels["route"])}",le="{labels["le"]}"}} {value}')
+            for route, histogram in sorted(self.durations.items()):
+                lines.append(f'file_share_http_request_duration_seconds_sum{{route="{label(route)}"}} '
+                             f'{histogram[-1]:.6f}')
+                lines.append(f'file_share_http_request_duration_seconds_count{{route="{label(route)}"}} '
+                             f'{sum(histogram[:-1])}')
+            metric('http_received_bytes_total', 'counter', 'Request body bytes by route',
+                   [({'route': r}, n) for r, n in sorted(self.bytes_in.items())])
+            metric('http_sent_bytes_total', 'counter', 'Response body bytes by route',
+                   [({'route': r}, n) for r, n in sorted(self.bytes_out.items())])
+            metric('http_active_requests', 'gauge', 'Requests in progress, including open transfers',
+                   [({'route': r}, n) for r, n in sorted(self.active.items())])
+
+        files, size = catalog.totals()
+        metric('shared_files', 'gauge', 'Files in the shared folder', [({}, files)])
+        metric('shared_bytes', 'gauge', 'Total size of the shared files', [({}, size)])
+        metric('event_subscribers', 'gauge', 'Open /events streams',
+               [({}, len(catalog._subscribers))])
+        metric('thumbnail_cache_bytes', 'gauge', 'Size of the thumbnail cache', [({}, thumbnails.total)])
+        metric('retention_deleted_total', 'counter', 'Files deleted by retention rules, by reason',
+               [({'reason': reason}, n) for reason, n in sorted(storage.deleted.items())])
+
+        scrub = integrity.status()
+        metric('integrity_verified_total', 'counter', 'Files the scrubber read back and found intact',
+               [({}, scrub['verified'])])
+        metric('integrity_read_bytes_total', 'counter', 'Bytes read by the integrity scrubber',
+               [({}, scrub['bytes_read'])])
+        metric('integrity_corrupt_files', 'gauge', 'Files that no longer match their checksums',
+               [({}, len(scrub['corrupt']))])
+
+        transfers = shaper.status()
+        metric('transfers_active', 'gauge', 'Bulk uploads (in) and downloads (out) in progress',
+               [({'direction': d}, transfers[d]['active']) for d in ('in', 'out')])
+        metric('transfer_rate_bytes', 'gauge', 'Current bytes/s of bulk transfers',
+               [({'direction': d}, transfers[d]['rate']) for d in ('in', 'out')])
+
+        status = pipeline.status()
+        metric('pipeline_queue_depth', 'gauge', 'Uploads waiting for post-processing',
+               [({}, status['queue_depth'])])
+        metric('pipeline_active_jobs', 'gauge', 'Uploads being post-processed', [({}, status['active'])])
+        metric('pipeline_rejected_total', 'counter', 'Uploads refused with 503 because the queue was full',
+               [({}, status['rejected'])])
+        with pipeline.lock:
+            stages = {stage: dict(stats) for stage, stats in pipeline.stats.items()}
+        metric('pipeline_stage_seconds_total', 'counter', 'Time spent per post-processing stage',
+               [({'stage': stage}, f"{stats['seconds']:.6f}") for stage, stats in stages.items()])
+        metric('pipeline_stage_runs_total', 'counter', 'Post-processing stage runs',
+               [({'stage': stage}, stats['count']) for stage, stats in stages.items()])
+        metric('pipeline_stage_errors_total', 'counter', 'Post-processing stage failures',
+               [({'stage': stage}, stats['errors']) for stage, stats in stages.items()])
+
+        usage = os.times()
+        metric('process_cpu_seconds_total', 'counter', 'User and system CPU time of the server',
+               [({}, f'{usage.user + usage.system:.3f}')])
+        try:
+            with open('/proc/self/statm') as f:
+                rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            metric('process_resident_memory_bytes', 'gauge', 'Resident memory of the server', [({}, rss)])
+        except (OSError, ValueError, AttributeError):
+            pass
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def start_profile():
+    """Profile this request if it is picked by PROFILE_SAMPLE_RATE; returns the profiler or None"""
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    if not rate or random.random() >= rate:
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is already active on this thread
+        return None
+    return profiler
+
+def finish_profile(profiler, route, seconds):
+    """Save a sampled profile if the request was slow
+
+    The .prof files can be read with `python -m pstats` or snakeviz. For
+    whole-process sampling with no setup, attach py-spy to the server.
+    """
+    profiler.disable()
+    if seconds < app.config['PROFILE_SLOW_SECONDS']:
+        return
+    os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+    profiler.dump_stats(os.path.join(app.config['PROFILE_FOLDER'],
+                                     f'{time.strftime("%Y%m%d-%H%M%S")}-{slug}-{seconds * 1000:.0f}ms.prof'))
+
+class TrackedResponse:
+    """Response iterable that counts bytes and records metrics when closed"""
+
+    def __init__(self, result, done):
+        self.result = result
+        self.done = done
+        self.sent = 0
+
+    def __iter__(self):
+        for data in self.result:
+            self.sent += len(data)
+            yield data
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.done(self.sent)
+
+def match_route(environ):
+    """The URL rule a request will be routed to, as a label, or None"""
+    try:
+        rule, _ = app.url_map.bind_to_environ(environ).match(return_rule=True)
+    except HTTPException:
+        return None
+    return rule.rule
+
+class MetricsMiddleware:
+    """WSGI middleware recording per-route metrics and optional profiles
+
+    File responses handed to the server's wsgi.file_wrapper are passed
+    through untouched, so sendfile(2) still works; their bytes are counted
+    from Content-Length.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        started = time.monotonic()
+        profiler = start_profile()
+        response = {}
+
+        def capture(status, headers, exc_info=None):
+            response['status'] = status.split(' ', 1)[0]
+            response['headers'] = headers
+            return start_response(status, headers, exc_info)
+
+        # Counted as active from the start, so uploads still sending their body show up
+        environ['file_share.route'] = match_route(environ)
+        route = environ['file_share.route'] or 'unmatched'
+        metrics.started(route)
+        try:
+            result = self.wsgi_app(environ, capture)
+        except BaseException:
+            metrics.abandoned(route)
+            if profiler:
+                profiler.disable()
+            raise
+        try:
+            bytes_in = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            bytes_in = 0
+
+        def done(sent):
+            seconds = time.monotonic() - started
+            metrics.finished(route, environ['REQUEST_METHOD'], response.get('status', '500'),
+                             seconds, bytes_in, sent)
+            if profiler:
+                finish_profile(profiler, route, seconds)
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(result, FileWrapper) or (isinstance(file_wrapper, type) and isinstance(result, file_wrapper)):
+            length = next((int(v) for k, v in response.get('headers', []) if k.lower() == 'content-length'), 0)
+            close = result.close
+
+            def close_and_record():
+                try:
+                    close()
+                finally:
+                    done(length)
+            result.close = close_and_record
+            return result
+        return TrackedResponse(result, done)
+
+def fair_shares(capacity, demands):
+    """Split capacity max-min fairly: whoever needs less than an equal share
+    gets what it needs, and the rest share the remainder equally"""
+    if capacity == math.inf:
+        return dict(demands)
+    shares = {}
+    pending = sorted(demands, key=demands.get)
+    while pending and demands[pending[0]] <= capacity / len(pending):
+        key = pending.pop(0)
+        shares[key] = demands[key]
+        capacity -= demands[key]
+    for key in pending:
+        shares[key] = capacity / len(pending)
+    return shares
+
+# Routes whose responses are never held back, whatever their size. /events
+# streams have no Content-Length but are long-lived notifications, not transfers
+PRIORITY_ROUTES = {'/preview/<path:filename>', '/qrcode', '/events'}
+
+class BandwidthShaper:
+    """Rate limits and fair sharing of bandwidth between transfers
+
+    Each direction, out for downloads and in for uploads, has an optional
+    limit for everything (RATE_LIMIT) and for each client
+    (CLIENT_RATE_LIMIT). Bulk transfers share the bandwidth max-min fairly:
+    equally between clients, then between a client's transfers, and a
+    transfer that can't use its share (a slow receiver, say) leaves the
+    rest to the others. Each transfer is paced by its own token bucket at
+    its share. Small bodies and previews are never held back; their bytes
+    are counted and the bulk transfers share what they leave.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transfers = {}
+        self.next_id = 1
+        self.priority_bytes = {'in': 0, 'out': 0}  # since the last rebalance
+        self.priority_rate = {'in': 0.0, 'out': 0.0}
+        self.balanced = time.monotonic()
+
+    @property
+    def limited(self):
+        return bool(app.config['RATE_LIMIT'] or app.config['CLIENT_RATE_LIMIT'])
+
+    def is_bulk(self, route, length):
+        """Whether a body is shaped, rather than sent straight away as a priority one"""
+        if route in PRIORITY_ROUTES:
+            return False
+        return length is None or length > app.config['SHAPER_PRIORITY_BYTES']
+
+    def priority(self, direction, length):
+        """Count the bytes of a priority body against the limits"""
+        with self.lock:
+            self.priority_bytes[direction] += length
+
+    def start(self, direction, client, path, size=None):
+        now = time.monotonic()
+        with self.lock:
+            transfer = {
+                'id': self.next_id, 'direction': direction, 'client': client, 'path': path,
+                'size': size, 'bytes': 0, 'started': now, 'share': None, 'tokens': 0.0,
+                'refilled': now, 'rate': None, 'window_bytes': 0, 'window_started': now,
+                'zero_copy': False,
+            }
+            self.next_id += 1
+            self.transfers[transfer['id']] = transfer
+            self._rebalance(now)
+        return transfer
+
+    def finish(self, transfer):
+        with self.lock:
+            if self.transfers.pop(transfer['id'], None):
+                self._rebalance(time.monotonic())
+
+    def acquire(self, transfer, length):
+        """Account for the next `length` bytes of a transfer
+
+        Returns how many seconds to wait before moving them.
+        """
+        now = time.monotonic()
+        with self.lock:
+            transfer['bytes'] += length
+            transfer['window_bytes'] += length
+            if now - transfer['window_started'] >= app.config['SHAPER_INTERVAL']:
+                transfer['rate'] = transfer['window_bytes'] / (now - transfer['window_started'])
+                transfer['window_bytes'] = 0
+                transfer['window_started'] = now
+            if now - self.balanced >= app.config['SHAPER_INTERVAL']:
+                self._rebalance(now)
+            share = transfer['share']
+            if share is None:
+                return 0
+            # A little burst is allowed, so pacing survives the odd scheduling hiccup
+            tokens = transfer['tokens'] + (now - transfer['refilled']) * share
+            transfer['tokens'] = min(tokens, share * 0.25) - length
+            transfer['refilled'] = now
+            return max(0.0, -transfer['tokens'] / share)
+
+    def _rate(self, transfer, now):
+        """Bytes/s over the last full window, or over the current one if it has run long"""
+        elapsed = now - transfer['window_started']
+        if transfer['rate'] is None or elapsed >= 2 * app.config['SHAPER_INTERVAL']:
+            return transfer['window_bytes'] / elapsed if elapsed > 0 else 0.0
+        return transfer['rate']
+
+    def _demand(self, transfer, now):
+        """What a transfer could use: unbounded, unless it runs below its share"""
+        share = transfer['share']
+        if share and now - transfer['started'] >= app.config['SHAPER_INTERVAL']:
+            rate = self._rate(transfer, now)
+            # A transfer held to its demand runs at 0.8 of its share, so this
+            # leaves it room to speed up without flapping at the threshold
+            if rate < share * 0.9:
+                return max(rate * 1.25, app.config['SHAPER_BLOCK_SIZE'])
+        return math.inf
+
+    def _rebalance(self, now):
+        """Recompute every transfer's share; lock held"""
+        elapsed = max(now - self.balanced, 0.001)
+        self.balanced = now
+        for direction in ('in', 'out'):
+            self.priority_rate[direction] = self.priority_bytes[direction] / elapsed
+            self.priority_bytes[direction] = 0
+            capacity = app.config['RATE_LIMIT'] or math.inf
+            # Priority traffic goes first, but bulk transfers never stop entirely
+            capacity = max(capacity - self.priority_rate[direction], capacity * 0.1)
+            clients = {}
+            for transfer in self.transfers.values():
+                if transfer['direction'] == direction:
+                    clients.setdefault(transfer['client'], []).append(transfer)
+            demands = {transfer['id']: self._demand(transfer, now)
+                       for transfers in clients.values() for transfer in transfers}
+            client_limit = app.config['CLIENT_RATE_LIMIT'] or math.inf
+            client_shares = fair_shares(capacity, {
+                client: min(client_limit, sum(demands[t['id']] for t in transfers))
+                for client, transfers in clients.items()})
+            for client, transfers in clients.items():
+                shares = fair_shares(client_shares[client], {t['id']: demands[t['id']] for t in transfers})
+                for transfer in transfers:
+                    share = shares[transfer['id']]
+                    transfer['share'] = None if share == math.inf else share
+
+    def status(self):
+        """Limits, totals per direction and each transfer's live rate and share"""
+        now = time.monotonic()
+        with self.lock:
+            transfers = [{
+                'id': t['id'],
+                'direction': t['direction'],
+                'client': t['client'],
+                'path': t['path'],
+                'size': t['size'],
+                'bytes': None if t['zero_copy'] else t['bytes'],
+                'rate': None if t['zero_copy'] else round(self._rate(t, now)),
+                'share': None if t['share'] is None else round(t['share']),
+                'seconds': round(now - t['started'], 3),
+            } for t in self.transfers.values()]
+            directions = {direction: {
+                'active': sum(1 for t in transfers if t['direction'] == direction),
+                'rate': sum(t['rate'] or 0 for t in transfers if t['direction'] == direction),
+                'priority_rate': round(self.priority_rate[direction]),
+            } for direction in ('in', 'out')}
+        return {
+            'rate_limit': app.config['RATE_LIMIT'],
+            'client_rate_limit': app.config['CLIENT_RATE_LIMIT'],
+            **directions,
+            'transfers': transfers,
+        }
+
+shaper = BandwidthShaper()
+
+class ShapedInput:
+    """wsgi.input that paces an upload through the shaper"""
+
+    def __init__(self, stream, transfer):
+        self.stream = stream
+        self.transfer = transfer
+
+    def _paced(self, data):
+        delay = shaper.acquire(self.transfer, len(data))
+        if delay:
+            time.sleep(delay)
+        return data
+
+    def _size(self, size):
+        if self.transfer['share'] is None:
+            return size
+        block = app.config['SHAPER_BLOCK_SIZE']
+        return block if size is None or size < 0 else min(size, block)
+
+    def read(self, size=-1):
+        return self._paced(self.stream.read(self._size(size)))
+
+    def readline(self, size=-1):
+        return self._paced(self.stream.readline(self._size(size)))
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+class ShapedResponse:
+    """Response iterable that paces a download through the shaper"""
+
+    def __init__(self, result, transfer):
+        self.result = result
+        self.transfer = transfer
+
+    def __iter__(self):
+        block = app.config['SHAPER_BLOCK_SIZE']
+        for data in self.result:
+            # Rate-limited bodies go out in small pieces so the pacing is smooth
+            pieces = ((data,) if self.transfer['share'] is None or len(data) <= block else
+                      (data[start:start + block] for start in range(0, len(data), block)))
+            for piece in pieces:
+                delay = shaper.acquire(self.transfer, len(piece))
+                if delay:
+                    time.sleep(delay)
+                yield piece
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            shaper.finish(self.transfer)
+
+class ShapingMiddleware:
+    """WSGI middleware passing bulk request and response bodies through the shaper
+
+    Without rate limits, file responses the server can send zero-copy are
+    left alone; they are listed as transfers, but without live progress.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        client = environ.get('REMOTE_ADDR')
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        upload = None
+        if length > app.config['SHAPER_PRIORITY_BYTES']:
+            upload = shaper.start('in', client, environ.get('PATH_INFO'), length)
+            environ['wsgi.input'] = ShapedInput(environ['wsgi.input'], upload)
+        elif length:
+            shaper.priority('in', length)
+        response = {}
+
+        def capture(status, headers, exc_info=None):
+            response['status'] = status.split(' ', 1)[0]
+            response['headers'] = headers
+            return start_response(status, headers, exc_info)
+
+        try:
+            result = self.wsgi_app(environ, capture)
+        finally:
+            if upload:
+                shaper.finish(upload)
+        if environ['REQUEST_METHOD'] == 'HEAD' or response.get('status') not in ('200', '206'):
+            return result
+        length = next((int(v) for k, v in response['headers'] if k.lower() == 'content-length'), None)
+        if not shaper.is_bulk(environ.get('file_share.route'), length):
+            shaper.priority('out', length or 0)
+            return result
+
+        transfer = shaper.start('out', client, environ.get('PATH_INFO'), length)
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if not shaper.limited and isinstance(file_wrapper, type) and isinstance(result, file_wrapper):
+            transfer['zero_copy'] = True
+            close = result.close
+
+            def close_and_finish():
+                try:
+                    close()
+                finally:
+                    shaper.finish(transfer)
+            result.close = close_and_finish
+            return result
+        return ShapedResponse(result, transfer)
+
+app.wsgi_app = MetricsMiddleware(ShapingMiddleware(app.wsgi_app))
+
+# Rendered app page and its ETag per connection URL; the page only changes
+# with the URL, so the template is compiled and rendered once for each
+index_pages = {}
+
 @app.route('/')
 def index():
-    local_ip = get_local_ip()
-    port = 5000
-    url = f"http://{local_ip}:{port}"
-    return render_template_string(HTML_TEMPLATE, url=url)
+    """The app page, revalidated by ETag so a reload costs a 304"""
+    url = network.urls()[0]
+    cached = index_pages.get(url)
+    if cached is None:
+        page = render_template_string(HTML_TEMPLATE, url=url,
+                                      qr_version=network.qr_etag(url, 'png'),
+                                      chunk_size=app.config['UPLOAD_CHUNK_SIZE'],
+                                      parallel_streams=app.config['UPLOAD_PARALLEL_STREAMS'],
+                                      hash_block_size=app.config['HASH_BLOCK_SIZE'])
+        cached = index_pages[url] = page, hashlib.sha1(page.encode()).hexdigest()[:16]
+    response = Response(cached[0], mimetype='text/html')
+    response.set_etag(cached[1])
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/qrcode')
 def generate_qr():
-    """Generate QR code for easy connection"""
-    local_ip = get_local_ip()
-    port = 5000
-    url = f"http://{local_ip}:{port}"
-    
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(url)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    from io import BytesIO
-    buffer = BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
-    
-    return send_file(buffer, mimetype='image/png')
+    """Generate QR code for easy connection
+
+    ?format=svg returns SVG instead of PNG and ?url= picks one of the
+    machine's other connection URLs. With ?v=<etag>, as linked from the
+    page, the image is cached by the browser indefinitely.
+    """
+    fmt = request.args.get('format', 'png')
+    if fmt not in ('png', 'svg'):
+        return jsonify({'error': 'Invalid format, use png or svg'}), 400
+    urls = network.urls()
+    url = request.args.get('url', urls[0])
+    if url not in urls:
+        return jsonify({'error': 'Unknown URL', 'urls': urls}), 404
 
-@app.route('/preview/<filename>')
+    body, etag = network.qr_code(url, fmt)
+    response = Response(body, mimetype='image/svg+xml' if fmt == 'svg' else 'image/png')
+    response.set_etag(etag)
+    if request.args.get('v') == etag:
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/preview/<path:filename>')
 def preview_file(filename):
-    """Serve image files for preview"""
+    """Serve a small cached thumbnail of an image for the file list
+
+    Use ?size=N to pick the thumbnail width. With ?v=<mtime> the response is
+    cached by the browser indefinitely, since the URL changes with the file.
+    """
     try:
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        if os.path.exists(file_path) and is_image_file(filename):
-            return send_file(file_path, mimetype=mimetypes.guess_type(filename)[0])
-        else:
+        entry = catalog.get(filename)
+        if entry is None or not entry['is_image']:
             return "File not found or not an image", 404
-    except:
+        max_age = 365 * 24 * 3600 if request.args.get('v') else 0
+        path = None
+        if can_thumbnail(filename):
+            path = thumbnails.get(filename, request.args.get('size', 80, type=int))
+        if path is not None:
+            return send_shared_file(path, f'image/{thumbnails.extension.replace("jpg", "jpeg")}',
+                                    max_age=max_age)
+        # Fall back to the original if Pillow can't read it
+        return send_shared_file(shared_path(filename),
+                                mimetypes.guess_type(filename)[0], max_age=max_age)
+    except OSError:
+        return "File not found or not an image", 404
+    except Exception:
         return "Error loading image", 500
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    busy = pipeline_busy() or storage_full(request.content_length or 0, request.remote_addr)
+    if busy:
+        return busy
     # Handle both single and multiple file uploads
     files = request.files.getlist('file') if 'file' in request.files else []
     
@@ -478,25 +4877,24 @@ def upload_file():
     uploaded_files = []
     errors = []
     
-    for file in files:
+    for index, file in enumerate(files):
         if file.filename == '':
             errors.append({'filename': 'unknown', 'error': 'No filename provided'})
             continue
             
         try:
-            filename = secure_filename(file.filename)
-            # Handle duplicate filenames
-            base, ext = os.path.splitext(filename)
-            counter = 1
-            original_filename = filename
-            while os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
-                filename = f"{base}_{counter}{ext}"
-                counter += 1
-            
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            original_filename = secure_path(file.filename)
+            # Duplicate names get a suffix; duplicate content is stored once
+            filename, size, digest, sha256, deduplicated = store_upload(
+                file.stream, original_filename, upload_digests(request.form, index))
+            finish_upload(filename, digest, request.remote_addr, sha256)
             uploaded_files.append({
                 'original_name': original_filename,
                 'saved_name': filename,
+                'size': size,
+                'content_hash': digest,
+                'sha256': sha256,
+                'deduplicated': deduplicated,
                 'success': True
             })
         except Exception as e:
@@ -524,6 +4922,9 @@ def upload_file():
 @app.route('/upload/batch', methods=['POST'])
 def upload_batch():
     """Handle multiple file uploads in a single request"""
+    busy = pipeline_busy() or storage_full(request.content_length or 0, request.remote_addr)
+    if busy:
+        return busy
     files = request.files.getlist('files')  # Note: using 'files' for batch uploads
     
     if not files:
@@ -532,30 +4933,23 @@ def upload_batch():
     uploaded_files = []
     errors = []
     
-    for file in files:
+    for index, file in enumerate(files):
         if file.filename == '':
             continue
             
         try:
-            # Get file size before saving
-            file.seek(0, os.SEEK_END)
-            file_size = file.tell()
-            file.seek(0)
-            
-            filename = secure_filename(file.filename)
-            # Handle duplicate filenames
-            base, ext = os.path.splitext(filename)
-            counter = 1
-            original_filename = filename
-            while os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
-                filename = f"{base}_{counter}{ext}"
-                counter += 1
-            
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            original_filename = secure_path(file.filename)
+            # Duplicate names get a suffix; duplicate content is stored once
+            filename, size, digest, sha256, deduplicated = store_upload(
+                file.stream, original_filename, upload_digests(request.form, index))
+            finish_upload(filename, digest, request.remote_addr, sha256)
             uploaded_files.append({
                 'original_name': original_filename,
                 'saved_name': filename,
-                'size': file_size,
+                'size': size,
+                'content_hash': digest,
+                'sha256': sha256,
+                'deduplicated': deduplicated,
                 'success': True
             })
         except Exception as e:
@@ -572,38 +4966,1330 @@ def upload_batch():
         'errors': errors if errors else None
     })
 
+@app.route('/upload/sessions', methods=['POST'])
+def create_upload_session():
+    """Start a resumable chunked upload"""
+    busy = pipeline_busy()
+    if busy:
+        return busy
+    data = request.get_json(silent=True) or {}
+    filename = secure_path(str(data.get('filename', '')))
+    if not filename:
+        return jsonify({'error': 'No filename provided'}), 400
+    try:
+        size = int(data.get('size', -1))
+        chunk_size = int(data.get('chunk_size') or app.config['UPLOAD_CHUNK_SIZE'])
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid size or chunk_size'}), 400
+    if size < 0:
+        return jsonify({'error': 'File size is required'}), 400
+    content_hash = str(data.get('content_hash') or '').lower()
+    if content_hash and not re.fullmatch(r'[0-9a-f]{64}', content_hash):
+        return jsonify({'error': 'Invalid content_hash'}), 400
+    if not 0 < chunk_size <= app.config['UPLOAD_MAX_CHUNK_SIZE']:
+        return jsonify({'error': 'Invalid chunk_size'}), 400
+    # Chunks are hashed as they arrive, which needs them aligned to hash blocks
+    if size > chunk_size and chunk_size % app.config['HASH_BLOCK_SIZE']:
+        return jsonify({'error': f'chunk_size must be a multiple of {app.config["HASH_BLOCK_SIZE"]}'}), 400
+    full = storage_full(size, request.remote_addr)
+    if full:
+        return full
+
+    session = {
+        'id': secrets.token_hex(16),
+        'filename': filename,
+        'size': size,
+        'chunk_size': chunk_size,
+        'total_chunks': (size + chunk_size - 1) // chunk_size,
+        'received': set(),
+        'block_digests': {},
+        'content_hash': content_hash or None,
+        'client': request.remote_addr,
+        'created': time.time(),
+        'lock': threading.Lock()
+    }
+    _, part_path = session_paths(session['id'])
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        preallocate(fd, size)
+    finally:
+        os.close(fd)
+    save_session(session)
+    with upload_sessions_lock:
+        upload_sessions[session['id']] = session
+    return jsonify(session_status(session)), 201
+
+@app.route('/upload/check', methods=['POST'])
+def upload_check():
+    """Finish an upload without sending it if the content is already stored
+
+    Takes {filename, size, content_hash}, where content_hash is computed as
+    in ContentHasher. Returns the usual upload response if the content was
+    known, or 404 if the client has to send the bytes.
+    """
+    busy = pipeline_busy()
+    if busy:
+        return busy
+    data = request.get_json(silent=True) or {}
+    filename = secure_path(str(data.get('filename', '')))
+    digest = str(data.get('content_hash', '')).lower()
+    if not filename or not re.match(r'^[0-9a-f]{64}$', digest):
+        return jsonify({'error': 'filename and content_hash are required'}), 400
+    try:
+        size = int(data.get('size', -1))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid size'}), 400
+
+    if not blobs.has(digest, size):
+        return jsonify({'exists': False}), 404
+    full = storage_full(size, request.remote_addr, disk=False)
+    if full:
+        return full
+    try:
+        name = blobs.share(digest, filename)
+    except NameConflict as e:
+        return jsonify({'error': str(e)}), 409
+    if name is None:
+        return jsonify({'exists': False}), 404
+    finish_upload(name, digest, request.remote_addr)
+    return jsonify({
+        'success': True,
+        'exists': True,
+        'uploaded_files': [{
+            'original_name': filename,
+            'saved_name': name,
+            'size': size,
+            'content_hash': digest,
+            'sha256': integrity.digest(name, os.stat(shared_path(name))),
+            'deduplicated': True,
+            'success': True
+        }],
+        'total_uploaded': 1,
+        'total_errors': 0
+    })
+
+@app.route('/storage')
+def storage_status():
+    """Space used and quotas, overall and for the requesting device"""
+    return jsonify(storage.status(request.remote_addr))
+
+@app.route('/transfers')
+def transfers_status():
+    """Uploads and downloads in progress with their live rates and fair shares"""
+    return jsonify(shaper.status())
+
+@app.route('/integrity')
+def integrity_status():
+    """Checksum records, scrubber progress and files that failed verification"""
+    return jsonify(integrity.status())
+
+@app.route('/upload/pipeline')
+def upload_pipeline_status():
+    """Queue depth, rejections and per-stage latency of upload post-processing"""
+    return jsonify(pipeline.status())
+
+@app.route('/upload/sessions/<session_id>', methods=['GET'])
+def upload_session_status(session_id):
+    """Report which chunks of an upload have arrived"""
+    session = get_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    with session['lock']:
+        return jsonify(session_status(session))
+
+def check_chunk(session_id, index, content_length, content_digest=None):
+    """Validate a chunk upload before reading its body
+
+    A Content-Digest header gives the SHA-256 the chunk must have; a chunk
+    damaged on the way is refused, so the client sends it again. Returns
+    (session, expected_length, sha256 or None, None) or
+    (None, None, None, (error, status)).
+    """
+    session = get_session(session_id)
+    if session is None:
+        return None, None, None, ({'error': 'Upload session not found'}, 404)
+    if not 0 <= index < session['total_chunks']:
+        return None, None, None, ({'error': 'Chunk index out of range'}, 400)
+    expected = chunk_length(session, index)
+    if content_length is not None and content_length != expected:
+        return None, None, None, ({'error': f'Chunk {index} must be {expected} bytes'}, 400)
+    sha256 = None
+    if content_digest:
+        sha256 = parse_digest_header(content_digest)
+        if sha256 is None:
+            return None, None, None, ({'error': 'Content-Digest needs a sha-256 value'}, 400)
+    return session, expected, sha256, None
+
+def chunk_digest_error(index, hasher, sha256):
+    """An error if a chunk doesn't match the SHA-256 of its Content-Digest, else None"""
+    if sha256 and hasher.whole.hexdigest() != sha256:
+        return {'error': f'Chunk {index} is corrupt: it does not match its Content-Digest'}
+    return None
+
+def record_chunk(session, index, hasher):
+    """Mark a fully written chunk as received"""
+    with session['lock']:
+        session['received'].add(index)
+        session.setdefault('block_digests', {})[str(index)] = hasher.block_digests()
+        save_session(session)
+        return {
+            'index': index,
+            'received': len(session['received']),
+            'total_chunks': session['total_chunks']
+        }
+
+def pwrite_all(fd, data, offset):
+    """Write all of data at offset"""
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+@app.route('/upload/sessions/<session_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(session_id, index):
+    """Write one chunk straight into the preallocated target file
+
+    Chunks may arrive in any order and over several connections at once;
+    each one is written at its own offset, so no reassembly step is needed.
+    """
+    session, expected, sha256, error = check_chunk(session_id, index, request.content_length,
+                                                   request.headers.get('Content-Digest'))
+    if error:
+        return jsonify(error[0]), error[1]
+
+    _, part_path = session_paths(session_id)
+    offset = index * session['chunk_size']
+    written = 0
+    hasher = ContentHasher(whole=bool(sha256))
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        while written < expected:
+            data = request.stream.read(min(1024 * 1024, expected - written))
+            if not data:
+                break
+            hasher.update(data)
+            pwrite_all(fd, data, offset + written)
+            written += len(data)
+    finally:
+        os.close(fd)
+    if written != expected:
+        return jsonify({'error': f'Incomplete chunk: got {written} of {expected} bytes'}), 400
+    corrupt = chunk_digest_error(index, hasher, sha256)
+    if corrupt:
+        return jsonify(corrupt), 400
+    return jsonify(record_chunk(session, index, hasher))
+
+@app.route('/upload/sessions/<session_id>/complete', methods=['POST'])
+def complete_upload_session(session_id):
+    """Move a fully received upload into the shared folder"""
+    session = get_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    with session['lock']:
+        meta_path, part_path = session_paths(session_id)
+        with upload_sessions_lock:
+            current = upload_sessions.get(session_id) is session
+        if not current or not os.path.exists(part_path):
+            # Completed or aborted by another request while we waited for the lock
+            return jsonify({'error': 'Upload session not found'}), 404
+        status = session_status(session)
+        if not status['complete']:
+            return jsonify(dict(status, error='Upload is missing chunks')), 409
+        block_digests = session.get('block_digests', {})
+        if all(str(i) in block_digests for i in range(session['total_chunks'])):
+            digest = combine_digests([d for i in range(session['total_chunks'])
+                                      for d in block_digests[str(i)]])
+        else:
+            # Session started before chunk hashes were recorded
+            digest = file_digest(part_path)
+        if session.get('content_hash') and session['content_hash'] != digest:
+            # Some chunk was damaged in a way its length didn't show; start over
+            for path in (meta_path, part_path):
+                os.remove(path)
+            with upload_sessions_lock:
+                upload_sessions.pop(session_id, None)
+            return jsonify({'error': f'Upload is corrupt: content_hash is {digest}, '
+                                     f'the client sent {session["content_hash"]}'}), 422
+        # Chunks came out of order, so the SHA-256 for Repr-Digest takes one
+        # in-order read, while they are still in the page cache
+        sha256 = integrity.known_sha256(digest) or file_sha256(part_path)
+        try:
+            filename, deduplicated = blobs.commit(part_path, digest, session['filename'])
+        except NameConflict as e:
+            # The name can never be saved; drop the upload
+            for path in (meta_path, part_path):
+                os.remove(path)
+            with upload_sessions_lock:
+                upload_sessions.pop(session_id, None)
+            return jsonify({'error': str(e)}), 409
+        os.remove(meta_path)
+        finish_upload(filename, digest, session.get('client'), sha256)
+        with upload_sessions_lock:
+            upload_sessions.pop(session_id, None)
+    return jsonify({
+        'success': True,
+        'uploaded_files': [{
+            'original_name': session['filename'],
+            'saved_name': filename,
+            'size': session['size'],
+            'content_hash': digest,
+            'sha256': sha256,
+            'deduplicated': deduplicated,
+            'success': True
+        }],
+        'total_uploaded': 1,
+        'total_errors': 0
+    })
+
+@app.route('/upload/sessions/<session_id>', methods=['DELETE'])
+def abort_upload_session(session_id):
+    """Discard an unfinished upload"""
+    session = get_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    with session['lock']:
+        for path in session_paths(session_id):
+            if os.path.exists(path):
+                os.remove(path)
+        with upload_sessions_lock:
+            upload_sessions.pop(session_id, None)
+    return jsonify({'success': True})
+
+@app.route('/sync/<path:filename>/signature')
+def sync_signature(filename):
+    """Block checksums of a shared file, to compute a delta for /sync against"""
+    path = shared_path(filename)
+    if path is None:
+        return jsonify({'error': 'File not found'}), 404
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            block_size = request.args.get('block_size', sync_block_size(size), type=int)
+            if not 512 <= block_size <= 8 * 1024 * 1024:
+                return jsonify({'error': 'block_size must be between 512 bytes and 8MB'}), 400
+            signature, etag = block_signature(f, block_size)
+    except OSError:
+        return jsonify({'error': 'File not found'}), 404
+    response = app.response_class(signature, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+@app.route('/sync/<path:filename>', methods=['POST'])
+def sync_upload(filename):
+    """Rebuild a file from a delta against the current version of filename
+
+    The body is a stream of SYNC_OP ops computed against the signature from
+    /sync/<filename>/signature, sent with If-Match set to the signature's
+    ETag. Query arguments give the size and content hash (digest) of the
+    result, the block_size of the signature, and mode: replace (default)
+    updates the file in place, version saves it under a new name. Without
+    If-Match the ops can only carry literal data.
+    """
+    name = secure_path(filename)
+    mode = request.args.get('mode', 'replace')
+    size = request.args.get('size', type=int)
+    digest = request.args.get('digest', '')
+    block_size = request.args.get('block_size', 0, type=int)
+    if mode not in ('replace', 'version'):
+        return jsonify({'error': 'Invalid mode, use replace or version'}), 400
+    if not name or size is None or size < 0 or not re.fullmatch(r'[0-9a-f]{64}', digest):
+        return jsonify({'error': 'size and digest of the new file are required'}), 400
+
+    path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+    base_fd = None
+    base_size = 0
+    if request.if_match:
+        try:
+            base_fd = os.open(path, os.O_RDONLY)
+            st = os.fstat(base_fd)
+        except OSError:
+            return jsonify({'error': 'File not found'}), 412
+        if not request.if_match.contains(file_etag(st)):
+            os.close(base_fd)
+            return jsonify({'error': 'File has changed since its signature was taken'}), 412
+        if not 512 <= block_size <= 8 * 1024 * 1024:
+            os.close(base_fd)
+            return jsonify({'error': 'block_size of the signature is required'}), 400
+        base_size = st.st_size
+    elif mode == 'replace' and os.path.exists(path):
+        return jsonify({'error': 'Replacing a file needs If-Match with its signature ETag'}), 428
+
+    try:
+        incoming = max(size - base_size, 0) if mode == 'replace' else size
+        busy = pipeline_busy() or storage_full(incoming, request.remote_addr)
+        if busy:
+            return busy
+        # The delta is bounded by the declared size instead (settable since Flask 3.1)
+        request.max_content_length = None
+        temp_path = os.path.join(app.config['UPLOAD_SESSION_FOLDER'], secrets.token_hex(16) + '.tmp')
+        hasher = ContentHasher(whole=True)
+        try:
+            with open(temp_path, 'wb') as out:
+                copied, literal = apply_delta(request.stream, base_fd, base_size, block_size,
+                                              out, hasher, size)
+            if copied + literal != size or hasher.hexdigest() != digest:
+                raise ValueError('Rebuilt file does not match the declared size and digest')
+            if mode == 'replace':
+                blobs.replace(temp_path, digest, name)
+                saved = name
+            else:
+                saved, _ = blobs.commit(temp_path, digest, name)
+        except ValueError as e:
+            os.remove(temp_path)
+            return jsonify({'error': str(e)}), 409 if isinstance(e, NameConflict) else 400
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    finally:
+        if base_fd is not None:
+            os.close(base_fd)
+    finish_upload(saved, digest, request.remote_addr, hasher.whole.hexdigest())
+    return jsonify({
+        'saved_name': saved,
+        'size': size,
+        'content_hash': digest,
+        'sha256': hasher.whole.hexdigest(),
+        'copied_bytes': copied,
+        'literal_bytes': literal,
+        'replaced': mode == 'replace' and base_fd is not None,
+    })
+
+def files_etag(query_string):
+    """ETag for a /files response
+
+    The catalog version changes with every add/remove/rename and the peer
+    version with every change to a peer's files, so together with the query
+    string they identify the response exactly.
+    """
+    return f'{catalog.instance}-{catalog.version}.{peers.version}-{zlib.crc32(query_string):08x}'
+
+def files_listing_json(local):
+    """The whole file list as a JSON array, followed by the peers' files unless `local`"""
+    listing = catalog.listing_json()
+    if local or not peers.active():
+        return listing
+    remote = peers.listing_json()
+    if remote == '[]':
+        return listing
+    if listing == '[]':
+        return remote
+    return listing[:-1] + ', ' + remote[1:]
+
+def node_headers():
+    """Identify this node to peers polling /files"""
+    return {'X-File-Share-Node': app.config['NODE_NAME'], 'X-File-Share-Instance': catalog.instance}
+
+def query_files(args):
+    """One page of the catalog for /files query arguments
+
+    Returns (payload, status); payload is {files, next_cursor, total} or an
+    error dict. One folder is listed, given by dir (the top level by
+    default), with its subfolders as entries of type folder. Peers' files
+    are included unless peers=0.
+    """
+    sort = args.get('sort', 'name')
+    order = args.get('order', 'asc')
+    if sort not in SORT_KEYS:
+        return {'error': f'Invalid sort, use one of: {", ".join(SORT_KEYS)}'}, 400
+    if order not in ('asc', 'desc'):
+        return {'error': 'Invalid order, use asc or desc'}, 400
+    try:
+        limit = min(max(int(args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return {'error': 'Invalid limit'}, 400
+    after = None
+    if args.get('cursor'):
+        try:
+            after = decode_cursor(args['cursor'], sort)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+
+    folder = args.get('dir', '').strip('/')
+    if folder and shared_path(folder) is None:
+        return {'error': 'Invalid dir'}, 400
+    if folder and catalog.get(folder) is not None:
+        return {'error': 'dir is a file, not a folder'}, 404
+    prefix = args.get('prefix', '').lower()
+    exts = {e.strip().lower().lstrip('.') for e in args.get('ext', '').split(',') if e.strip()}
+    file_type = args.get('type', '')
+
+    def match(entry):
+        # Filters apply to the name within the folder
+        name = entry['name'].rpartition('/')[2].lower()
+        if prefix and not name.startswith(prefix):
+            return False
+        if exts and (name.rsplit('.', 1)[-1] if '.' in name else '') not in exts:
+            return False
+        if file_type and entry['type'] != file_type:
+            return False
+        return True
+
+    source = peers if peers.active() and args.get('peers') != '0' else catalog
+    files, last_key = source.page(sort, order == 'desc', after, limit, match, folder)
+    return {
+        'files': files,
+        'next_cursor': encode_cursor(sort, last_key) if last_key is not None else None,
+        'total': source.count((prefix, tuple(sorted(exts)), file_type), match, folder)
+    }, 200
+
 @app.route('/files')
 def list_files():
-    """List all shared files"""
-    files = []
-    for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-        if os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
-            files.append({
-                'name': filename,
-                'icon': get_file_icon(filename),
-                'is_image': is_image_file(filename)
-            })
-    return jsonify(files)
+    """List shared files from the in-memory catalog
+
+    Without query parameters the whole list of files, in every folder, is
+    returned as a JSON array. With any of dir, limit, cursor, sort, order,
+    prefix, ext or type, one page of one folder is returned as {files,
+    next_cursor, total}. Files on peers are listed too, unless peers=0 asks
+    for this node's files only.
+    """
+    etag = files_etag(request.query_string)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304, headers=node_headers())
+        response.set_etag(etag)
+        return response
+
+    if all(key == 'peers' for key in request.args):
+        response = app.response_class(files_listing_json(request.args.get('peers') == '0'),
+                                      mimetype='application/json')
+    else:
+        payload, status = query_files(request.args)
+        if status != 200:
+            return jsonify(payload), status
+        response = jsonify(payload)
+    response.headers.update(node_headers())
+    response.set_etag(etag)
+    return response
+
+def parse_search_time(value):
+    """Unix time from a timestamp or a date such as 2024-05-01"""
+    try:
+        return float(value)
+    except ValueError:
+        return time.mktime(time.strptime(value, '%Y-%m-%d'))
+
+@app.route('/search')
+def search_files():
+    """Search shared files through the persistent search index
+
+    q is matched word by word, as prefixes, against names, EXIF fields of
+    images and the text of txt/csv/json files. ext, type, min_size,
+    max_size, after and before (Unix time or YYYY-MM-DD) filter on metadata.
+    Results come by relevance, or by sort=name|size|mtime with order, and
+    are paged with limit and offset.
+    """
+    started = time.perf_counter()
+    args = request.args
+    sort = args.get('sort') or None
+    if sort is not None and sort not in SEARCH_SORTS:
+        return jsonify({'error': f'Invalid sort, use one of: {", ".join(SEARCH_SORTS)}'}), 400
+    try:
+        limit = min(max(int(args.get('limit', 50)), 1), 1000)
+        offset = max(int(args.get('offset', 0)), 0)
+        min_size = int(args['min_size']) if args.get('min_size') else None
+        max_size = int(args['max_size']) if args.get('max_size') else None
+        after = parse_search_time(args['after']) if args.get('after') else None
+        before = parse_search_time(args['before']) if args.get('before') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid limit, offset, size or date'}), 400
+    exts = sorted({e.strip().lower().lstrip('.') for e in args.get('ext', '').split(',') if e.strip()})
+
+    matches, total = search_index.search(
+        args.get('q', ''), exts, args.get('type', ''), min_size, max_size, after, before,
+        sort, args.get('order') == 'desc', limit, offset)
+    results = []
+    for match in matches:
+        # The catalog has the current entry; the index may lag it briefly
+        entry = catalog.get(match['name'])
+        if entry is not None:
+            results.append(dict(entry, exif=match['exif'], snippet=match['snippet']))
+    return jsonify({
+        'results': results,
+        'total': total,
+        'took_ms': round((time.perf_counter() - started) * 1000, 2),
+    })
 
-@app.route('/download/<filename>')
+def last_event_version(last_event_id):
+    """Catalog version a reconnecting SSE client has seen
+
+    Event ids are "<instance>-<version>"; after a server restart the ids no
+    longer match and -1 is returned so the client is told to reload its
+    list. None means a fresh connection.
+    """
+    if not last_event_id:
+        return None
+    instance, _, version = last_event_id.partition('-')
+    return int(version) if instance == catalog.instance and version.isdigit() else -1
+
+def sse_frame(event):
+    """Format a catalog event as a server-sent event"""
+    return f"id: {catalog.instance}-{event['version']}\ndata: {json.dumps(event)}\n\n"
+
+@app.route('/events')
+def file_events():
+    """Stream catalog changes to the browser as server-sent events"""
+    q = catalog.subscribe(last_event_version(request.headers.get('Last-Event-ID', '')))
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    event = q.get(timeout=app.config['EVENTS_KEEPALIVE'])
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield sse_frame(event)
+        finally:
+            catalog.unsubscribe(q)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Server metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/download/archive', methods=['GET', 'POST'])
+def download_archive():
+    """Stream several shared files as one ZIP or tar archive
+
+    Pass the selection as repeated `files` values (query string or form);
+    with none, every shared file is included. `format` is zip (default) or
+    tar. Nothing is buffered: entries are read and sent a block at a time.
+    """
+    archive_format = request.values.get('format', 'zip')
+    if archive_format not in ('zip', 'tar'):
+        return jsonify({'error': 'Invalid format, use zip or tar'}), 400
+
+    names = request.values.getlist('files')
+    if names:
+        missing = [name for name in names if catalog.get(name) is None and not catalog.files_under(name)]
+        if missing:
+            return jsonify({'error': 'Files not found', 'files': missing}), 404
+        # A folder stands for every file below it
+        names = list(dict.fromkeys(file for name in names
+                                   for file in ([name] if catalog.get(name) else catalog.files_under(name))))
+    else:
+        names = catalog.names()
+    for name in names:
+        storage.touch(name)
+
+    if archive_format == 'tar':
+        members = tar_members(names)
+        response = Response(tar_stream(members), mimetype='application/x-tar')
+        response.content_length = tar_length(members)
+    else:
+        response = Response(zip_stream(names), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment',
+                         filename=f'shared_files.{archive_format}')
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/download/<path:filename>')
 def download_file(filename):
-    """Download a shared file"""
+    """Download a shared file, compressed if it is text and the client accepts that"""
+    if shared_path(filename) is None:
+        return "File not found", 404
+    storage.touch(filename)
     try:
-        return send_file(
-            os.path.join(app.config['UPLOAD_FOLDER'], filename),
-            as_attachment=True,
-            download_name=filename
-        )
-    except:
+        path, coding, compress, headers = negotiate_download(request, shared_path(filename), filename)
+        return send_shared_file(path, pipeline.content_type(filename), download_name=os.path.basename(filename),
+                                headers=headers, compress=compress)
+    except OSError:
         return "File not found", 404
 
-if __name__ == '__main__':
-    local_ip = get_local_ip()
+@app.route('/peers')
+def peers_status():
+    """Known peers, whether their files are listed and when they last answered"""
+    return jsonify({'node': app.config['NODE_NAME'], 'peers': peers.status()})
+
+@app.route('/peers/<peer_id>/<any(download, preview):kind>/<path:filename>')
+def peer_file(peer_id, kind, filename):
+    """Download or preview a file on a peer
+
+    The response is streamed through block by block, with range and
+    conditional headers passed along both ways, or with PEER_REDIRECT the
+    client is sent to the peer directly.
+    """
+    peer = peers.get(peer_id)
+    if peer is None:
+        return jsonify({'error': 'Unknown peer'}), 404
+    path = f'/{kind}/{urllib.parse.quote(filename, safe="/")}'
+    if request.query_string:
+        path += '?' + request.query_string.decode('latin1')
+    if app.config['PEER_REDIRECT']:
+        return redirect(peer['url'] + path, 307)
+
+    headers = {name: request.headers[name] for name in PROXY_REQUEST_HEADERS if name in request.headers}
+    try:
+        upstream = peers.open(peer, request.method, path, headers)
+    except (OSError, http.client.HTTPException):
+        return jsonify({'error': f"Peer {peer['name']} is unreachable"}), 502
+
+    def stream():
+        try:
+            while True:
+                block = upstream.read(app.config['SEND_BLOCK_SIZE'])
+                if not block:
+                    break
+                yield block
+        finally:
+            upstream.close()
+
+    response_headers = [(name, value) for name, value in upstream.getheaders()
+                        if name.lower() in PROXY_RESPONSE_HEADERS]
+    return Response(stream(), status=upstream.status, headers=response_headers, direct_passthrough=True)
+
+class AsgiInput:
+    """File-like wsgi.input fed from ASGI receive(), for use from a worker thread"""
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.buffer = bytearray()
+        self.finished = False
+        self.disconnected = False
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+        if message['type'] == 'http.disconnect':
+            self.finished = self.disconnected = True
+            return
+        self.buffer += message.get('body', b'')
+        self.finished = not message.get('more_body', False)
+
+    def read(self, size=-1):
+        while not self.finished and (size is None or size < 0 or len(self.buffer) < size):
+            self._fill()
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        while b'\n' not in self.buffer and not self.finished and (size < 0 or len(self.buffer) < size):
+            self._fill()
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        return self.read(end)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+def asgi_environ(scope, body):
+    """Build a WSGI environ for an ASGI HTTP scope"""
+    server = scope.get('server') or ('localhost', app.config['PORT'])
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        # AsgiInput ends with the request body, chunked or not
+        'wsgi.input_terminated': True,
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.decode('latin1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+def asgi_headers(headers):
+    """Convert Werkzeug or WSGI headers to an ASGI header list"""
+    return [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]
+
+class AsgiServer:
+    """ASGI front end for serving many slow or long transfers at once
+
+    Downloads, previews, chunk uploads, /files and /events are handled here
+    on the event loop, so an idle or slow connection costs a coroutine
+    rather than a thread. File reads and writes run on a small thread pool
+    and each block is awaited through send()/receive(), which gives
+    backpressure: a slow client is never read ahead of by more than one
+    block. Every other route runs the Flask app on a worker thread.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.io = ThreadPoolExecutor(app.config['ASGI_IO_THREADS'], thread_name_prefix='asgi-io')
+        self.wsgi_threads = ThreadPoolExecutor(app.config['ASGI_WSGI_THREADS'],
+                                               thread_name_prefix='asgi-wsgi')
+        self.active = 0
+        # (method, path pattern, handler, route label as in the Flask app)
+        self.routes = [
+            ('GET', re.compile(r'/files'), self.list_files, '/files'),
+            ('GET', re.compile(r'/events'), self.events, '/events'),
+            ('GET', re.compile(r'/download/(?!archive$)(.+)'), self.download, '/download/<path:filename>'),
+            ('GET', re.compile(r'/preview/(.+)'), self.preview, '/preview/<path:filename>'),
+            ('PUT', re.compile(r'/upload/sessions/([^/]+)/chunks/(\d+)'), self.upload_chunk,
+             '/upload/sessions/<session_id>/chunks/<int:index>'),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await asyncio.get_running_loop().run_in_executor(None, start_server)
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.io.shutdown(wait=False)
+                    self.wsgi_threads.shutdown(wait=False)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        if self.active >= app.config['ASGI_MAX_CONNECTIONS']:
+            await self.send_json(send, {'error': 'Server busy, try again shortly'}, 503,
+                                 [(b'retry-after', b'1')])
+            return
+        self.active += 1
+        try:
+            method = 'GET' if scope['method'] == 'HEAD' else scope['method']
+            for route_method, pattern, handler, route in self.routes:
+                match = pattern.fullmatch(scope['path'])
+                if match and route_method == method:
+                    await self.call_native(handler, route, scope, receive, send, *match.groups())
+                    return
+            await self.call_wsgi(scope, receive, send)
+        finally:
+            self.active -= 1
+
+    async def call_native(self, handler, route, scope, receive, send, *args):
+        """Run one of our own handlers, recording the same metrics as the WSGI middleware
+
+        Profiling is left to the WSGI routes: on the event loop a profiler
+        would also catch every other request in flight.
+        """
+        started = time.monotonic()
+        response = {'status': 500, 'sent': 0}
+        bytes_in = 0
+        for name, value in scope['headers']:
+            if name == b'content-length' and value.isdigit():
+                bytes_in = int(value)
+
+        async def tracked_send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            elif message['type'] == 'http.response.body':
+                response['sent'] += len(message.get('body', b''))
+            elif message['type'] == 'http.response.zerocopysend':
+                response['sent'] += message.get('count') or 0
+            await send(message)
+
+        scope['file_share.route'] = route
+        metrics.started(route)
+        try:
+            await handler(scope, receive, tracked_send, *args)
+        finally:
+            # Handlers that hand the request to Flask are counted by the middleware
+            if scope.get('file_share.bridged'):
+                metrics.abandoned(route)
+            else:
+                metrics.finished(route, scope['method'], response['status'],
+                                 time.monotonic() - started, bytes_in, response['sent'])
+
+    async def run_io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.io, func, *args)
+
+    async def send_json(self, send, payload, status=200, headers=(), head=False):
+        """Send a JSON response; with head, only its headers, as HEAD asks for"""
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        await send({'type': 'http.response.start', 'status': status, 'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            *headers
+        ]})
+        await send({'type': 'http.response.body', 'body': b'' if head else body})
+
+    async def send_text(self, send, text, status):
+        body = text.encode()
+        await send({'type': 'http.response.start', 'status': status, 'headers': [
+            (b'content-type', b'text/html; charset=utf-8'),
+            (b'content-length', str(len(body)).encode())
+        ]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def send_file(self, scope, send, path, mimetype=None, download_name=None, max_age=0,
+                        headers=None):
+        """Async counterpart of send_shared_file; raises OSError if path can't be opened"""
+        mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        f = await self.run_io(open, path, 'rb')
+        transfer = None
+        try:
+            req = app.request_class(asgi_environ(scope, None))
+            response, plan = plan_file_response(f, req, mimetype, download_name, max_age, headers)
+            await send({'type': 'http.response.start', 'status': response.status_code,
+                        'headers': asgi_headers(response.headers.items())})
+            if plan is None or scope['method'] == 'HEAD':
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+            length = response.content_length
+            if shaper.is_bulk(scope.get('file_share.route'), length):
+                transfer = shaper.start('out', (scope.get('client') or ('',))[0], scope['path'], length)
+            else:
+                shaper.priority('out', length or 0)
+            # Rate-limited files go through Python in small blocks so they can be paced
+            zero_copy = ('http.response.zerocopysend' in (scope.get('extensions') or {}) and
+                         not (transfer and shaper.limited))
+            block_size = app.config['SHAPER_BLOCK_SIZE' if transfer and shaper.limited else 'SEND_BLOCK_SIZE']
+            for part in plan:
+                if isinstance(part, bytes):
+                    await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+                elif zero_copy:
+                    await send({'type': 'http.response.zerocopysend', 'file': f,
+                                'offset': part[0], 'count': part[1] - part[0], 'more_body': True})
+                    if transfer:
+                        shaper.acquire(transfer, part[1] - part[0])
+                else:
+                    offset, stop = part
+                    while offset < stop:
+                        data = await self.run_io(os.pread, f.fileno(),
+                                                 min(block_size, stop - offset), offset)
+                        if not data:
+                            break
+                        offset += len(data)
+                        await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+                        delay = shaper.acquire(transfer, len(data)) if transfer else 0
+                        if delay:
+                            await asyncio.sleep(delay)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            f.close()
+            if transfer:
+                shaper.finish(transfer)
+
+    async def download(self, scope, receive, send, filename):
+        if shared_path(filename) is None:
+            await self.send_text(send, 'File not found', 404)
+            return
+        storage.touch(filename)
+        try:
+            req = app.request_class(asgi_environ(scope, None))
+            path, coding, compress, headers = await self.run_io(
+                negotiate_download, req, shared_path(filename), filename)
+            if compress:
+                # Compressing is CPU work; leave it to the Flask route on a thread
+                await self.call_wsgi(scope, receive, send)
+                return
+            await self.send_file(scope, send, path, pipeline.content_type(filename),
+                                 download_name=os.path.basename(filename), headers=headers)
+        except OSError:
+            await self.send_text(send, 'File not found', 404)
+
+    async def preview(self, scope, receive, send, filename):
+        entry = catalog.get(filename)
+        if entry is None or not entry['is_image']:
+            await self.send_text(send, 'File not found or not an image', 404)
+            return
+        args = app.request_class(asgi_environ(scope, None)).args
+        max_age = 365 * 24 * 3600 if args.get('v') else 0
+        try:
+            path = None
+            if can_thumbnail(filename):
+                path = await self.run_io(thumbnails.get, filename, args.get('size', 80, type=int))
+            if path is not None:
+                await self.send_file(scope, send, path,
+                                     f'image/{thumbnails.extension.replace("jpg", "jpeg")}',
+                                     max_age=max_age)
+            else:
+                await self.send_file(scope, send, shared_path(filename),
+                                     mimetypes.guess_type(filename)[0], max_age=max_age)
+        except OSError:
+            await self.send_text(send, 'File not found or not an image', 404)
+
+    async def list_files(self, scope, receive, send):
+        req = app.request_class(asgi_environ(scope, None))
+        etag = files_etag(scope['query_string'])
+        headers = [(b'etag', f'"{etag}"'.encode())] + asgi_headers(node_headers().items())
+        if req.if_none_match.contains(etag):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        head = scope['method'] == 'HEAD'
+        if all(key == 'peers' for key in req.args):
+            await self.send_json(send, files_listing_json(req.args.get('peers') == '0'), headers=headers,
+                                 head=head)
+            return
+        payload, status = query_files(req.args)
+        await self.send_json(send, payload, status, headers if status == 200 else [], head=head)
+
+    async def events(self, scope, receive, send):
+        last_event_id = ''
+        for name, value in scope['headers']:
+            if name == b'last-event-id':
+                last_event_id = value.decode('latin1')
+        q = catalog.subscribe(last_event_version(last_event_id))
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no')
+            ]})
+            await send({'type': 'http.response.body', 'body': b'retry: 3000\n\n', 'more_body': True})
+            # The catalog publishes from its watcher thread into a plain
+            # queue; poll it rather than tying a thread to each client
+            idle = 0
+            while not disconnected.is_set():
+                try:
+                    frame = sse_frame(q.get_nowait())
+                except queue.Empty:
+                    try:
+                        await asyncio.wait_for(disconnected.wait(), 0.25)
+                    except asyncio.TimeoutError:
+                        pass
+                    idle += 0.25
+                    if idle < app.config['EVENTS_KEEPALIVE']:
+                        continue
+                    frame = ': keep-alive\n\n'
+                idle = 0
+                await send({'type': 'http.response.body', 'body': frame.encode(), 'more_body': True})
+        finally:
+            watcher.cancel()
+            catalog.unsubscribe(q)
+
+    async def upload_chunk(self, scope, receive, send, session_id, index):
+        """Async counterpart of the chunk PUT route"""
+        index = int(index)
+        content_length = None
+        content_digest = None
+        for name, value in scope['headers']:
+            if name == b'content-length' and value.isdigit():
+                content_length = int(value)
+            elif name == b'content-digest':
+                content_digest = value.decode('latin1')
+        session, expected, sha256, error = check_chunk(session_id, index, content_length, content_digest)
+        if error:
+            await self.send_json(send, *error)
+            return
+
+        _, part_path = session_paths(session_id)
+        offset = index * session['chunk_size']
+        written = 0
+        hasher = ContentHasher(whole=bool(sha256))
+
+        def write(data, at):
+            hasher.update(data)
+            pwrite_all(fd, data, at)
+
+        fd = await self.run_io(os.open, part_path, os.O_WRONLY)
+        transfer = None
+        if shaper.is_bulk(scope['file_share.route'], expected):
+            transfer = shaper.start('in', (scope.get('client') or ('',))[0], scope['path'], expected)
+        else:
+            shaper.priority('in', expected)
+        try:
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                data = message.get('body', b'')
+                more_body = message.get('more_body', False)
+                if written + len(data) > expected:
+                    await self.send_json(send, {'error': f'Chunk {index} must be {expected} bytes'}, 400)
+                    return
+                if data:
+                    await self.run_io(write, data, offset + written)
+                    written += len(data)
+                    delay = shaper.acquire(transfer, len(data)) if transfer else 0
+                    if delay:
+                        await asyncio.sleep(delay)
+        finally:
+            os.close(fd)
+            if transfer:
+                shaper.finish(transfer)
+        if written != expected:
+            await self.send_json(send, {'error': f'Incomplete chunk: got {written} of {expected} bytes'}, 400)
+            return
+        corrupt = chunk_digest_error(index, hasher, sha256)
+        if corrupt:
+            await self.send_json(send, corrupt, 400)
+            return
+        await self.send_json(send, await self.run_io(record_chunk, session, index, hasher))
+
+    async def call_wsgi(self, scope, receive, send):
+        """Run the Flask app for this request on a worker thread"""
+        scope['file_share.bridged'] = True
+        loop = asyncio.get_running_loop()
+        body = AsgiInput(receive, loop)
+        environ = asgi_environ(scope, body)
+        closed = threading.Event()
+
+        async def watch_disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+            closed.set()
+
+        def respond(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            started = []
+
+            def start_response(status, headers, exc_info=None):
+                started[:] = [int(status.split(' ', 1)[0]), asgi_headers(headers)]
+
+            result = self.wsgi_app(environ, start_response)
+            watcher = None
+            try:
+                # Once the request body is consumed, a disconnect can be
+                # noticed between blocks of a long streamed response
+                if body.finished:
+                    watcher = asyncio.run_coroutine_threadsafe(watch_disconnect(), loop)
+                sent_start = False
+                for data in result:
+                    if closed.is_set() or body.disconnected:
+                        return
+                    if not sent_start:
+                        respond({'type': 'http.response.start', 'status': started[0],
+                                 'headers': started[1]})
+                        sent_start = True
+                    if data:
+                        respond({'type': 'http.response.body', 'body': data, 'more_body': True})
+                if not sent_start:
+                    respond({'type': 'http.response.start', 'status': started[0], 'headers': started[1]})
+                respond({'type': 'http.response.body', 'body': b''})
+            finally:
+                if watcher is not None:
+                    watcher.cancel()
+                if hasattr(result, 'close'):
+                    result.close()
+
+        await loop.run_in_executor(self.wsgi_threads, run)
+
+asgi_app = AsgiServer(app)
+
+server_lock = threading.Lock()
+server_started = threading.Event()
+
+def start_server():
+    """Create the share's folders and start the server's background work; returns the app
+
+    Importing this module creates nothing and starts no threads, so the
+    --sync client can use it without touching the share. main() calls this
+    before serving; the first request or ASGI startup calls it for servers
+    that load file:app or file:asgi_app themselves.
+    """
+    with server_lock:
+        if server_started.is_set():
+            return app
+        for folder in (app.config['UPLOAD_FOLDER'], app.config['UPLOAD_SESSION_FOLDER'],
+                       app.config['THUMBNAIL_FOLDER'], app.config['BLOB_FOLDER'],
+                       app.config['COMPRESSED_FOLDER'], app.config['STATE_FOLDER']):
+            os.makedirs(folder, exist_ok=True)
+        network.watch()
+        catalog.scan()
+        catalog.watch()
+        thumbnails.start()
+        blobs.start_collector()
+        pipeline.start()
+        storage.start_sweeper()
+        integrity.start_scrubber()
+        search_index.start()
+        variants.start_collector()
+        server_started.set()
+    return app
+
+@app.before_request
+def ensure_started():
+    if not server_started.is_set():
+        start_server()
+
+def parse_size(text):
+    """Parse a size such as 500M or 20G into bytes"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', text, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError(f'invalid size: {text}')
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+def parse_duration(text):
+    """Parse a duration such as 90s, 12h or 30d into seconds"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*', text, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError(f'invalid duration: {text}')
+    unit = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}[match.group(2).lower()]
+    return float(match.group(1)) * unit
+
+def push_delta(path, url, name=None, mode='replace'):
+    """Send a local file to a file_share server as a delta against its copy
+
+    Returns the server's reply, with the number of bytes sent added.
+    """
+    name = secure_path(name or os.path.basename(path))
+    parts = urllib.parse.urlsplit(url if '://' in url else 'http://' + url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    conn = connection_class(parts.netloc, timeout=300)
+    route = f"{parts.path.rstrip('/')}/sync/{urllib.parse.quote(name, safe='/')}"
+
+    conn.request('GET', route + '/signature')
+    resp = conn.getresponse()
+    body = resp.read()
+    headers = {}
+    if resp.status == 200:
+        signature = json.loads(body)
+        headers['If-Match'] = resp.getheader('ETag')
+    elif resp.status == 404:
+        signature = {'size': 0, 'block_size': app.config['SYNC_MIN_BLOCK'], 'blocks': []}
+    else:
+        raise OSError(f'Signature request failed: HTTP {resp.status}')
+
+    sent = 0
+
+    def delta_body():
+        # Op headers are tiny; gather them into reasonably sized chunks
+        nonlocal sent
+        pending = bytearray()
+        with open(path, 'rb') as f:
+            for data in compute_delta(f, signature):
+                pending += data
+                if len(pending) >= 256 * 1024:
+                    sent += len(pending)
+                    yield bytes(pending)
+                    pending.clear()
+        sent += len(pending)
+        yield bytes(pending)
+
+    query = urllib.parse.urlencode({'mode': mode, 'size': os.path.getsize(path),
+                                    'digest': file_digest(path), 'block_size': signature['block_size']})
+    conn.request('POST', f'{route}?{query}', body=delta_body(), headers=headers, encode_chunked=True)
+    resp = conn.getresponse()
+    reply = json.loads(resp.read() or b'{}')
+    conn.close()
+    if resp.status != 200:
+        raise OSError(reply.get('error', f'HTTP {resp.status}'))
+    reply['sent_bytes'] = sent
+    return reply
+
+def main():
+    parser = argparse.ArgumentParser(description='Share files with devices on the local network')
+    parser.add_argument('--host', default='0.0.0.0', help='address to listen on')
+    parser.add_argument('--port', type=int, default=app.config['PORT'], help='port to listen on')
+    parser.add_argument('--server', choices=('dev', 'asgi'), default='dev',
+                        help='dev: threaded Werkzeug server; asgi: asyncio server '
+                             '(needs uvicorn) for many concurrent transfers')
+    parser.add_argument('--max-connections', type=int, default=app.config['ASGI_MAX_CONNECTIONS'],
+                        help='with --server asgi, open requests before answering 503')
+    parser.add_argument('--profile-rate', type=float, default=app.config['PROFILE_SAMPLE_RATE'],
+                        help='fraction of requests to run under cProfile, e.g. 0.01')
+    parser.add_argument('--profile-slow', type=float, default=app.config['PROFILE_SLOW_SECONDS'],
+                        help='save profiles of sampled requests slower than this many seconds')
+    parser.add_argument('--quota', type=parse_size, help='limit on the total size of shared files, e.g. 50G')
+    parser.add_argument('--client-quota', type=parse_size, help='limit on what each device may upload')
+    parser.add_argument('--max-age', type=parse_duration,
+                        help='delete files this long after upload, e.g. 30d')
+    parser.add_argument('--max-idle', type=parse_duration,
+                        help='delete files not downloaded for this long, e.g. 7d')
+    parser.add_argument('--evict-lru', action='store_true',
+                        help='when over --quota, delete the least recently downloaded files')
+    parser.add_argument('--rate-limit', type=parse_size,
+                        help='bytes/s for all uploads, and for all downloads, e.g. 20M')
+    parser.add_argument('--client-rate-limit', type=parse_size,
+                        help='bytes/s for each device\'s uploads, and for its downloads, e.g. 5M')
+    parser.add_argument('--scrub-rate', type=parse_size, default=app.config['SCRUB_RATE'],
+                        help='bytes/s the integrity scrubber re-reads shared files at; 0 disables it')
+    parser.add_argument('--scrub-interval', type=parse_duration, default=app.config['SCRUB_INTERVAL'],
+                        help='time between passes re-verifying every shared file, e.g. 7d')
+    parser.add_argument('--peer', action='append', default=[], metavar='URL',
+                        help='another file_share node whose files to list here, e.g. '
+                             'http://192.168.1.20:5000; may be repeated')
+    parser.add_argument('--discover', action='store_true',
+                        help='find other nodes on the LAN over mDNS (needs zeroconf)')
+    parser.add_argument('--node-name', default=app.config['NODE_NAME'],
+                        help='name shown next to this node\'s files on its peers')
+    parser.add_argument('--peer-redirect', action='store_true',
+                        help='redirect clients to peers for remote files instead of proxying')
+    parser.add_argument('--sync', nargs=2, metavar=('FILE', 'URL'),
+                        help='send FILE to the server at URL, transferring only what changed '
+                             'since its copy, then exit')
+    parser.add_argument('--sync-new-version', action='store_true',
+                        help='with --sync, keep the server\'s copy and save FILE under a new name')
+    args = parser.parse_args()
+    if args.sync:
+        path, url = args.sync
+        try:
+            reply = push_delta(path, url, mode='version' if args.sync_new_version else 'replace')
+        except OSError as e:
+            sys.exit(f'sync failed: {e}')
+        print(f"{reply['saved_name']}: sent {reply['sent_bytes']} bytes for {reply['size']} "
+              f"({reply['copied_bytes']} reused from the server's copy)")
+        return
+    app.config['STORAGE_QUOTA_BYTES'] = args.quota
+    app.config['CLIENT_QUOTA_BYTES'] = args.client_quota
+    app.config['RETENTION_MAX_AGE'] = args.max_age
+    app.config['RETENTION_MAX_IDLE'] = args.max_idle
+    app.config['RETENTION_EVICT_LRU'] = args.evict_lru
+    app.config['RATE_LIMIT'] = args.rate_limit
+    app.config['CLIENT_RATE_LIMIT'] = args.client_rate_limit
+    app.config['SCRUB_RATE'] = args.scrub_rate
+    app.config['SCRUB_INTERVAL'] = args.scrub_interval
+    app.config['PORT'] = args.port
+    app.config['ASGI_MAX_CONNECTIONS'] = args.max_connections
+    app.config['PROFILE_SAMPLE_RATE'] = args.profile_rate
+    app.config['PROFILE_SLOW_SECONDS'] = args.profile_slow
+    app.config['NODE_NAME'] = args.node_name
+    app.config['PEER_REDIRECT'] = args.peer_redirect
+
+    if args.server == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            sys.exit("--server asgi needs uvicorn: pip install uvicorn")
+
+    start_server()
+    for url in args.peer:
+        peers.add(url)
+    if args.peer:
+        peers.watch()
+    if args.discover and not peers.discover():
+        sys.exit("--discover needs zeroconf: pip install zeroconf")
+
     print(f"\nFile Share Server Started!")
     print(f"Access from any device on the same network:")
-    print(f"   http://{local_ip}:5000")
-    print(f"   http://localhost:5000")
+    for url in network.urls():
+        print(f"   {url}")
+    print(f"   http://localhost:{args.port}")
     print("\nPress Ctrl+C to stop the server\n")
-    
+
     # Run the server
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    if args.server == 'asgi':
+        uvicorn.run(asgi_app, host=args.host, port=args.port, log_level='warning')
+    else:
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
+
+if __name__ == '__main__':
+    main()
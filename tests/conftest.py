@@ -0,0 +1,89 @@
+import os
+import io
+import shutil
+import sys
+import tempfile
+import time
+
+import pytest
+
+# file.py shares ./shared_files, so import it from an empty scratch folder
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix='file-share-tests-'))
+sys.path.insert(0, ROOT)
+
+def pytest_addoption(parser):
+    parser.addoption('--stress', action='store_true', help='also run the full-size stress tests')
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'stress: full-size stress test, run with --stress')
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--stress'):
+        return
+    skip = pytest.mark.skip(reason='full-size stress test, run with --stress')
+    for item in items:
+        if 'stress' in item.keywords:
+            item.add_marker(skip)
+
+@pytest.fixture(autouse=True)
+def empty_share():
+    """Remove the files and upload sessions of each test, so quotas and listings start from nothing"""
+    yield
+    import file
+    with file.upload_sessions_lock:
+        file.upload_sessions.clear()
+    shutil.rmtree(file.app.config['UPLOAD_SESSION_FOLDER'], ignore_errors=True)
+    folder = file.app.config['UPLOAD_FOLDER']
+    if not os.path.isdir(folder):
+        return
+    os.makedirs(file.app.config['UPLOAD_SESSION_FOLDER'])
+    for name in os.listdir(folder):
+        if not name.startswith('.'):
+            path = os.path.join(folder, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    file.catalog.scan()
+
+@pytest.fixture
+def client():
+    """Flask test client of a started server sharing the scratch folder"""
+    import file
+    file.start_server()
+    return file.app.test_client()
+
+@pytest.fixture
+def send_chunks(client):
+    """Upload data over a chunked session, leaving it to the caller to complete; returns the session id"""
+    def send(filename, data, chunk_size=None):
+        body = {'filename': filename, 'size': len(data)}
+        if chunk_size:
+            body['chunk_size'] = chunk_size
+        resp = client.post('/upload/sessions', json=body)
+        assert resp.status_code == 201, resp.get_json()
+        session = resp.get_json()
+        size = session['chunk_size']
+        for index in range(session['total_chunks']):
+            chunk = data[index * size:(index + 1) * size]
+            resp = client.put(f"/upload/sessions/{session['session_id']}/chunks/{index}", data=chunk)
+            assert resp.status_code == 200, resp.get_json()
+        return session['session_id']
+    return send
+
+@pytest.fixture
+def upload(client):
+    """Upload a file through /upload and wait until post-processing has listed it; returns its entry"""
+    import file
+
+    def send(name, data):
+        resp = client.post('/upload', data={'file': (io.BytesIO(data), name)})
+        assert resp.status_code == 200, resp.get_json()
+        saved = resp.get_json()['uploaded_files'][0]['saved_name']
+        deadline = time.monotonic() + 10
+        while file.catalog.get(saved) is None:
+            assert time.monotonic() < deadline, f'{saved} was never listed'
+            time.sleep(0.01)
+        return resp.get_json()['uploaded_files'][0]
+    return send
@@ -0,0 +1,45 @@
+import io
+import os
+import tarfile
+import zipfile
+
+from file import app, tar_length, tar_members, tar_stream
+
+FILES = {'a.txt': b'alpha' * 1000, 'docs/b.md': b'# beta\n', 'docs/sub/c.bin': os.urandom(70000)}
+
+def share(upload):
+    for name, data in FILES.items():
+        upload(name, data)
+
+def test_zip_of_everything(client, upload):
+    share(upload)
+    resp = client.get('/download/archive')
+    assert resp.headers['Content-Disposition'] == 'attachment; filename=shared_files.zip'
+    with zipfile.ZipFile(io.BytesIO(resp.data)) as archive:
+        assert archive.testzip() is None
+        assert {name: archive.read(name) for name in archive.namelist()} == FILES
+
+def test_tar_of_a_selection(client, upload):
+    share(upload)
+    resp = client.post('/download/archive', data={'format': 'tar', 'files': ['a.txt', 'docs']})
+    assert int(resp.headers['Content-Length']) == len(resp.data)
+    with tarfile.open(fileobj=io.BytesIO(resp.data)) as archive:
+        assert {m.name: archive.extractfile(m).read() for m in archive.getmembers()} == FILES
+
+def test_bad_requests(client, upload):
+    share(upload)
+    resp = client.get('/download/archive', query_string={'files': ['a.txt', 'missing.txt']})
+    assert (resp.status_code, resp.get_json()['files']) == (404, ['missing.txt'])
+    assert client.get('/download/archive', query_string={'format': 'rar'}).status_code == 400
+
+def test_file_deleted_mid_stream_keeps_the_length(client, upload):
+    share(upload)
+    members = tar_members(['a.txt', 'docs/sub/c.bin'])
+    stream = tar_stream(members)
+    first = next(stream)
+    os.remove(os.path.join(app.config['UPLOAD_FOLDER'], 'docs/sub/c.bin'))
+    body = first + b''.join(stream)
+    assert len(body) == tar_length(members)
+    with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+        assert archive.extractfile('a.txt').read() == FILES['a.txt']
+        assert archive.extractfile('docs/sub/c.bin').read() == bytes(70000)
@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+from file import app, asgi_app
+
+def call(method, path, query=b'', headers=(), body=b''):
+    """Run one request through the ASGI app; returns (status, headers, body)"""
+    async def run():
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(3600)  # the client stays connected
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'query_string': query, 'root_path': '',
+            'headers': [(k.lower().encode(), v.encode()) for k, v in headers] +
+                       [(b'content-length', str(len(body)).encode())],
+            'client': ('127.0.0.1', 50000), 'server': ('127.0.0.1', 8000),
+        }
+        await asgi_app(scope, receive, send)
+        start = sent[0]
+        return (start['status'], {k.decode().lower(): v.decode() for k, v in start['headers']},
+                b''.join(m.get('body', b'') for m in sent[1:] if m['type'] == 'http.response.body'))
+    return asyncio.run(run())
+
+def test_lifespan_starts_the_server():
+    async def run():
+        messages = [{'type': 'lifespan.startup'}]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            sent.append(message)
+        task = asyncio.ensure_future(asgi_app({'type': 'lifespan'}, receive, send))
+        while not sent:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        return sent
+    assert asyncio.run(run()) == [{'type': 'lifespan.startup.complete'}]
+
+def test_file_list_and_head(upload):
+    upload('asgi.txt', b'served natively')
+    status, headers, body = call('GET', '/files')
+    assert status == 200
+    assert [entry['name'] for entry in json.loads(body)] == ['asgi.txt']
+    status, head_headers, body = call('HEAD', '/files')
+    assert (status, body) == (200, b'')
+    assert head_headers['etag'] == headers['etag']
+
+def test_range_download(upload):
+    upload('range.bin', bytes(range(256)) * 4)
+    status, headers, body = call('GET', '/download/range.bin', headers=[('Range', 'bytes=10-19')])
+    assert (status, body) == (206, bytes(range(10, 20)))
+    assert headers['content-range'] == 'bytes 10-19/1024'
+
+def test_chunks_natively_and_the_rest_through_flask(client):
+    session = client.post('/upload/sessions', json={'filename': 'asgi.bin', 'size': 5}).get_json()
+    url = f"/upload/sessions/{session['session_id']}"
+    status, _, body = call('PUT', f'{url}/chunks/0', body=b'hello')
+    assert (status, json.loads(body)['received']) == (200, 1)
+    status, _, body = call('POST', f'{url}/complete')
+    assert (status, json.loads(body)['uploaded_files'][0]['saved_name']) == (200, 'asgi.bin')
+    status, _, body = call('GET', '/download/asgi.bin')
+    assert (status, body) == (200, b'hello')
+
+def test_connection_limit(monkeypatch):
+    monkeypatch.setitem(app.config, 'ASGI_MAX_CONNECTIONS', 0)
+    status, headers, _ = call('GET', '/files')
+    assert (status, headers['retry-after']) == (503, '1')
@@ -0,0 +1,61 @@
+import os
+import time
+
+from file import FileCatalog, app, catalog
+
+def write(folder, name, size):
+    path = os.path.join(folder, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+def test_scan_and_refresh(tmp_path):
+    folder = str(tmp_path)
+    write(folder, 'a.txt', 10)
+    write(folder, 'photos/2024/b.jpg', 20)
+    write(folder, '.blobs/ab/cdef', 30)
+    write(folder, 'photos/.hidden', 40)
+    local = FileCatalog(folder)
+    local.scan()
+    assert local.names() == ['a.txt', 'photos/2024/b.jpg']
+    assert local.totals() == (2, 30)
+    photos = local.folder_entry('photos')
+    assert (photos['files'], photos['size']) == (1, 20)
+
+    events = local.subscribe()
+    write(folder, 'photos/c.png', 5)
+    local.refresh('photos/c.png')
+    os.remove(os.path.join(folder, 'a.txt'))
+    local.refresh('a.txt')
+    os.rename(os.path.join(folder, 'photos/c.png'), os.path.join(folder, 'd.png'))
+    local.rename('photos/c.png', 'd.png')
+    assert [events.get_nowait()['type'] for _ in range(3)] == ['add', 'remove', 'rename']
+    assert local.names() == ['d.png', 'photos/2024/b.jpg']
+    assert local.folder_entry('photos')['files'] == 1
+
+    version = local.version
+    local.refresh('d.png')  # unchanged
+    assert local.version == version
+
+def test_changes_outside_the_app_are_picked_up(client):
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'outside.txt')
+    with open(path, 'w') as f:
+        f.write('copied in by hand')
+
+    def listed():
+        return [e['name'] for e in client.get('/files').get_json()]
+    deadline = time.monotonic() + 10
+    while 'outside.txt' not in listed():
+        assert time.monotonic() < deadline, 'the watcher did not see the new file'
+        time.sleep(0.05)
+    os.remove(path)
+    while 'outside.txt' in listed():
+        assert time.monotonic() < deadline, 'the watcher did not see the file go'
+        time.sleep(0.05)
+
+def test_listing_etag(client):
+    first = client.get('/files')
+    assert client.get('/files', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    write(app.config['UPLOAD_FOLDER'], 'etag.txt', 1)
+    catalog.refresh('etag.txt')
+    assert client.get('/files', headers={'If-None-Match': first.headers['ETag']}).status_code == 200
@@ -0,0 +1,54 @@
+import gzip
+import os
+
+import pytest
+
+from file import variants
+
+TEXT = b'a line of a log file that compresses well\n' * 2000
+
+def test_gzip_on_the_fly(client, upload):
+    upload('server.log', TEXT)
+    resp = client.get('/download/server.log', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(resp.data) == TEXT
+
+@pytest.mark.parametrize('coding, module', [('zstd', 'zstandard'), ('br', 'brotli')])
+def test_optional_codings(client, upload, coding, module):
+    library = pytest.importorskip(module)
+    upload(f'{coding}.log', TEXT)
+    resp = client.get(f'/download/{coding}.log', headers={'Accept-Encoding': coding})
+    assert resp.headers['Content-Encoding'] == coding
+    if coding == 'zstd':
+        assert library.ZstdDecompressor().decompressobj().decompress(resp.data) == TEXT
+    else:
+        assert library.decompress(resp.data) == TEXT
+
+def test_precompressed_variant(client, upload):
+    upload('variant.log', TEXT)
+    variants.submit('variant.log').result()
+    resp = client.get('/download/variant.log', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert int(resp.headers['Content-Length']) == len(resp.data) < len(TEXT) // 10
+    assert gzip.decompress(resp.data) == TEXT
+
+def test_preference_order(client, upload):
+    upload('prefer.log', TEXT)
+    resp = client.get('/download/prefer.log', headers={'Accept-Encoding': 'gzip;q=0.5, identity, unknown'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    resp = client.get('/download/prefer.log', headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.data == TEXT
+
+def test_sent_as_is(client, upload):
+    upload('tiny.log', b'short\n')
+    upload('photo.bin', os.urandom(20000))
+    upload('range.log', TEXT)
+    for name in ('tiny.log', 'photo.bin'):
+        resp = client.get(f'/download/{name}', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in resp.headers
+    # Ranges always get the uncompressed bytes, so resuming keeps working
+    resp = client.get('/download/range.log', headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=0-9'})
+    assert (resp.status_code, resp.data) == (206, TEXT[:10])
+    assert 'Content-Encoding' not in resp.headers
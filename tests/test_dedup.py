@@ -0,0 +1,102 @@
+import errno
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+from file import app, blobs, get_session
+
+def shared_path(name):
+    return os.path.join(app.config['UPLOAD_FOLDER'], name)
+
+def test_identical_uploads_share_a_blob(client, send_chunks):
+    data = os.urandom(100000)
+    first = client.post(f'/upload/sessions/{send_chunks("dedup-a.bin", data)}/complete').get_json()
+    second = client.post(f'/upload/sessions/{send_chunks("dedup-b.bin", data)}/complete').get_json()
+    assert first['uploaded_files'][0]['deduplicated'] is False
+    assert second['uploaded_files'][0]['deduplicated'] is True
+    a, b = os.stat(shared_path('dedup-a.bin')), os.stat(shared_path('dedup-b.bin'))
+    assert (a.st_ino, a.st_dev) == (b.st_ino, b.st_dev)
+    assert a.st_mode & 0o777 == 0o444
+
+    digest = first['uploaded_files'][0]['content_hash']
+    resp = client.post('/upload/check', json={'filename': 'dedup-c.bin', 'size': len(data), 'content_hash': digest})
+    assert resp.status_code == 200
+    with open(shared_path(resp.get_json()['uploaded_files'][0]['saved_name']), 'rb') as f:
+        assert f.read() == data
+
+def test_edited_blob_is_not_reused(client, send_chunks):
+    data = os.urandom(50000)
+    client.post(f'/upload/sessions/{send_chunks("edited-a.bin", data)}/complete')
+    path = shared_path('edited-a.bin')
+    os.chmod(path, 0o644)
+    with open(path, 'r+b') as f:
+        f.write(b'changed on the host')
+
+    resp = client.post(f'/upload/sessions/{send_chunks("edited-b.bin", data)}/complete')
+    assert resp.get_json()['uploaded_files'][0]['deduplicated'] is False
+    with open(shared_path('edited-b.bin'), 'rb') as f:
+        assert f.read() == data
+
+class CountingLock:
+    """A lock that counts the threads that have asked for it"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = 0
+
+    def __enter__(self):
+        self.waiting += 1
+        self.lock.acquire()
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+def test_concurrent_completes(client, send_chunks):
+    session_id = send_chunks('race.bin', os.urandom(20000))
+    session = get_session(session_id)
+    session['lock'] = lock = CountingLock()
+    results = []
+
+    def complete():
+        results.append(app.test_client().post(f'/upload/sessions/{session_id}/complete').status_code)
+
+    # Both requests find the session, then queue on its lock
+    with lock:
+        threads = [threading.Thread(target=complete) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        while lock.waiting < 3:
+            time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [200, 404]
+    assert not [name for name in os.listdir(app.config['UPLOAD_FOLDER']) if name.startswith('race_')]
+
+@pytest.mark.parametrize('code', [errno.ENOSPC, errno.EACCES])
+def test_link_errors_are_not_no_hard_links(tmp_path, monkeypatch, code):
+    temp_path = tmp_path / 'upload'
+    temp_path.write_bytes(b'data')
+    digest = hashlib.sha256(str(code).encode()).hexdigest()
+
+    def link(src, dst):
+        raise OSError(code, os.strerror(code))
+    monkeypatch.setattr(os, 'link', link)
+    with pytest.raises(OSError) as e:
+        blobs.commit(str(temp_path), digest, f'linkerror-{code}.bin')
+    assert e.value.errno == code
+    assert not os.path.exists(shared_path(f'linkerror-{code}.bin'))
+
+def test_no_hard_links(tmp_path, monkeypatch):
+    temp_path = tmp_path / 'upload'
+    temp_path.write_bytes(b'on exfat')
+
+    def link(src, dst):
+        raise OSError(errno.EPERM, os.strerror(errno.EPERM))
+    monkeypatch.setattr(os, 'link', link)
+    name, existed = blobs.commit(str(temp_path), hashlib.sha256(b'on exfat').hexdigest(), 'nolinks.bin')
+    assert (name, existed) == ('nolinks.bin', False)
+    with open(shared_path(name), 'rb') as f:
+        assert f.read() == b'on exfat'
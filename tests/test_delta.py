@@ -0,0 +1,81 @@
+import hashlib
+import io
+import json
+import os
+import random
+
+import pytest
+
+from file import SYNC_OP, apply_delta, block_signature, compute_delta
+
+BLOCK = 2048
+
+def sync(tmp_path, base, new, max_scan=None):
+    """Run new through compute_delta against base and rebuild it; returns (rebuilt, copied, literal)"""
+    path = tmp_path / 'base'
+    path.write_bytes(base)
+    with open(path, 'rb') as f:
+        signature = json.loads(block_signature(f, BLOCK)[0])
+        delta = b''.join(compute_delta(io.BytesIO(new), signature, max_scan))
+        out = io.BytesIO()
+        hasher = hashlib.sha256()
+        copied, literal = apply_delta(io.BytesIO(delta), f.fileno(), len(base), BLOCK, out, hasher, len(new))
+    assert hasher.hexdigest() == hashlib.sha256(new).hexdigest()
+    return out.getvalue(), copied, literal
+
+@pytest.fixture
+def base():
+    return random.Random(1).randbytes(50 * BLOCK + 123)
+
+def test_unchanged(tmp_path, base):
+    rebuilt, copied, literal = sync(tmp_path, base, base)
+    assert rebuilt == base
+    assert (copied, literal) == (len(base), 0)
+
+def test_insertion_shifts_data(tmp_path, base):
+    new = base[:10000] + b'inserted' * 100 + base[10000:]
+    rebuilt, copied, literal = sync(tmp_path, base, new)
+    assert rebuilt == new
+    # Only the inserted bytes and the block they landed in are sent
+    assert literal <= 800 + BLOCK
+
+def test_overwrite_append_and_truncate(tmp_path, base):
+    new = base[:BLOCK * 3] + b'x' * BLOCK + base[BLOCK * 4:] + b'tail'
+    rebuilt, copied, literal = sync(tmp_path, base, new)
+    assert rebuilt == new
+    assert literal == BLOCK + len(base) % BLOCK + 4
+
+    new = base[:BLOCK * 7]
+    rebuilt, copied, literal = sync(tmp_path, base, new)
+    assert (rebuilt, literal) == (new, 0)
+
+def test_sparse_probing(tmp_path, base):
+    # Past max_scan bytes without a match, shifted data is still found further on
+    new = os.urandom(BLOCK * 5) + base
+    rebuilt, copied, literal = sync(tmp_path, base, new, max_scan=BLOCK)
+    assert rebuilt == new
+    assert copied > len(base) - 4 * BLOCK
+
+def test_empty_files(tmp_path, base):
+    assert sync(tmp_path, b'', base) == (base, 0, len(base))
+    assert sync(tmp_path, base, b'') == (b'', 0, 0)
+
+def apply(tmp_path, base, delta, max_size=1 << 20):
+    with open(tmp_path / 'base', 'wb+') as f:
+        f.write(base)
+        f.flush()
+        return apply_delta(io.BytesIO(delta), f.fileno(), len(base), BLOCK, io.BytesIO(), hashlib.sha256(), max_size)
+
+def test_malformed(tmp_path, base):
+    with pytest.raises(ValueError, match='past the end'):
+        apply(tmp_path, base, SYNC_OP.pack(b'C', 51, 1))
+    with pytest.raises(ValueError, match='larger than the declared size'):
+        apply(tmp_path, base, SYNC_OP.pack(b'C', 0, 2), max_size=BLOCK)
+    with pytest.raises(ValueError, match='larger than the declared size'):
+        apply(tmp_path, base, SYNC_OP.pack(b'D', 0, 10) + b'0123456789', max_size=9)
+    with pytest.raises(ValueError, match='inside literal data'):
+        apply(tmp_path, base, SYNC_OP.pack(b'D', 0, 10) + b'01234')
+    with pytest.raises(ValueError, match='inside an op header'):
+        apply(tmp_path, base, SYNC_OP.pack(b'D', 0, 1) + b'0' + b'C\0')
+    with pytest.raises(ValueError, match='Unknown delta op'):
+        apply(tmp_path, base, SYNC_OP.pack(b'X', 0, 0))
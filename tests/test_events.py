@@ -0,0 +1,53 @@
+import io
+import json
+
+import pytest
+
+from file import app, catalog
+
+@pytest.fixture
+def events(client, monkeypatch):
+    """Open /events streams; yields a function taking the request headers"""
+    monkeypatch.setitem(app.config, 'EVENTS_KEEPALIVE', 0.1)
+    opened = []
+
+    def open_stream(headers=None):
+        resp = client.get('/events', headers=headers or {})
+        opened.append(resp)
+        assert resp.mimetype == 'text/event-stream'
+        stream = iter(resp.response)
+        assert next(stream).startswith(b'retry:')
+        return stream
+    yield open_stream
+    for resp in opened:
+        resp.close()
+
+def next_event(stream):
+    """The next event frame as (id, event), skipping keep-alives"""
+    for _ in range(100):
+        frame = next(stream).decode()
+        if not frame.startswith(':'):
+            lines = dict(line.split(': ', 1) for line in frame.strip().split('\n'))
+            return lines['id'], json.loads(lines['data'])
+    raise AssertionError('no event')
+
+def upload(client, name):
+    client.post('/upload', data={'file': (io.BytesIO(b'event'), name)})
+
+def test_changes_are_pushed(client, events):
+    stream = events()
+    upload(client, 'pushed.txt')
+    event_id, event = next_event(stream)
+    assert (event['type'], event['file']['name']) == ('add', 'pushed.txt')
+    assert event_id == f"{catalog.instance}-{event['version']}"
+
+def test_reconnect_replays_missed_events(client, events):
+    upload(client, 'before.txt')
+    last_id = f'{catalog.instance}-{catalog.version}'
+    upload(client, 'missed.txt')
+    _, event = next_event(events({'Last-Event-ID': last_id}))
+    assert (event['type'], event['file']['name']) == ('add', 'missed.txt')
+
+def test_reconnect_after_restart_resyncs(client, events):
+    _, event = next_event(events({'Last-Event-ID': 'otherinstance-12'}))
+    assert event['type'] == 'resync'
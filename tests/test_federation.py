@@ -0,0 +1,81 @@
+"""Start three instances that list each other as peers and check they federate"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+FILE_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'file.py')
+NODES = ('alpha', 'beta', 'gamma')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=5) as resp:
+        return resp.read()
+
+def wait_for(check, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            result = check()
+        except OSError:
+            result = None
+        if result:
+            return result
+        if time.monotonic() > deadline:
+            pytest.fail('timed out waiting for the nodes')
+        time.sleep(0.2)
+
+@pytest.fixture
+def nodes(tmp_path):
+    """URL of each node, each sharing one file named after it"""
+    urls = {name: f'http://127.0.0.1:{free_port()}' for name in NODES}
+    peer_args = [arg for url in urls.values() for arg in ('--peer', url)]
+    procs = []
+    try:
+        for name, url in urls.items():
+            folder = tmp_path / name / 'shared_files'
+            folder.mkdir(parents=True)
+            (folder / f'{name}.txt').write_text(f'hello from {name}')
+            procs.append(subprocess.Popen(
+                [sys.executable, FILE_PY, '--host', '127.0.0.1', '--port', url.rsplit(':', 1)[1],
+                 '--node-name', name, *peer_args],
+                cwd=tmp_path / name, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        for url in urls.values():
+            wait_for(lambda: get(url + '/peers'))
+        yield urls
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait(10)
+
+def test_federation(nodes):
+    for name, url in nodes.items():
+        # Each node lists its own file and its two peers' files, not itself as a peer
+        def listed():
+            files = json.loads(get(url + '/files'))
+            return len(files) == 3 and files
+        files = wait_for(listed)
+        assert {f['name']: f.get('node') for f in files} == {
+            other + '.txt': None if other == name else other for other in NODES}
+        status = json.loads(get(url + '/peers'))
+        assert status['node'] == name
+        assert sorted(peer['node'] for peer in status['peers'] if peer['live']) == \
+            sorted(other for other in NODES if other != name)
+
+        # Remote files are proxied from the node that has them
+        for entry in files:
+            if 'peer' in entry:
+                body = get(f"{url}/peers/{entry['peer']}/download/{entry['name']}")
+                assert body == f"hello from {entry['node']}".encode()
+        assert json.loads(get(url + '/files?peers=0')) == [
+            f for f in files if 'peer' not in f]
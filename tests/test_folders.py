@@ -0,0 +1,52 @@
+import io
+import os
+
+from file import app
+
+def page(client, **args):
+    resp = client.get('/files', query_string=dict(args, peers='0'))
+    assert resp.status_code == 200, resp.get_json()
+    return resp.get_json()
+
+def test_uploads_keep_their_folders(client, upload):
+    assert upload('docs/notes.txt', b'notes')['saved_name'] == 'docs/notes.txt'
+    assert upload('../docs/../sub/./x.txt', b'x')['saved_name'] == 'docs/sub/x.txt'
+    assert os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], 'docs', 'sub', 'x.txt'))
+    assert client.get('/download/docs/sub/x.txt').data == b'x'
+    assert sorted(entry['name'] for entry in client.get('/files').get_json()) == \
+        ['docs/notes.txt', 'docs/sub/x.txt']
+
+def test_listing_one_folder_with_totals(client, upload):
+    upload('top.txt', b't')
+    upload('docs/a.txt', b'a' * 10)
+    upload('docs/sub/b.txt', b'b' * 20)
+    upload('docs/sub/c.txt', b'c' * 30)
+
+    top = page(client, dir='')
+    assert [(entry['name'], entry['type']) for entry in top['files']] == \
+        [('docs', 'folder'), ('top.txt', 'document')]
+    assert top['total'] == 2
+    folder = top['files'][0]
+    assert (folder['files'], folder['size']) == (3, 60)
+
+    docs = page(client, dir='docs/')
+    assert [entry['name'] for entry in docs['files']] == ['docs/a.txt', 'docs/sub']
+    assert docs['files'][1]['files'] == 2
+    assert [entry['name'] for entry in page(client, dir='docs/sub', prefix='c')['files']] == ['docs/sub/c.txt']
+
+def test_bad_dirs(client, upload):
+    upload('docs/a.txt', b'a')
+    assert client.get('/files', query_string={'dir': 'docs/a.txt'}).status_code == 404
+    assert client.get('/files', query_string={'dir': 'docs/../..'}).status_code == 400
+    assert client.get('/files', query_string={'dir': '.blobs'}).status_code == 400
+    assert page(client, dir='missing') == {'files': [], 'next_cursor': None, 'total': 0}
+
+def test_a_file_where_a_folder_should_be(client, upload, send_chunks):
+    upload('report', b'a file, not a folder')
+    resp = client.post('/upload', data={'file': (io.BytesIO(b'x'), 'report/page.txt')})
+    assert resp.status_code == 400
+    assert 'report' in resp.get_json()['details'][0]['error']
+
+    session_id = send_chunks('report/page.txt', b'x')
+    assert client.post(f'/upload/sessions/{session_id}/complete').status_code == 409
+    assert not os.path.isdir(os.path.join(app.config['UPLOAD_FOLDER'], 'report'))
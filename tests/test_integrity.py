@@ -0,0 +1,61 @@
+import base64
+import hashlib
+import io
+import os
+
+from file import app, integrity
+
+def repr_digest(data):
+    return 'sha-256=:' + base64.b64encode(hashlib.sha256(data).digest()).decode() + ':'
+
+def test_chunked_upload_has_a_digest_at_once(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'HASH_BLOCK_SIZE', 1024)
+    data = os.urandom(5000)
+    session = client.post('/upload/sessions', json={'filename': 'chunked.bin', 'size': len(data),
+                                                    'chunk_size': 2048}).get_json()
+    url = f"/upload/sessions/{session['session_id']}"
+    # Out of order, as parallel streams send them
+    for index in reversed(range(session['total_chunks'])):
+        chunk = data[index * 2048:(index + 1) * 2048]
+        resp = client.put(f'{url}/chunks/{index}', data=chunk, headers={'Content-Digest': repr_digest(chunk)})
+        assert resp.status_code == 200
+    saved = client.post(f'{url}/complete').get_json()['uploaded_files'][0]
+    assert saved['sha256'] == hashlib.sha256(data).hexdigest()
+    resp = client.get('/download/chunked.bin')
+    assert resp.data == data
+    assert resp.headers['Repr-Digest'] == repr_digest(data)
+
+def test_damaged_chunk_is_refused(client):
+    session = client.post('/upload/sessions', json={'filename': 'damaged.bin', 'size': 10}).get_json()
+    resp = client.put(f"/upload/sessions/{session['session_id']}/chunks/0", data=b'0123456789',
+                      headers={'Content-Digest': repr_digest(b'0123456788')})
+    assert resp.status_code == 400
+    assert 'corrupt' in resp.get_json()['error']
+
+def test_upload_checked_against_client_digest(client):
+    resp = client.post('/upload', data={'file': (io.BytesIO(b'sent'), 'checked.txt'),
+                                        'sha256': hashlib.sha256(b'meant').hexdigest()})
+    assert resp.status_code == 400
+    assert 'corrupt' in resp.get_json()['details'][0]['error']
+    assert not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], 'checked.txt'))
+
+    resp = client.post('/upload', data={'file': (io.BytesIO(b'sent'), 'checked.txt'),
+                                        'sha256': hashlib.sha256(b'sent').hexdigest()})
+    assert resp.get_json()['total_uploaded'] == 1
+    assert client.get('/download/checked.txt').headers['Repr-Digest'] == repr_digest(b'sent')
+
+def test_scrubber_finds_bit_rot(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'SCRUB_RATE', 1 << 40)
+    client.post('/upload', data={'file': (io.BytesIO(b'x' * 4096), 'rot.bin')})
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'rot.bin')
+    integrity.verify('rot.bin', {})
+    assert 'rot.bin' not in integrity.corrupt
+
+    # Flip a byte without changing the size or mtime, as a failing disk would
+    st = os.stat(path)
+    os.chmod(path, 0o644)
+    with open(path, 'r+b') as f:
+        f.write(b'y')
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    integrity.verify('rot.bin', {})
+    assert 'rot.bin' in integrity.corrupt
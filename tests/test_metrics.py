@@ -0,0 +1,85 @@
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from werkzeug.serving import make_server
+
+from file import app, start_server
+
+@pytest.fixture
+def server():
+    """Base URL of the app on a threaded Werkzeug server, which closes responses as a real client sees them"""
+    start_server()
+    httpd = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+def get(url, data=None, method=None):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data, method=method), timeout=10) as resp:
+            return resp.read()
+    except urllib.error.HTTPError as e:
+        return e.read()
+
+def samples(text, name):
+    """{labels: value} of one metric"""
+    return {labels: float(value) for labels, value in
+            re.findall(rf'^file_share_{name}\{{(.*)\}} (\S+)$', text, re.M)}
+
+def until(check):
+    """Poll check until it passes; metrics are recorded once the server closes the response"""
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            return check()
+        except (AssertionError, KeyError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def test_requests_are_counted_per_route(server, upload):
+    upload('counted.txt', b'x' * 1000)
+    before = samples(get(server + '/metrics').decode(), 'http_requests_total')
+    for _ in range(3):
+        get(server + '/download/counted.txt')
+    get(server + '/no/such/page')
+    key = 'route="/download/<path:filename>",method="GET",status="200"'
+
+    def check():
+        text = get(server + '/metrics').decode()
+        after = samples(text, 'http_requests_total')
+        assert after[key] - before.get(key, 0) == 3
+        assert after['route="unmatched",method="GET",status="404"'] >= 1
+        assert samples(text, 'http_sent_bytes_total')['route="/download/<path:filename>"'] >= 3000
+        assert samples(text, 'http_request_duration_seconds_count')['route="/download/<path:filename>"'] >= 3
+    until(check)
+
+def test_active_requests_return_to_zero(server):
+    def active():
+        return samples(get(server + '/metrics').decode(), 'http_active_requests')
+    before = active().get('route="/files"', 0)
+    for _ in range(5):
+        get(server + '/files')
+
+    def check():
+        now = active()
+        # The /metrics request itself is still in progress
+        assert now['route="/files"'] == before
+        assert now['route="/metrics"'] >= 1
+    until(check)
+
+def test_slow_requests_are_profiled(server, tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'PROFILE_SAMPLE_RATE', 1)
+    monkeypatch.setitem(app.config, 'PROFILE_SLOW_SECONDS', 0)
+    monkeypatch.setitem(app.config, 'PROFILE_FOLDER', str(tmp_path))
+    get(server + '/files')
+
+    def check():
+        assert [name for name in os.listdir(tmp_path) if name.endswith('.prof')]
+    until(check)
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+from file import app, catalog
+
+@pytest.fixture
+def files(client):
+    """Twenty files, each n bytes long for n from 1 to 20, half .txt and half .log"""
+    folder = app.config['UPLOAD_FOLDER']
+    names = []
+    for n in range(1, 21):
+        name = f"page{n:02d}.{'txt' if n % 2 else 'log'}"
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(b'x' * n)
+        names.append(name)
+    catalog.scan()
+    return names
+
+def walk(client, **args):
+    """Names from following next_cursor through every page"""
+    names = []
+    cursor = None
+    while True:
+        query = dict(args, cursor=cursor) if cursor else args
+        payload = client.get('/files', query_string=query).get_json()
+        names += [entry['name'] for entry in payload['files']]
+        cursor = payload['next_cursor']
+        if cursor is None:
+            return names, payload['total']
+
+def test_pages_cover_every_file_once(client, files):
+    assert walk(client, limit=10) == (files, 20)
+    assert walk(client, limit=7, order='desc') == (files[::-1], 20)
+    assert walk(client, limit=1, sort='size', order='desc') == (files[::-1], 20)
+
+def test_last_full_page_has_no_cursor(client, files):
+    payload = client.get('/files', query_string={'limit': 20}).get_json()
+    assert len(payload['files']) == 20
+    assert payload['next_cursor'] is None
+
+def test_filters(client, files):
+    assert walk(client, limit=3, ext='log') == (files[1::2], 10)
+    assert walk(client, limit=3, prefix='PAGE1') == (files[9:19], 10)
+    assert walk(client, limit=3, prefix='page1', ext='txt,csv') == (files[10:19:2], 5)
+
+@pytest.mark.parametrize('args', [
+    {'sort': 'colour'}, {'order': 'up'}, {'limit': 'ten'}, {'cursor': 'not-a-cursor'},
+    {'dir': '../outside'},
+])
+def test_invalid_arguments(client, args):
+    assert client.get('/files', query_string=args).status_code == 400
@@ -0,0 +1,52 @@
+import os
+import queue
+import threading
+
+from file import app
+
+CHUNK = 4 * 1024 * 1024
+
+def test_parallel_streams_across_files(client):
+    """Workers pull chunks of several files from one queue, as the web page does"""
+    files = {f'parallel{i}.bin': os.urandom(CHUNK * 2 + i * 1000) for i in range(3)}
+    sessions = {}
+    for name, data in files.items():
+        sessions[name] = client.post('/upload/sessions', json={
+            'filename': name, 'size': len(data), 'chunk_size': CHUNK}).get_json()
+    streams = sessions[name]['parallel_streams']
+    assert streams == app.config['UPLOAD_PARALLEL_STREAMS']
+
+    chunks = queue.Queue()
+    for name, session in sessions.items():
+        for index in range(session['total_chunks']):
+            chunks.put((name, index))
+    failures = []
+
+    def stream():
+        worker = app.test_client()
+        while True:
+            try:
+                name, index = chunks.get_nowait()
+            except queue.Empty:
+                return
+            data = files[name][index * CHUNK:(index + 1) * CHUNK]
+            resp = worker.put(f"/upload/sessions/{sessions[name]['session_id']}/chunks/{index}", data=data)
+            if resp.status_code != 200:
+                failures.append((name, index, resp.status_code))
+
+    threads = [threading.Thread(target=stream) for _ in range(streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not failures
+
+    for name, data in files.items():
+        resp = client.post(f"/upload/sessions/{sessions[name]['session_id']}/complete")
+        assert resp.status_code == 200
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], name), 'rb') as f:
+            assert f.read() == data
+
+def test_page_uses_the_advertised_stream_count(client):
+    page = client.get('/').get_data(as_text=True)
+    assert f"const PARALLEL_STREAMS = {app.config['UPLOAD_PARALLEL_STREAMS']};" in page
@@ -0,0 +1,45 @@
+import os
+import time
+from concurrent.futures import Future
+
+import file
+from file import UploadPipeline, app
+
+def wait_for(check, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+def test_slow_stage_does_not_hold_up_the_queue(monkeypatch):
+    pending = []
+
+    def submit(name):
+        pending.append(Future())
+        return pending[-1]
+    monkeypatch.setattr(file.variants, 'submit', submit)
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    pipeline = UploadPipeline(1, 1)
+    pipeline.start()
+    for i in range(3):
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], f'slow{i}.txt'), 'w') as f:
+            f.write('text ' * 1000)
+        pipeline.submit(f'slow{i}.txt')
+    # All three jobs finish while their compression is still running
+    wait_for(lambda: pipeline.status()['completed'] == 3)
+    assert len(pending) == 3
+    assert pipeline.status()['stages']['compress']['count'] == 0
+
+    pending[0].set_result(None)
+    pending[1].set_exception(OSError('disk full'))
+    stages = pipeline.status()['stages']
+    assert (stages['compress']['count'], stages['compress']['errors']) == (2, 1)
+
+def test_full_queue_refuses_uploads(client, monkeypatch):
+    pipeline = UploadPipeline(1, 1)  # not started, so the queue stays full
+    pipeline.submit('queued.txt')
+    monkeypatch.setattr(file, 'pipeline', pipeline)
+    resp = client.post('/upload/sessions', json={'filename': 'refused.txt', 'size': 10})
+    assert resp.status_code == 503
+    assert resp.get_json()['retry_after'] == int(resp.headers['Retry-After']) >= 1
+    assert pipeline.status()['rejected'] == 1
@@ -0,0 +1,48 @@
+import pytest
+
+from file import app, resolve_ranges
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', [(0, 100)]),
+    ('bytes=100-', [(100, 1000)]),
+    ('bytes=-100', [(900, 1000)]),
+    ('bytes=-5000', [(0, 1000)]),
+    ('bytes=990-5000', [(990, 1000)]),
+    ('BYTES = 0-0', [(0, 1)]),
+    # Out of order, overlapping and adjacent ranges are sorted and merged
+    ('bytes=500-599,0-99', [(0, 100), (500, 600)]),
+    ('bytes=0-99,50-149', [(0, 150)]),
+    ('bytes=0-99,100-199', [(0, 200)]),
+    ('bytes=0-9, 200-209, 5-19', [(0, 20), (200, 210)]),
+])
+def test_satisfiable(header, expected):
+    assert resolve_ranges(header, 1000) == expected
+
+def test_unsatisfiable():
+    assert resolve_ranges('bytes=1000-1099', 1000) == []
+    assert resolve_ranges('bytes=2000-,3000-3999', 1000) == []
+    assert resolve_ranges('bytes=-0', 1000) == []
+
+@pytest.mark.parametrize('header', [
+    None,
+    '',
+    'items=0-9',
+    'bytes=5',
+    'bytes=-',
+    'bytes=a-9',
+    'bytes=0-x',
+    'bytes=9-0',
+    'bytes=0-9,',
+])
+def test_ignored(header):
+    assert resolve_ranges(header, 1000) is None
+
+def test_empty_file():
+    assert resolve_ranges('bytes=0-9', 0) is None
+
+def test_too_many_ranges(monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_RANGES', 3)
+    assert resolve_ranges('bytes=0-0,2-2,4-4', 1000) == [(0, 1), (2, 3), (4, 5)]
+    assert resolve_ranges('bytes=0-0,2-2,4-4,6-6', 1000) is None
+    # Merging happens before the limit is applied
+    assert resolve_ranges('bytes=0-0,1-1,2-2,3-3', 1000) == [(0, 4)]
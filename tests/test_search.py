@@ -0,0 +1,57 @@
+import io
+import os
+import time
+
+import pytest
+from PIL import Image
+
+from file import app, catalog
+
+def search(client, **args):
+    resp = client.get('/search', query_string=args)
+    assert resp.status_code == 200, resp.get_json()
+    return [result['name'] for result in resp.get_json()['results']]
+
+def until_found(client, expected, **args):
+    """Search until the indexer, which follows the catalog in the background, has caught up"""
+    deadline = time.monotonic() + 10
+    while True:
+        names = search(client, **args)
+        if names == expected or time.monotonic() > deadline:
+            return names
+        time.sleep(0.05)
+
+@pytest.fixture
+def shared(upload):
+    exif = Image.Exif()
+    exif[0x010F] = 'Fujifilm'  # Make
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), 'blue').save(buffer, 'JPEG', exif=exif)
+    upload('holiday_beach.jpg', buffer.getvalue())
+    upload('meeting-notes.txt', b'Agenda: quarterly budget review\n' * 100)
+    upload('budget.csv', b'item,cost\nlamp,12\n')
+
+def test_names_contents_and_exif(client, shared):
+    assert until_found(client, ['holiday_beach.jpg'], q='holi') == ['holiday_beach.jpg']
+    assert until_found(client, ['meeting-notes.txt'], q='quarterly') == ['meeting-notes.txt']
+    assert until_found(client, ['holiday_beach.jpg'], q='fujifilm') == ['holiday_beach.jpg']
+    assert sorted(until_found(client, ['budget.csv', 'meeting-notes.txt'], q='budget', sort='name')) == \
+        ['budget.csv', 'meeting-notes.txt']
+
+def test_filters(client, shared):
+    until_found(client, ['budget.csv', 'holiday_beach.jpg', 'meeting-notes.txt'], sort='name')
+    assert search(client, ext='csv,txt', sort='name') == ['budget.csv', 'meeting-notes.txt']
+    assert search(client, min_size=1000) == ['meeting-notes.txt']
+    assert search(client, sort='size', order='desc', limit=1) == ['meeting-notes.txt']
+    assert search(client, sort='size', order='desc', limit=1, offset=2) == ['budget.csv']
+    assert search(client, type='image') == ['holiday_beach.jpg']
+
+def test_removed_files_leave_the_index(client, shared):
+    until_found(client, ['budget.csv'], q='budget', ext='csv')
+    os.remove(os.path.join(app.config['UPLOAD_FOLDER'], 'budget.csv'))
+    catalog.refresh('budget.csv')
+    assert until_found(client, [], q='budget', ext='csv') == []
+
+@pytest.mark.parametrize('args', [{'sort': 'colour'}, {'limit': 'x'}, {'after': 'yesterday'}])
+def test_invalid_arguments(client, args):
+    assert client.get('/search', query_string=args).status_code == 400
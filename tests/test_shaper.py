@@ -0,0 +1,85 @@
+import math
+import os
+import time
+
+import pytest
+
+from file import BandwidthShaper, app, fair_shares
+
+@pytest.fixture
+def limits(monkeypatch):
+    """Set RATE_LIMIT and CLIENT_RATE_LIMIT for one test"""
+    def set_limits(rate=None, client=None):
+        monkeypatch.setitem(app.config, 'RATE_LIMIT', rate)
+        monkeypatch.setitem(app.config, 'CLIENT_RATE_LIMIT', client)
+    return set_limits
+
+def test_fair_shares():
+    assert fair_shares(90, {'a': math.inf, 'b': math.inf, 'c': math.inf}) == {'a': 30, 'b': 30, 'c': 30}
+    # What a small demand leaves is shared by the others
+    assert fair_shares(90, {'a': 10, 'b': math.inf, 'c': math.inf}) == {'a': 10, 'b': 40, 'c': 40}
+    assert fair_shares(90, {'a': 10, 'b': 20}) == {'a': 10, 'b': 20}
+    assert fair_shares(math.inf, {'a': 10, 'b': math.inf}) == {'a': 10, 'b': math.inf}
+
+def test_shares_between_clients_then_transfers(limits):
+    limits(rate=1200)
+    shaper = BandwidthShaper()
+    a1 = shaper.start('out', 'a', '/download/1')
+    a2 = shaper.start('out', 'a', '/download/2')
+    b = shaper.start('out', 'b', '/download/3')
+    upload = shaper.start('in', 'b', '/upload')
+    assert (a1['share'], a2['share'], b['share'], upload['share']) == (300, 300, 600, 1200)
+    shaper.finish(b)
+    assert (a1['share'], a2['share']) == (600, 600)
+
+def test_client_limit(limits):
+    limits(client=100)
+    shaper = BandwidthShaper()
+    a = shaper.start('out', 'a', '/download/1')
+    b1 = shaper.start('out', 'b', '/download/2')
+    b2 = shaper.start('out', 'b', '/download/3')
+    assert (a['share'], b1['share'], b2['share']) == (100, 50, 50)
+
+def test_unlimited_transfers_are_not_paced(limits):
+    limits()
+    shaper = BandwidthShaper()
+    transfer = shaper.start('out', 'a', '/download/1')
+    assert transfer['share'] is None
+    assert shaper.acquire(transfer, 10 ** 9) == 0
+
+def test_pacing(limits):
+    limits(rate=1000)
+    shaper = BandwidthShaper()
+    transfer = shaper.start('out', 'a', '/download/1')
+    # Each byte waits its turn at the share
+    assert shaper.acquire(transfer, 250) == pytest.approx(0.25, abs=0.01)
+    assert shaper.acquire(transfer, 500) == pytest.approx(0.75, abs=0.01)
+
+def test_priority_routes():
+    shaper = BandwidthShaper()
+    assert not shaper.is_bulk('/events', None)
+    assert not shaper.is_bulk('/preview/<path:filename>', 50 * 1024 * 1024)
+    assert not shaper.is_bulk('/download/<path:filename>', app.config['SHAPER_PRIORITY_BYTES'])
+    assert shaper.is_bulk('/download/<path:filename>', app.config['SHAPER_PRIORITY_BYTES'] + 1)
+    assert shaper.is_bulk('/download/archive', None)
+
+def test_rate_limited_download(client, upload, limits):
+    data = os.urandom(3 * 1024 * 1024)
+    upload('big.bin', data)
+    limits(rate=4 * 1024 * 1024)
+    started = time.monotonic()
+    resp = client.get('/download/big.bin', buffered=False)
+    body = iter(resp.response)
+    received = next(body)
+    transfers = client.get('/transfers').get_json()
+    assert transfers['rate_limit'] == 4 * 1024 * 1024
+    [transfer] = [t for t in transfers['transfers'] if t['path'] == '/download/big.bin']
+    assert (transfer['direction'], transfer['size']) == ('out', len(data))
+    # Less whatever the small responses of this test took first
+    assert 0 < transfer['share'] <= 4 * 1024 * 1024
+    received += b''.join(body)
+    resp.close()
+    assert received == data
+    # 3 MiB at 4 MiB/s
+    assert time.monotonic() - started > 0.6
+    assert not [t for t in client.get('/transfers').get_json()['transfers'] if t['path'] == '/download/big.bin']
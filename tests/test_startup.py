@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run(tmp_path, code):
+    return subprocess.run([sys.executable, '-c', textwrap.dedent(code)], cwd=tmp_path, env=dict(os.environ, PYTHONPATH=ROOT),
+                          capture_output=True, text=True, timeout=60)
+
+def test_import_has_no_side_effects(tmp_path):
+    result = run(tmp_path, '''
+        import sys, threading
+        import file
+        assert file.network._ips is None
+        assert threading.active_count() == 1, threading.enumerate()
+        assert 'PIL.Image' not in sys.modules
+    ''')
+    assert result.returncode == 0, result.stderr
+    assert os.listdir(tmp_path) == []
+
+def test_lazy_modules_load_once_across_threads(tmp_path):
+    # LazyLoader let all but one of these threads see PIL.Image half-loaded
+    result = run(tmp_path, '''
+        import threading
+        import file
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def touch():
+            barrier.wait()
+            try:
+                file.Image.open, file.ImageOps.exif_transpose
+            except AttributeError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=touch) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+    ''')
+    assert result.returncode == 0, result.stderr
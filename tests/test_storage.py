@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+from file import StorageManager, app, catalog
+
+KB = 1024
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """A StorageManager over five 200 KB files, oldest first, and no limits set"""
+    folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    monkeypatch.setitem(app.config, 'STORAGE_MIN_FREE_BYTES', 0)
+    names = [f'file{i}.bin' for i in range(5)]
+    for i, name in enumerate(names):
+        path = os.path.join(folder, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 200 * KB)
+        os.utime(path, (1000000 + i, 1000000 + i))
+        catalog.refresh(name)
+    yield StorageManager(folder, str(tmp_path / 'storage.json'))
+    for name in names:
+        try:
+            os.remove(os.path.join(folder, name))
+        except FileNotFoundError:
+            pass
+        catalog.refresh(name)
+
+def shared():
+    return sorted(catalog.names())
+
+def test_no_limits(storage):
+    assert storage.check(10 ** 12, 'client', disk=False) is None
+
+def test_quota(storage, monkeypatch):
+    monkeypatch.setitem(app.config, 'STORAGE_QUOTA_BYTES', 1200 * KB)
+    assert storage.check(200 * KB, 'client') is None
+    error, status = storage.check(200 * KB + 1, 'client')
+    assert status == 507
+    assert error['used'] == 1000 * KB
+    assert len(shared()) == 5
+
+def test_evicts_only_the_shortfall(storage, monkeypatch):
+    monkeypatch.setitem(app.config, 'STORAGE_QUOTA_BYTES', 1000 * KB)
+    monkeypatch.setitem(app.config, 'RETENTION_EVICT_LRU', True)
+    storage.touch('file0.bin')
+    assert storage.check(300 * KB, 'client') is None
+    # file0 was downloaded most recently, so the next two oldest go
+    assert shared() == ['file0.bin', 'file3.bin', 'file4.bin']
+
+def test_no_eviction_when_it_cannot_help(storage, monkeypatch):
+    monkeypatch.setitem(app.config, 'STORAGE_QUOTA_BYTES', 1000 * KB)
+    monkeypatch.setitem(app.config, 'RETENTION_EVICT_LRU', True)
+    error, status = storage.check(1000 * KB + 1, 'client')
+    assert status == 507
+    assert len(shared()) == 5
+
+def test_no_eviction_for_a_refused_upload(storage, monkeypatch):
+    monkeypatch.setitem(app.config, 'STORAGE_QUOTA_BYTES', 1000 * KB)
+    monkeypatch.setitem(app.config, 'RETENTION_EVICT_LRU', True)
+    monkeypatch.setitem(app.config, 'CLIENT_QUOTA_BYTES', 100 * KB)
+    assert storage.check(200 * KB, 'client')[1] == 507
+    monkeypatch.setitem(app.config, 'CLIENT_QUOTA_BYTES', None)
+    monkeypatch.setitem(app.config, 'STORAGE_MIN_FREE_BYTES', 1 << 60)
+    error, status = storage.check(200 * KB, 'client')
+    assert status == 507 and 'free' in error
+    assert len(shared()) == 5
+    # Content that is already stored needs no disk space, only quota
+    assert storage.check(200 * KB, 'client', disk=False) is None
+    assert len(shared()) == 4
+
+def test_client_quota(storage, monkeypatch):
+    monkeypatch.setitem(app.config, 'CLIENT_QUOTA_BYTES', 500 * KB)
+    storage.record_upload('file0.bin', 'phone')
+    storage.record_upload('file1.bin', 'phone')
+    assert storage.check(100 * KB, 'phone') is None
+    error, status = storage.check(100 * KB + 1, 'phone')
+    assert (status, error['used']) == (507, 400 * KB)
+    assert storage.check(500 * KB, 'laptop') is None
@@ -0,0 +1,48 @@
+import io
+import os
+
+from PIL import Image
+
+from file import app, catalog, thumbnails
+
+def png(size=(1200, 800), color='red'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+def preview(client, name, **args):
+    resp = client.get(f'/preview/{name}', query_string=args)
+    assert resp.status_code == 200
+    return Image.open(io.BytesIO(resp.data)), resp
+
+def test_thumbnail_sizes(client, upload):
+    upload('photo.png', png())
+    image, resp = preview(client, 'photo.png')
+    assert resp.mimetype in ('image/webp', 'image/jpeg')
+    assert max(image.size) == 80
+    assert max(preview(client, 'photo.png', size=200)[0].size) == 320
+    # Cached on disk; a second request doesn't render again
+    path = thumbnails.get('photo.png', 80)
+    rendered = os.stat(path).st_mtime_ns
+    preview(client, 'photo.png')
+    assert os.stat(path).st_mtime_ns == rendered
+
+def test_copies_share_thumbnails(client, upload):
+    upload('one.png', png(color='blue'))
+    upload('two.png', png(color='blue'))
+    assert thumbnails.get('one.png', 160) == thumbnails.get('two.png', 160)
+
+def test_unreadable_images_fall_back_to_the_original(client, upload):
+    upload('broken.png', b'not a png')
+    assert client.get('/preview/broken.png').data == b'not a png'
+    assert client.get('/preview/notes.txt').status_code == 404
+
+def test_index_drops_deleted_files(client, upload):
+    upload('gone.png', png(color='green'))
+    preview(client, 'gone.png')
+    assert 'gone.png' in thumbnails.digests
+    os.remove(os.path.join(app.config['UPLOAD_FOLDER'], 'gone.png'))
+    catalog.refresh('gone.png')
+    thumbnails.dirty = True
+    thumbnails.save()
+    assert 'gone.png' not in thumbnails.digests
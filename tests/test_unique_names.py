@@ -0,0 +1,69 @@
+"""Concurrency stress test for upload name allocation
+
+Uploads the same filename many times from parallel threads and checks that
+every upload got its own name and that every saved file still holds the
+bytes sent for it. Half of the uploads share content, so the hard-linked
+deduplication path runs alongside plain stores. The full-size run is
+marked stress and runs with: python -m pytest tests --stress
+"""
+import io
+import os
+import threading
+
+import pytest
+
+import file
+from file import app
+
+FILENAME = 'IMG_0001.jpg'
+
+def content(i):
+    # Even uploads share one payload and are deduplicated
+    return b'shared payload\n' * 64 if i % 2 == 0 else f'upload {i}\n'.encode() * 64
+
+@pytest.mark.parametrize('uploads, threads', [
+    (60, 16),
+    pytest.param(500, 64, marks=pytest.mark.stress),
+])
+def test_concurrent_uploads_get_unique_names(client, monkeypatch, uploads, threads):
+    monkeypatch.setitem(app.config, 'POSTPROCESS_QUEUE', uploads)
+    monkeypatch.setattr(file.pipeline.jobs, 'maxsize', uploads)
+    jobs = list(range(uploads))
+    lock = threading.Lock()
+    saved = {}  # saved name -> expected content
+    failures = []
+
+    def worker():
+        while True:
+            with lock:
+                if not jobs:
+                    return
+                i = jobs.pop()
+            body = content(i)
+            resp = client.post('/upload', data={'file': (io.BytesIO(body), FILENAME)})
+            with lock:
+                if resp.status_code != 200:
+                    failures.append(f'upload {i}: HTTP {resp.status_code}')
+                    continue
+                name = resp.get_json()['uploaded_files'][0]['saved_name']
+                if name in saved:
+                    failures.append(f'upload {i}: name {name} handed out twice')
+                saved[name] = body
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    folder = app.config['UPLOAD_FOLDER']
+    on_disk = {name for name in os.listdir(folder) if name.startswith('IMG_0001')}
+    for name, body in saved.items():
+        if name not in on_disk:
+            failures.append(f'{name} is missing')
+            continue
+        with open(os.path.join(folder, name), 'rb') as f:
+            if f.read() != body:
+                failures.append(f'{name} was overwritten')
+    assert not failures, failures[:20]
+    assert len(on_disk) == uploads
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+from file import app, upload_sessions, upload_sessions_lock
+
+CHUNK = 4 * 1024 * 1024  # the smallest chunk_size allowed for multi-chunk sessions
+
+@pytest.fixture
+def data():
+    return os.urandom(2 * CHUNK + 1000)
+
+def create(client, name, data):
+    resp = client.post('/upload/sessions', json={'filename': name, 'size': len(data), 'chunk_size': CHUNK})
+    assert resp.status_code == 201
+    return resp.get_json()
+
+def put(client, session, index, data):
+    return client.put(f"/upload/sessions/{session['session_id']}/chunks/{index}",
+                      data=data[index * CHUNK:(index + 1) * CHUNK])
+
+def test_chunks_in_any_order(client, data):
+    session = create(client, 'chunks.bin', data)
+    assert (session['total_chunks'], session['missing_chunks']) == (3, [0, 1, 2])
+    for index in (2, 0):
+        assert put(client, session, index, data).status_code == 200
+    status = client.get(f"/upload/sessions/{session['session_id']}").get_json()
+    assert (status['received_chunks'], status['missing_chunks'], status['complete']) == ([0, 2], [1], False)
+
+    resp = client.post(f"/upload/sessions/{session['session_id']}/complete")
+    assert resp.status_code == 409
+    assert resp.get_json()['missing_chunks'] == [1]
+
+    put(client, session, 1, data)
+    resp = client.post(f"/upload/sessions/{session['session_id']}/complete")
+    assert resp.get_json()['uploaded_files'][0]['saved_name'] == 'chunks.bin'
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], 'chunks.bin'), 'rb') as f:
+        assert f.read() == data
+    assert client.get(f"/upload/sessions/{session['session_id']}").status_code == 404
+
+def test_resume_after_restart(client, data):
+    session = create(client, 'resumed.bin', data)
+    put(client, session, 0, data)
+    # A restart loses the in-memory sessions; they are reloaded from disk
+    with upload_sessions_lock:
+        upload_sessions.clear()
+    status = client.get(f"/upload/sessions/{session['session_id']}").get_json()
+    assert status['missing_chunks'] == [1, 2]
+    put(client, session, 1, data)
+    put(client, session, 2, data)
+    resp = client.post(f"/upload/sessions/{session['session_id']}/complete")
+    assert resp.status_code == 200
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], 'resumed.bin'), 'rb') as f:
+        assert f.read() == data
+
+def test_abort(client, data):
+    session = create(client, 'aborted.bin', data)
+    put(client, session, 0, data)
+    assert client.delete(f"/upload/sessions/{session['session_id']}").status_code == 200
+    assert client.get(f"/upload/sessions/{session['session_id']}").status_code == 404
+    assert os.listdir(app.config['UPLOAD_SESSION_FOLDER']) == []
+
+def test_bad_chunks(client, data):
+    session = create(client, 'bad.bin', data)
+    url = f"/upload/sessions/{session['session_id']}/chunks"
+    assert client.put(f'{url}/3', data=b'x').status_code == 400
+    assert client.put(f'{url}/2', data=b'too short').status_code == 400
+    assert client.put('/upload/sessions/' + '0' * 32 + '/chunks/0', data=b'x').status_code == 404
+
+@pytest.mark.parametrize('body', [
+    {'size': 10},
+    {'filename': 'a.txt'},
+    {'filename': 'a.txt', 'size': 10, 'chunk_size': -1},
+    {'filename': 'a.txt', 'size': CHUNK * 2, 'chunk_size': CHUNK + 1},
+    {'filename': 'a.txt', 'size': 10, 'content_hash': 'abc'},
+])
+def test_invalid_sessions(client, body):
+    assert client.post('/upload/sessions', json=body).status_code == 400